@@ -0,0 +1,132 @@
+import sqlite3
+import time
+from enum import Enum
+
+from DBService.connection_pool import SQLiteConnectionPool
+from DBService.migrations import migrate
+
+class BroadcastStatus(Enum):
+    RUNNING = 'running'
+    DONE = 'done'
+
+class Broadcast:
+    def __init__(self, broadcast_id: int, text: str, status: str, checkpoint_user_id: str | None, sent_count: int, failed_count: int):
+        self.id = broadcast_id
+        self.text = text
+        self.status = BroadcastStatus(status)
+        self.checkpoint_user_id = checkpoint_user_id
+        self.sent_count = sent_count
+        self.failed_count = failed_count
+
+def _create_broadcast_tables(connection: sqlite3.Connection):
+    connection.execute(
+        """
+        CREATE TABLE broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            checkpoint_user_id TEXT DEFAULT NULL,
+            sent_count INTEGER NOT NULL DEFAULT 0,
+            failed_count INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """
+    )
+    connection.execute(
+        """
+        CREATE TABLE broadcast_failures (
+            broadcast_id INTEGER NOT NULL,
+            user_id TEXT NOT NULL,
+            status INTEGER DEFAULT NULL,
+            status_message TEXT DEFAULT NULL,
+            PRIMARY KEY (broadcast_id, user_id)
+        )
+        """
+    )
+
+BROADCAST_MIGRATIONS = [
+    _create_broadcast_tables,
+]
+
+class BroadcastDatabaseService:
+    def __init__(self, db_name: str = "broadcasts.db", pool_size: int = 2):
+        self._pool = SQLiteConnectionPool(db_name, pool_size, metrics_stage="broadcast_db")
+        with self._pool.connection() as connection:
+            migrate(connection, BROADCAST_MIGRATIONS)
+
+    def close(self):
+        self._pool.close()
+
+    def create(self, text: str) -> int:
+        now = time.time()
+        with self._pool.connection() as connection:
+            cursor = connection.execute("INSERT INTO broadcasts (text, created_at, updated_at) VALUES (?, ?, ?)", (text, now, now))
+            return cursor.lastrowid
+
+    def load(self, broadcast_id: int) -> Broadcast | None:
+        with self._pool.connection() as connection:
+            row = connection.execute(
+                "SELECT id, text, status, checkpoint_user_id, sent_count, failed_count FROM broadcasts WHERE id = ?",
+                (broadcast_id,)
+            ).fetchone()
+        return Broadcast(*row) if row else None
+
+    def save_progress(self, broadcast_id: int, checkpoint_user_id: str, sent_count: int, failures: list[tuple[str, int | None, str | None]]):
+        # failures and the checkpoint are written in one transaction, so a resumed broadcast counts every user once
+        with self._pool.connection() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO broadcast_failures (broadcast_id, user_id, status, status_message) VALUES (?, ?, ?, ?)",
+                [(broadcast_id, *failure) for failure in failures]
+            )
+            connection.execute(
+                """
+                UPDATE broadcasts
+                SET checkpoint_user_id = ?, sent_count = sent_count + ?, failed_count = failed_count + ?, updated_at = ?
+                WHERE id = ?
+                """,
+                (checkpoint_user_id, sent_count, len(failures), time.time(), broadcast_id)
+            )
+
+    def get_unsent_receivers(self, broadcast_id: int) -> list[str]:
+        # receivers of batches whose broadcast call failed as a whole have no viber status
+        with self._pool.connection() as connection:
+            rows = connection.execute(
+                "SELECT user_id FROM broadcast_failures WHERE broadcast_id = ? AND status IS NULL ORDER BY user_id",
+                (broadcast_id,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def save_resent(self, broadcast_id: int, receivers: list[str], failures: list[tuple[str, int | None, str | None]]):
+        # the failures of the resent receivers are replaced by the failures of the new call
+        with self._pool.connection() as connection:
+            connection.executemany(
+                "DELETE FROM broadcast_failures WHERE broadcast_id = ? AND user_id = ?",
+                [(broadcast_id, receiver) for receiver in receivers]
+            )
+            connection.executemany(
+                "INSERT OR REPLACE INTO broadcast_failures (broadcast_id, user_id, status, status_message) VALUES (?, ?, ?, ?)",
+                [(broadcast_id, *failure) for failure in failures]
+            )
+            connection.execute(
+                """
+                UPDATE broadcasts
+                SET sent_count = sent_count + ?, failed_count = failed_count - ?, updated_at = ?
+                WHERE id = ?
+                """,
+                (len(receivers) - len(failures), len(receivers) - len(failures), time.time(), broadcast_id)
+            )
+
+    def finish(self, broadcast_id: int):
+        with self._pool.connection() as connection:
+            connection.execute(
+                "UPDATE broadcasts SET status = ?, updated_at = ? WHERE id = ?",
+                (BroadcastStatus.DONE.value, time.time(), broadcast_id)
+            )
+
+    def get_failures(self, broadcast_id: int) -> list[tuple[str, int | None, str | None]]:
+        with self._pool.connection() as connection:
+            return connection.execute(
+                "SELECT user_id, status, status_message FROM broadcast_failures WHERE broadcast_id = ? ORDER BY user_id",
+                (broadcast_id,)
+            ).fetchall()
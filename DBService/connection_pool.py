@@ -0,0 +1,87 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from metrics import metrics_registry
+
+class SQLiteConnectionPool:
+    def __init__(self, db_name: str, pool_size: int = 4, synchronous: str = "NORMAL", cache_size: int = -8000,
+                 mmap_size: int = 0, cached_statements: int = 128, timeout: float = 10.0, metrics_stage: str = "sqlite"):
+        self._db_name = db_name
+        self._metrics_stage = metrics_stage
+        self._pool_size = max(1, pool_size)
+        self._synchronous = synchronous
+        self._cache_size = cache_size
+        self._mmap_size = mmap_size
+        self._cached_statements = cached_statements
+        self._timeout = timeout
+        self._idle_connections = queue.LifoQueue(maxsize=self._pool_size)
+        self._all_connections = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+    @property
+    def db_name(self) -> str:
+        return self._db_name
+
+    def _create_connection(self) -> sqlite3.Connection:
+        # check_same_thread is disabled because connections are handed between worker threads,
+        # the pool guarantees that a connection is used by a single thread at a time
+        connection = sqlite3.connect(
+            self._db_name,
+            timeout=self._timeout,
+            check_same_thread=False,
+            cached_statements=self._cached_statements
+        )
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute(f"PRAGMA synchronous = {self._synchronous}")
+        connection.execute(f"PRAGMA cache_size = {int(self._cache_size)}")
+        connection.execute(f"PRAGMA mmap_size = {int(self._mmap_size)}")
+        return connection
+
+    def _acquire(self) -> sqlite3.Connection:
+        if self._closed:
+            raise sqlite3.ProgrammingError("Connection pool is closed")
+
+        try:
+            return self._idle_connections.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if len(self._all_connections) < self._pool_size:
+                connection = self._create_connection()
+                self._all_connections.append(connection)
+                return connection
+
+        try:
+            return self._idle_connections.get(timeout=self._timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError(f"No free database connection in pool after {self._timeout} seconds")
+
+    def _release(self, connection: sqlite3.Connection):
+        if self._closed:
+            connection.close()
+        else:
+            self._idle_connections.put_nowait(connection)
+
+    @contextmanager
+    def connection(self):
+        with metrics_registry.timer(self._metrics_stage):
+            connection = self._acquire()
+            try:
+                yield connection
+                connection.commit()
+            except BaseException:
+                connection.rollback()
+                raise
+            finally:
+                self._release(connection)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            connections, self._all_connections = self._all_connections, []
+        for connection in connections:
+            connection.close()
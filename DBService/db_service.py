@@ -1,92 +1,214 @@
 import sqlite3
+import time
 from cryptography.fernet import Fernet
 
+from DBService.connection_pool import SQLiteConnectionPool
+from DBService.migrations import migrate
+from ttl_cache import LRUTTLCache
+
+USER_DATA_FIELDS = ('api_key', 'chat_state', 'img_description', 'img_count', 'last_keyboard', 'unsubscribed_at', 'last_active_at')
+# values of chat_state and img_count written by the retention job, ChatState.MAIN and the column default
+IDLE_CHAT_STATE = 1
+IDLE_IMG_COUNT = 1
+
 class UserDataDatabaseService:
-    def __init__(self, encryption_key: str, db_name: str = "user_data.db"):
+    def __init__(self, encryption_key: str, db_name: str = "user_data.db", pool_size: int = 4,
+                 synchronous: str = "NORMAL", cache_size: int = -8000, mmap_size: int = 0,
+                 api_key_cache_size: int = 1024, api_key_cache_ttl: float = 600.0):
         self._db_name = db_name
+        self._pool = SQLiteConnectionPool(db_name, pool_size, synchronous, cache_size, mmap_size, metrics_stage="user_data_db")
         self._init_database()
         self._fernet = Fernet(encryption_key)
+        # decrypted keys are kept in process memory only, a zero size disables the cache
+        self._api_key_cache = LRUTTLCache(api_key_cache_size, api_key_cache_ttl) if api_key_cache_size > 0 else None
+
+    def close(self):
+        self._pool.close()
 
     def _init_database(self):
-        connection = sqlite3.connect(self._db_name)
-        cursor = connection.cursor()
-
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS user_data (
-                user_id TEXT NOT NULL,
-                api_key TEXT DEFAULT NULL,
-                chat_state INTEGER DEFAULT 1,
-                img_description TEXT DEFAULT 'Empty',
-                img_count INTEGER DEFAULT 1,
-                last_keyboard TEXT DEFAULT NULL
+        with self._pool.connection() as connection:
+            is_empty = connection.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0] == 0
+            if is_empty and connection.execute("PRAGMA auto_vacuum").fetchone()[0] == 0:
+                # auto_vacuum of a file in WAL mode only changes with a rebuild, which is free while it is empty
+                connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                connection.execute("VACUUM")
+            migrate(connection)
+
+    def _add_user_if_not_exists(self, connection: sqlite3.Connection, user_id: str):
+        connection.execute("INSERT OR IGNORE INTO user_data (user_id) VALUES (?)", (user_id,))
+
+    def load_user_data(self, user_id: str) -> dict:
+        select_query = f"SELECT {', '.join(USER_DATA_FIELDS)} FROM user_data WHERE user_id = ?"
+        with self._pool.connection() as connection:
+            row = connection.execute(select_query, (user_id,)).fetchone()
+            if row is None:
+                self._add_user_if_not_exists(connection, user_id)
+                row = connection.execute(select_query, (user_id,)).fetchone()
+
+        return dict(zip(USER_DATA_FIELDS, row))
+
+    def update_user_data(self, user_id: str, fields: dict):
+        if not fields:
+            return
+
+        unknown_fields = set(fields) - set(USER_DATA_FIELDS)
+        if unknown_fields:
+            raise ValueError(f"Unknown user data fields: {unknown_fields}")
+
+        if 'api_key' in fields:
+            self._invalidate_cached_api_key(user_id)
+
+        # sorted field order keeps the statement text stable so sqlite can reuse the prepared statement
+        field_names = sorted(fields)
+        assignments = ", ".join(f"{field} = ?" for field in field_names)
+        values = [fields[field] for field in field_names]
+        with self._pool.connection() as connection:
+            connection.execute(f"UPDATE user_data SET {assignments} WHERE user_id = ?", (*values, user_id))
+
+    def mark_unsubscribed(self, user_ids: list[str]):
+        unsubscribed_at = time.time()
+        with self._pool.connection() as connection:
+            connection.executemany(
+                "UPDATE user_data SET unsubscribed_at = ? WHERE user_id = ? AND unsubscribed_at IS NULL",
+                [(unsubscribed_at, user_id) for user_id in user_ids]
             )
-            """
-        )
-
-        connection.commit()
-        connection.close()
-
-    def _add_user_if_not_exists(self, user_id: str):
-        connection = sqlite3.connect(self._db_name)
-        cursor = connection.cursor()
-        cursor.execute(f"INSERT OR IGNORE INTO user_data (user_id) VALUES (?)", (user_id,))
-        connection.commit()
-        connection.close()
-
-    def get_api_key(self, user_id: str) -> str:
-        self._add_user_if_not_exists(user_id)
-        encrypted_api_key = self._get_table_field(user_id, 'api_key')
-        if encrypted_api_key:
-            decrypted_api_key = self._fernet.decrypt(encrypted_api_key.encode()).decode()
-            return decrypted_api_key
-        else:
+
+    def count_subscribed_users(self) -> int:
+        with self._pool.connection() as connection:
+            return connection.execute("SELECT COUNT(*) FROM user_data WHERE unsubscribed_at IS NULL").fetchone()[0]
+
+    def get_subscribed_user_ids(self, after_user_id: str | None, limit: int) -> list[str]:
+        # keyset pagination, every page is a short read on the primary key index instead of one long scan
+        with self._pool.connection() as connection:
+            rows = connection.execute(
+                "SELECT user_id FROM user_data WHERE user_id > ? AND unsubscribed_at IS NULL ORDER BY user_id LIMIT ?",
+                (after_user_id or "", limit)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def clear_idle_user_state(self, idle_before: float, after_rowid: int, limit: int) -> tuple[int, int]:
+        # rows are changed in small batches walking the table by rowid, so every batch is a short write transaction
+        # and rows checked by an earlier batch are not scanned again. Returns the changed row count and the last rowid.
+        with self._pool.connection() as connection:
+            rowids = [row[0] for row in connection.execute(
+                """
+                UPDATE user_data SET img_description = NULL, last_keyboard = NULL, chat_state = ?, img_count = ?
+                WHERE rowid IN (
+                    SELECT rowid FROM user_data
+                    WHERE rowid > ? AND last_active_at < ?
+                      AND (img_description IS NOT NULL OR last_keyboard IS NOT NULL OR chat_state != ? OR img_count != ?)
+                    ORDER BY rowid
+                    LIMIT ?
+                )
+                RETURNING rowid
+                """,
+                (IDLE_CHAT_STATE, IDLE_IMG_COUNT, after_rowid, idle_before, IDLE_CHAT_STATE, IDLE_IMG_COUNT, limit)
+            ).fetchall()]
+        return len(rowids), max(rowids, default=after_rowid)
+
+    def clear_idle_api_keys(self, idle_before: float, after_rowid: int, limit: int) -> tuple[int, int]:
+        with self._pool.connection() as connection:
+            rowids = [row[0] for row in connection.execute(
+                """
+                UPDATE user_data SET api_key = NULL
+                WHERE rowid IN (
+                    SELECT rowid FROM user_data
+                    WHERE rowid > ? AND last_active_at < ? AND api_key IS NOT NULL
+                    ORDER BY rowid
+                    LIMIT ?
+                )
+                RETURNING rowid
+                """,
+                (after_rowid, idle_before, limit)
+            ).fetchall()]
+        return len(rowids), max(rowids, default=after_rowid)
+
+    def delete_unsubscribed_users(self, unsubscribed_before: float, limit: int) -> int:
+        with self._pool.connection() as connection:
+            user_ids = [row[0] for row in connection.execute(
+                """
+                DELETE FROM user_data
+                WHERE rowid IN (SELECT rowid FROM user_data WHERE unsubscribed_at < ? LIMIT ?)
+                RETURNING user_id
+                """,
+                (unsubscribed_before, limit)
+            ).fetchall()]
+            if user_ids:
+                placeholders = ", ".join("?" * len(user_ids))
+                connection.execute(f"DELETE FROM chat_sessions WHERE user_id IN ({placeholders})", user_ids)
+        return len(user_ids)
+
+    def delete_stale_chat_sessions(self, updated_before: float, limit: int) -> int:
+        with self._pool.connection() as connection:
+            cursor = connection.execute(
+                "DELETE FROM chat_sessions WHERE rowid IN (SELECT rowid FROM chat_sessions WHERE updated_at < ? LIMIT ?)",
+                (updated_before, limit)
+            )
+            return cursor.rowcount
+
+    def get_page_stats(self) -> dict:
+        with self._pool.connection() as connection:
+            return {
+                "auto_vacuum": connection.execute("PRAGMA auto_vacuum").fetchone()[0],
+                "page_size": connection.execute("PRAGMA page_size").fetchone()[0],
+                "page_count": connection.execute("PRAGMA page_count").fetchone()[0],
+                "freelist_count": connection.execute("PRAGMA freelist_count").fetchone()[0]
+            }
+
+    def incremental_vacuum(self, pages: int):
+        with self._pool.connection() as connection:
+            # the pragma frees one page per step and execute() only runs the first step of statements without result columns
+            connection.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+
+    def checkpoint(self):
+        with self._pool.connection() as connection:
+            # a passive checkpoint never waits for readers or writers
+            connection.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+
+    def encrypt_api_key(self, api_key: str) -> str:
+        return self._fernet.encrypt(api_key.encode()).decode()
+
+    def decrypt_api_key(self, user_id: str, encrypted_api_key: str | None) -> str | None:
+        if not encrypted_api_key:
             return None
 
-    def store_api_key(self, user_id: str, api_key: str):
-        encrypted_api_key = self._fernet.encrypt(api_key.encode()).decode()
-        self._set_table_field(user_id, 'api_key', encrypted_api_key)
-
-    def get_chat_state(self, user_id: str) -> int | None:
-        return self._get_table_field(user_id, 'chat_state')
-    
-    def set_chat_state(self, user_id: str, chat_state: int):
-        self._set_table_field(user_id, 'chat_state', chat_state)
-
-    def get_img_description(self, user_id: str) -> str | None:
-        return self._get_table_field(user_id, 'img_description')
-
-    def set_img_description(self, user_id: str, img_description: str):
-        self._set_table_field(user_id, 'img_description', img_description)
-
-    def get_img_count(self, user_id: str) -> int | None:
-        return self._get_table_field(user_id, 'img_count')
-    
-    def set_img_count(self, user_id: str, img_count: int):
-        self._set_table_field(user_id, 'img_count', img_count)
-
-    def get_last_keyboard(self, user_id: str) -> str | None:
-        return self._get_table_field(user_id, 'last_keyboard')
-
-    def set_last_keyboard(self, user_id: str, last_keyboard_json: str):
-        self._set_table_field(user_id, 'last_keyboard', last_keyboard_json)
-
-    def _get_table_field(self, user_id: str, field: str):
-        self._add_user_if_not_exists(user_id)
-    
-        connection = sqlite3.connect(self._db_name)
-        cursor = connection.cursor()
-        cursor.execute(f"SELECT {field} FROM user_data WHERE user_id = ?", (user_id,))
-        field_data = cursor.fetchone()
-        connection.close()
-
-        return field_data[0]
-
-    def _set_table_field(self, user_id: str, field: str, value):
-        self._add_user_if_not_exists(user_id)
-
-        connection = sqlite3.connect(self._db_name)
-        cursor = connection.cursor()
-        cursor.execute(f"UPDATE user_data SET {field} = ? WHERE user_id = ?", (value, user_id))
-        connection.commit()
-        connection.close()
+        if self._api_key_cache is not None:
+            cached_entry = self._api_key_cache.get(user_id)
+            # the cached value is only trusted while it matches the stored token, so writes from other processes are honoured
+            if cached_entry and cached_entry[0] == encrypted_api_key:
+                return cached_entry[1]
+
+        decrypted_api_key = self._fernet.decrypt(encrypted_api_key.encode()).decode()
+        if self._api_key_cache is not None:
+            self._api_key_cache.set(user_id, (encrypted_api_key, decrypted_api_key))
+        return decrypted_api_key
+
+    def _invalidate_cached_api_key(self, user_id: str):
+        if self._api_key_cache is not None:
+            self._api_key_cache.pop(user_id)
+
+    def api_key_cache_stats(self) -> dict | None:
+        return self._api_key_cache.stats() if self._api_key_cache is not None else None
+
+    def load_chat_session(self, user_id: str) -> tuple[str, float] | None:
+        with self._pool.connection() as connection:
+            row = connection.execute("SELECT chat_data, updated_at FROM chat_sessions WHERE user_id = ?", (user_id,)).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def get_chat_session_updated_at(self, user_id: str) -> float | None:
+        with self._pool.connection() as connection:
+            row = connection.execute("SELECT updated_at FROM chat_sessions WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def save_chat_session(self, user_id: str, chat_data: str) -> float:
+        updated_at = time.time()
+        with self._pool.connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO chat_sessions (user_id, chat_data, updated_at) VALUES (?, ?, ?)",
+                (user_id, chat_data, updated_at)
+            )
+        return updated_at
+
+    def delete_chat_session(self, user_id: str):
+        with self._pool.connection() as connection:
+            connection.execute("DELETE FROM chat_sessions WHERE user_id = ?", (user_id,))
@@ -0,0 +1,177 @@
+import os
+import socket
+import sqlite3
+import time
+from enum import Enum
+
+from DBService.connection_pool import SQLiteConnectionPool
+from DBService.migrations import migrate
+
+class JobStatus(Enum):
+    PENDING = 'pending'
+    LEASED = 'leased'
+    DONE = 'done'
+    FAILED = 'failed'
+
+class Job:
+    def __init__(self, job_id: int, user_id: str | None, payload: bytes, attempts: int):
+        self.id = job_id
+        self.user_id = user_id
+        self.payload = payload
+        self.attempts = attempts
+
+def _create_jobs_table(connection: sqlite3.Connection):
+    connection.execute(
+        """
+        CREATE TABLE jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT DEFAULT NULL,
+            payload BLOB NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            lease_owner TEXT DEFAULT NULL,
+            lease_expires_at REAL DEFAULT NULL,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """
+    )
+    connection.execute("CREATE INDEX jobs_status_id ON jobs (status, id)")
+
+JOB_QUEUE_MIGRATIONS = [
+    _create_jobs_table,
+]
+
+class JobQueueDatabaseService:
+    def __init__(self, db_name: str = "jobs.db", pool_size: int = 2, lease_seconds: float = 60.0, max_attempts: int = 3):
+        self._db_name = db_name
+        self._pool = SQLiteConnectionPool(db_name, pool_size, metrics_stage="job_queue_db")
+        self._lease_seconds = lease_seconds
+        self._max_attempts = max_attempts
+        self._lease_owner = f"{socket.gethostname()}:{os.getpid()}"
+        with self._pool.connection() as connection:
+            migrate(connection, JOB_QUEUE_MIGRATIONS)
+
+    def close(self):
+        self._pool.close()
+
+    @property
+    def lease_owner(self) -> str:
+        return self._lease_owner
+
+    def enqueue(self, user_id: str | None, payload: bytes) -> int:
+        now = time.time()
+        with self._pool.connection() as connection:
+            cursor = connection.execute(
+                "INSERT INTO jobs (user_id, payload, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                (user_id, payload, now, now)
+            )
+            return cursor.lastrowid
+
+    def claim(self, limit: int) -> list[Job]:
+        if limit <= 0:
+            return []
+
+        now = time.time()
+        with self._pool.connection() as connection:
+            # users with a live lease of another process are skipped, their jobs must not run in two processes at once.
+            # jobs of users leased by this process are claimed, the dispatcher chains them after the running ones
+            rows = connection.execute(
+                """
+                UPDATE jobs
+                SET status = 'leased', lease_owner = ?, lease_expires_at = ?, attempts = attempts + 1, updated_at = ?
+                WHERE id IN (
+                    SELECT id FROM (
+                        SELECT id, user_id FROM jobs WHERE status = 'pending'
+                        UNION ALL
+                        SELECT id, user_id FROM jobs WHERE status = 'leased' AND lease_expires_at < ? AND attempts < ?
+                    )
+                    WHERE user_id IS NULL OR user_id NOT IN (
+                        SELECT user_id FROM jobs
+                        WHERE status = 'leased' AND lease_expires_at >= ? AND lease_owner != ? AND user_id IS NOT NULL
+                    )
+                    ORDER BY id
+                    LIMIT ?
+                )
+                RETURNING id, user_id, payload, attempts
+                """,
+                (self._lease_owner, now + self._lease_seconds, now, now, self._max_attempts, now, self._lease_owner, limit)
+            ).fetchall()
+
+        # RETURNING does not guarantee any order, jobs have to be dispatched in the order they were accepted
+        return sorted((Job(*row) for row in rows), key=lambda job: job.id)
+
+    def renew_leases(self, job_ids: list[int]):
+        if not job_ids:
+            return
+
+        now = time.time()
+        placeholders = ", ".join("?" * len(job_ids))
+        with self._pool.connection() as connection:
+            connection.execute(
+                f"UPDATE jobs SET lease_expires_at = ?, updated_at = ? WHERE lease_owner = ? AND status = 'leased' AND id IN ({placeholders})",
+                (now + self._lease_seconds, now, self._lease_owner, *job_ids)
+            )
+
+    def complete(self, job_id: int, status: JobStatus = JobStatus.DONE):
+        with self._pool.connection() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = ?, lease_owner = NULL, lease_expires_at = NULL, updated_at = ? WHERE id = ?",
+                (status.value, time.time(), job_id)
+            )
+
+    def requeue_unfinished(self) -> int:
+        # leases of processes that are gone are released right away instead of waiting for them to expire
+        hostname = socket.gethostname()
+        with self._pool.connection() as connection:
+            lease_owners = [row[0] for row in connection.execute("SELECT DISTINCT lease_owner FROM jobs WHERE status = 'leased'")]
+            dead_lease_owners = [owner for owner in lease_owners if owner and self._is_dead_local_owner(owner, hostname)]
+            if not dead_lease_owners:
+                return 0
+
+            placeholders = ", ".join("?" * len(dead_lease_owners))
+            cursor = connection.execute(
+                f"""
+                UPDATE jobs
+                SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END,
+                    lease_owner = NULL, lease_expires_at = NULL, updated_at = ?
+                WHERE status = 'leased' AND lease_owner IN ({placeholders})
+                """,
+                (self._max_attempts, time.time(), *dead_lease_owners)
+            )
+            return cursor.rowcount
+
+    def _is_dead_local_owner(self, lease_owner: str, hostname: str) -> bool:
+        owner_hostname, _, owner_pid = lease_owner.rpartition(":")
+        if owner_hostname != hostname or not owner_pid.isdigit():
+            return False
+        if lease_owner == self._lease_owner:
+            # the current process has not claimed anything yet, so these leases belong to a previous run with the same pid
+            return True
+        try:
+            os.kill(int(owner_pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            return False
+        return False
+
+    def compact(self, older_than_seconds: float) -> int:
+        now = time.time()
+        with self._pool.connection() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = 'failed', lease_owner = NULL, updated_at = ? WHERE status = 'leased' AND lease_expires_at < ? AND attempts >= ?",
+                (now, now, self._max_attempts)
+            )
+            cursor = connection.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                (now - older_than_seconds,)
+            )
+            return cursor.rowcount
+
+    def count_by_status(self) -> dict:
+        with self._pool.connection() as connection:
+            rows = connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        counts = {status.value: 0 for status in JobStatus}
+        counts.update(rows)
+        return counts
@@ -0,0 +1,52 @@
+import sqlite3
+import time
+
+from DBService.connection_pool import SQLiteConnectionPool
+from DBService.migrations import migrate
+
+def _create_processed_messages_table(connection: sqlite3.Connection):
+    connection.execute(
+        """
+        CREATE TABLE processed_messages (
+            message_key TEXT PRIMARY KEY NOT NULL,
+            seen_at REAL NOT NULL
+        )
+        """
+    )
+    connection.execute("CREATE INDEX processed_messages_seen_at ON processed_messages (seen_at)")
+
+MESSAGE_DEDUP_MIGRATIONS = [
+    _create_processed_messages_table,
+]
+
+class MessageDedupDatabaseService:
+    def __init__(self, db_name: str = "message_dedup.db", pool_size: int = 2):
+        self._pool = SQLiteConnectionPool(db_name, pool_size, metrics_stage="message_dedup_db")
+        with self._pool.connection() as connection:
+            migrate(connection, MESSAGE_DEDUP_MIGRATIONS)
+
+    def close(self):
+        self._pool.close()
+
+    def mark_seen(self, message_key: str, window_seconds: float) -> bool:
+        now = time.time()
+        with self._pool.connection() as connection:
+            # a single upsert keeps check-and-mark atomic across worker processes,
+            # keys older than the window are treated as new deliveries
+            cursor = connection.execute(
+                """
+                INSERT INTO processed_messages (message_key, seen_at) VALUES (?, ?)
+                ON CONFLICT (message_key) DO UPDATE SET seen_at = excluded.seen_at WHERE seen_at < ?
+                """,
+                (message_key, now, now - window_seconds)
+            )
+            return cursor.rowcount > 0
+
+    def forget(self, message_key: str):
+        with self._pool.connection() as connection:
+            connection.execute("DELETE FROM processed_messages WHERE message_key = ?", (message_key,))
+
+    def prune(self, window_seconds: float) -> int:
+        with self._pool.connection() as connection:
+            cursor = connection.execute("DELETE FROM processed_messages WHERE seen_at < ?", (time.time() - window_seconds,))
+            return cursor.rowcount
@@ -0,0 +1,151 @@
+import argparse
+import os
+import sqlite3
+import time
+
+def _table_exists(connection: sqlite3.Connection, table_name: str) -> bool:
+    row = connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,)).fetchone()
+    return row is not None
+
+def _add_user_id_primary_key(connection: sqlite3.Connection):
+    connection.execute(
+        """
+        CREATE TABLE user_data_new (
+            user_id TEXT PRIMARY KEY NOT NULL,
+            api_key TEXT DEFAULT NULL,
+            chat_state INTEGER DEFAULT 1,
+            img_description TEXT DEFAULT 'Empty',
+            img_count INTEGER DEFAULT 1,
+            last_keyboard TEXT DEFAULT NULL
+        )
+        """
+    )
+
+    if _table_exists(connection, 'user_data'):
+        # Every UPDATE of the legacy table touched all duplicates of a user while rows inserted afterwards
+        # only hold default values, so the first row of each user carries the most recently written values.
+        connection.execute(
+            """
+            INSERT INTO user_data_new (user_id, api_key, chat_state, img_description, img_count, last_keyboard)
+            SELECT user_id, api_key, chat_state, img_description, img_count, last_keyboard
+            FROM user_data
+            WHERE rowid IN (SELECT MIN(rowid) FROM user_data GROUP BY user_id)
+            """
+        )
+        connection.execute("DROP TABLE user_data")
+
+    connection.execute("ALTER TABLE user_data_new RENAME TO user_data")
+
+def _replace_legacy_keyboard_json_with_ids(connection: sqlite3.Connection):
+    from keyboards import resolve_keyboard_id
+
+    legacy_keyboards = connection.execute(
+        "SELECT DISTINCT last_keyboard FROM user_data WHERE last_keyboard LIKE '{%'"
+    ).fetchall()
+    for (legacy_keyboard,) in legacy_keyboards:
+        # keyboards which are not registered anymore are dropped, Help then falls back to the main keyboard
+        connection.execute(
+            "UPDATE user_data SET last_keyboard = ? WHERE last_keyboard = ?",
+            (resolve_keyboard_id(legacy_keyboard), legacy_keyboard)
+        )
+
+def _create_chat_sessions_table(connection: sqlite3.Connection):
+    connection.execute(
+        """
+        CREATE TABLE chat_sessions (
+            user_id TEXT PRIMARY KEY NOT NULL,
+            chat_data TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """
+    )
+    connection.execute("CREATE INDEX chat_sessions_updated_at ON chat_sessions (updated_at)")
+
+def _add_unsubscribed_at_column(connection: sqlite3.Connection):
+    # NULL means subscribed, broadcasts page through these users only
+    connection.execute("ALTER TABLE user_data ADD COLUMN unsubscribed_at REAL DEFAULT NULL")
+    connection.execute("CREATE INDEX user_data_unsubscribed_at ON user_data (unsubscribed_at) WHERE unsubscribed_at IS NOT NULL")
+
+def _add_last_active_at_column(connection: sqlite3.Connection):
+    connection.execute("ALTER TABLE user_data ADD COLUMN last_active_at REAL DEFAULT NULL")
+    # existing users get the whole idle period from now on
+    connection.execute("UPDATE user_data SET last_active_at = ?", (time.time(),))
+
+# Migration N brings the database to schema version N (stored in PRAGMA user_version).
+# Only append new migrations to the end of the list.
+MIGRATIONS = [
+    _add_user_id_primary_key,
+    _replace_legacy_keyboard_json_with_ids,
+    _create_chat_sessions_table,
+    _add_unsubscribed_at_column,
+    _add_last_active_at_column,
+]
+
+def get_schema_version(connection: sqlite3.Connection) -> int:
+    return connection.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(connection: sqlite3.Connection, migrations: list = MIGRATIONS) -> tuple[int, int]:
+    latest_version = len(migrations)
+    if connection.in_transaction:
+        connection.commit()
+
+    initial_version = get_schema_version(connection)
+    if initial_version > latest_version:
+        raise RuntimeError(f"Database schema version {initial_version} is newer than supported {latest_version}")
+
+    while True:
+        # the write lock is taken before re-reading the version so concurrent workers never apply a migration twice
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            version = get_schema_version(connection)
+            if version >= latest_version:
+                connection.rollback()
+                return initial_version, version
+
+            migrations[version](connection)
+            connection.execute(f"PRAGMA user_version = {version + 1}")
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+
+def _count_rows(connection: sqlite3.Connection) -> int:
+    if not _table_exists(connection, 'user_data'):
+        return 0
+    return connection.execute("SELECT COUNT(*) FROM user_data").fetchone()[0]
+
+def _database_size(db_name: str) -> int:
+    return sum(os.path.getsize(path) for path in (db_name, f"{db_name}-wal") if os.path.exists(path))
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply pending user data database migrations.")
+    parser.add_argument("db_name", nargs="?", default="user_data.db", help="path to the sqlite database")
+    parser.add_argument("--vacuum", action="store_true", help="rebuild the database file after migrating to reclaim free pages")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db_name):
+        parser.error(f"Database {args.db_name} does not exist")
+
+    connection = sqlite3.connect(args.db_name)
+    try:
+        rows_before = _count_rows(connection)
+        size_before = _database_size(args.db_name)
+
+        version_before, version_after = migrate(connection)
+        if args.vacuum:
+            # the rebuild also switches older databases to incremental vacuum used by the retention job
+            connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            connection.execute("VACUUM")
+        connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+        rows_after = _count_rows(connection)
+        size_after = _database_size(args.db_name)
+    finally:
+        connection.close()
+
+    print(f"Schema version: {version_before} -> {version_after}")
+    print(f"user_data rows: {rows_before} -> {rows_after}")
+    print(f"Database size: {size_before} -> {size_after} bytes")
+
+if __name__ == "__main__":
+    main()
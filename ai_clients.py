@@ -0,0 +1,119 @@
+import importlib
+import sys
+import threading
+import time
+from typing import AsyncIterator, BinaryIO, Iterator
+
+ONE_SHOT_MODEL = "text-davinci-003"
+ONE_SHOT_MAX_TOKENS = 1024
+WHISPER_MODEL = "whisper-1"
+
+_import_lock = threading.Lock()
+_import_seconds = {}
+
+def lazy_import(module_name: str):
+    # client modules are imported on first use, openai alone takes a large part of the start up time
+    module = sys.modules.get(module_name)
+    if module is not None:
+        return module
+
+    started_at = time.perf_counter()
+    module = importlib.import_module(module_name)
+    with _import_lock:
+        _import_seconds.setdefault(module_name, time.perf_counter() - started_at)
+    return module
+
+def lazy_import_stats() -> dict:
+    with _import_lock:
+        return dict(_import_seconds)
+
+class AIClients:
+    def ask_question(self, api_key: str, question: str) -> str:
+        chat_gpt_client = lazy_import("OpenAIClients.ChatGPT.chat_gpt_client")
+        return chat_gpt_client.TextDavinciClient.ask_question(api_key, question)
+
+    def stream_question(self, api_key: str, question: str) -> Iterator[str]:
+        openai = lazy_import("openai")
+        response = openai.Completion.create(
+            model=ONE_SHOT_MODEL,
+            prompt=question,
+            max_tokens=ONE_SHOT_MAX_TOKENS,
+            api_key=api_key,
+            stream=True
+        )
+        for chunk in response:
+            delta = chunk["choices"][0]["text"]
+            if delta:
+                yield delta
+
+    def generate_image(self, api_key: str, description: str, size: str) -> list[str]:
+        dalle_client = lazy_import("OpenAIClients.DALLE.dalle_client")
+        image_request_data = dalle_client.ImageRequestData(description, 1, dalle_client.ImageSize[size.upper()])
+        return dalle_client.DALLEClient.generate_images(api_key, image_request_data)
+
+    def transcribe(self, api_key: str, media_file: BinaryIO) -> str:
+        # media_file has to have a name with an extension, the API detects the media format by it
+        openai = lazy_import("openai")
+        return openai.Audio.transcribe(WHISPER_MODEL, media_file, api_key=api_key)["text"]
+
+class AsyncAIClients:
+    # Uses the asyncio API of openai, all calls of a worker share one aiohttp session.
+    def __init__(self, pool_size: int = 100):
+        self._pool_size = pool_size
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None:
+            aiohttp = lazy_import("aiohttp")
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self._pool_size))
+        return self._session
+
+    async def _request(self, create, **kwargs):
+        openai = lazy_import("openai")
+        # openai takes the session from a context variable, setting it here only affects the current task
+        session_token = openai.aiosession.set(self._get_session())
+        try:
+            return await create(**kwargs)
+        finally:
+            openai.aiosession.reset(session_token)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def ask_question(self, api_key: str, question: str) -> str:
+        response = await self._request(
+            lazy_import("openai").Completion.acreate,
+            model=ONE_SHOT_MODEL, prompt=question, max_tokens=ONE_SHOT_MAX_TOKENS, api_key=api_key
+        )
+        return response["choices"][0]["text"]
+
+    async def stream_question(self, api_key: str, question: str) -> AsyncIterator[str]:
+        response = await self._request(
+            lazy_import("openai").Completion.acreate,
+            model=ONE_SHOT_MODEL, prompt=question, max_tokens=ONE_SHOT_MAX_TOKENS, api_key=api_key, stream=True
+        )
+        async for chunk in response:
+            delta = chunk["choices"][0]["text"]
+            if delta:
+                yield delta
+
+    async def chat_completion(self, api_key: str, model: str, messages: list[dict], stream: bool = False):
+        return await self._request(
+            lazy_import("openai").ChatCompletion.acreate, model=model, messages=messages, api_key=api_key, stream=stream
+        )
+
+    async def generate_image(self, api_key: str, description: str, size: str) -> list[str]:
+        dalle_client = lazy_import("OpenAIClients.DALLE.dalle_client")
+        response = await self._request(
+            lazy_import("openai").Image.acreate,
+            prompt=description, n=1, size=dalle_client.ImageSize[size.upper()].value, api_key=api_key
+        )
+        return [image["url"] for image in response["data"]]
+
+    async def transcribe(self, api_key: str, media_file: BinaryIO) -> str:
+        response = await self._request(
+            lazy_import("openai").Audio.atranscribe, model=WHISPER_MODEL, file=media_file, api_key=api_key
+        )
+        return response["text"]
@@ -0,0 +1,167 @@
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+from rate_limiter import TokenBucket
+from ttl_cache import LRUTTLCache
+
+logger = logging.getLogger(__name__)
+
+# how often a coroutine checks the in flight limit of a key, the semaphore is shared with threads and cannot be awaited
+IN_FLIGHT_POLL_INTERVAL = 0.05
+
+class RateLimitExceededError(Exception):
+    pass
+
+def _get_retry_after(error: Exception) -> float | None:
+    headers = getattr(error, "headers", None) or {}
+    retry_after = headers.get("Retry-After") or headers.get("retry-after")
+    try:
+        return float(retry_after) if retry_after else None
+    except ValueError:
+        return None
+
+def _is_rate_limit_error(error: Exception) -> bool:
+    return getattr(error, "http_status", None) == 429 or type(error).__name__ == "RateLimitError"
+
+class _KeyLimits:
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float, max_in_flight: int):
+        self.requests = TokenBucket(requests_per_minute / 60.0, capacity=max(1.0, requests_per_minute / 6.0))
+        self.tokens = TokenBucket(tokens_per_minute / 60.0, capacity=tokens_per_minute)
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.lock = threading.Lock()
+        self.backoff_until = 0.0
+        self.backoff_level = 0
+
+class ApiKeyLimiter:
+    def __init__(self, requests_per_minute: float = 60.0, tokens_per_minute: float = 90000.0, max_in_flight: int = 2,
+                 queue_timeout: float = 30.0, backoff_seconds: float = 2.0, max_backoff_seconds: float = 60.0,
+                 max_keys: int = 10000, idle_ttl: float = 3600.0):
+        self._requests_per_minute = requests_per_minute
+        self._tokens_per_minute = tokens_per_minute
+        self._max_in_flight = max_in_flight
+        self._queue_timeout = queue_timeout
+        self._backoff_seconds = backoff_seconds
+        self._max_backoff_seconds = max_backoff_seconds
+        # limits are kept per hash of the api key, keys which are not used for a while are forgotten
+        self._limits = LRUTTLCache(max_keys, idle_ttl)
+        self._stats_lock = threading.Lock()
+        self._admitted = 0
+        self._rejected = 0
+        self._rate_limited = 0
+        self._wait_time_total = 0.0
+
+    def _get_limits(self, api_key: str) -> _KeyLimits:
+        key_hash = hashlib.sha256(api_key.encode()).hexdigest()
+        limits = self._limits.get(key_hash)
+        if limits is None:
+            new_limits = _KeyLimits(self._requests_per_minute, self._tokens_per_minute, self._max_in_flight)
+            limits = new_limits if self._limits.set_if_absent(key_hash, new_limits) else self._limits.get(key_hash, new_limits)
+        return limits
+
+    def _reject(self, reason: str):
+        with self._stats_lock:
+            self._rejected += 1
+        raise RateLimitExceededError(reason)
+
+    def _check_backoff(self, api_key: str) -> tuple[_KeyLimits, float, float, float]:
+        limits = self._get_limits(api_key)
+        started_at = time.monotonic()
+        deadline = started_at + self._queue_timeout
+
+        with limits.lock:
+            backoff_until = limits.backoff_until
+        if backoff_until > deadline:
+            self._reject("API key is backing off after rate limit errors")
+        return limits, started_at, deadline, max(0.0, backoff_until - started_at)
+
+    def _record_admitted(self, started_at: float):
+        with self._stats_lock:
+            self._admitted += 1
+            self._wait_time_total += time.monotonic() - started_at
+
+    def _record_result(self, limits: _KeyLimits, error: Exception | None):
+        if error is None:
+            with limits.lock:
+                limits.backoff_level = 0
+        elif _is_rate_limit_error(error):
+            self._back_off(limits, _get_retry_after(error))
+
+    @contextmanager
+    def limit(self, api_key: str, tokens: int = 0):
+        # Waits until the call fits the limits of the key or raises RateLimitExceededError after the queue timeout.
+        # Rate limit errors from the API inside the block make later calls of the same key back off.
+        limits, started_at, deadline, backoff_wait = self._check_backoff(api_key)
+        if backoff_wait:
+            time.sleep(backoff_wait)
+
+        if not limits.in_flight.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            self._reject("Too many requests in flight for the API key")
+        try:
+            if not limits.requests.acquire(timeout=max(0.0, deadline - time.monotonic())):
+                self._reject("Requests per minute limit of the API key exceeded")
+            if tokens and not limits.tokens.acquire(min(tokens, self._tokens_per_minute), timeout=max(0.0, deadline - time.monotonic())):
+                self._reject("Tokens per minute limit of the API key exceeded")
+            self._record_admitted(started_at)
+
+            try:
+                yield
+            except Exception as e:
+                self._record_result(limits, e)
+                raise
+            else:
+                self._record_result(limits, None)
+        finally:
+            limits.in_flight.release()
+
+    @asynccontextmanager
+    async def limit_async(self, api_key: str, tokens: int = 0):
+        # the same limits as limit(), waiting happens on the event loop instead of blocking a thread
+        limits, started_at, deadline, backoff_wait = self._check_backoff(api_key)
+        if backoff_wait:
+            await asyncio.sleep(backoff_wait)
+
+        while not limits.in_flight.acquire(blocking=False):
+            if time.monotonic() + IN_FLIGHT_POLL_INTERVAL > deadline:
+                self._reject("Too many requests in flight for the API key")
+            await asyncio.sleep(IN_FLIGHT_POLL_INTERVAL)
+        try:
+            if not await limits.requests.acquire_async(timeout=max(0.0, deadline - time.monotonic())):
+                self._reject("Requests per minute limit of the API key exceeded")
+            if tokens and not await limits.tokens.acquire_async(min(tokens, self._tokens_per_minute), timeout=max(0.0, deadline - time.monotonic())):
+                self._reject("Tokens per minute limit of the API key exceeded")
+            self._record_admitted(started_at)
+
+            try:
+                yield
+            except Exception as e:
+                self._record_result(limits, e)
+                raise
+            else:
+                self._record_result(limits, None)
+        finally:
+            limits.in_flight.release()
+
+    def _back_off(self, limits: _KeyLimits, retry_after: float | None):
+        with limits.lock:
+            delay = min(self._max_backoff_seconds, self._backoff_seconds * 2 ** limits.backoff_level)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            limits.backoff_level += 1
+            limits.backoff_until = max(limits.backoff_until, time.monotonic() + delay)
+        with self._stats_lock:
+            self._rate_limited += 1
+        logger.warning(f"OpenAI rate limit hit, requests with this API key are paused for {delay} seconds.")
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "keys": len(self._limits),
+                "admitted": self._admitted,
+                "rejected": self._rejected,
+                "rate_limited": self._rate_limited,
+                "wait_time_avg": self._wait_time_total / self._admitted if self._admitted else 0.0
+            }
@@ -0,0 +1,132 @@
+from typing import AsyncIterator, Iterator
+
+from ai_clients import AsyncAIClients, lazy_import
+from context_window import ContextWindow, count_tokens
+
+CHAT_MODEL = "gpt-3.5-turbo"
+SYSTEM_ROLE = "system"
+USER_ROLE = "user"
+ASSISTANT_ROLE = "assistant"
+
+class AssistantChat:
+    def __init__(self, assistant_role: str, messages: list[dict] | None = None, token_counts: list[int] | None = None):
+        self._assistant_role = assistant_role
+        self._messages = messages if messages is not None else [
+            {"role": SYSTEM_ROLE, "content": f"You are {assistant_role}."}
+        ]
+        # token counts are kept next to the messages so the history is never tokenized twice
+        self._token_counts = token_counts if token_counts is not None else [
+            count_tokens(message["content"]) for message in self._messages
+        ]
+
+    @property
+    def assistant_role(self) -> str:
+        return self._assistant_role
+
+    @property
+    def messages(self) -> list[dict]:
+        return self._messages
+
+    @property
+    def prompt_tokens(self) -> int:
+        return sum(self._token_counts)
+
+    def _append_message(self, role: str, content: str):
+        self._messages.append({"role": role, "content": content})
+        self._token_counts.append(count_tokens(content))
+
+    def _fit_context_window(self, context_window: ContextWindow):
+        # the role prompt is pinned, the oldest turns are dropped from the history for good
+        dropped_count = context_window.fit(self._token_counts, pinned_count=1)
+        if dropped_count:
+            del self._messages[1:1 + dropped_count]
+            del self._token_counts[1:1 + dropped_count]
+
+    def _begin_turn(self, message: str, context_window: ContextWindow | None) -> tuple[list[dict], list[int]]:
+        # the history before the turn is returned, a failed call restores it so no unanswered user message is kept
+        history = (list(self._messages), list(self._token_counts))
+        self._append_message(USER_ROLE, message)
+        if context_window is not None:
+            self._fit_context_window(context_window)
+        return history
+
+    def _restore_history(self, history: tuple[list[dict], list[int]]):
+        self._messages[:], self._token_counts[:] = history
+
+    def _finish_turn(self, response: dict, context_window: ContextWindow | None) -> str:
+        if context_window is not None and "usage" in response:
+            context_window.report_usage(response["usage"]["prompt_tokens"])
+
+        answer = response["choices"][0]["message"]["content"]
+        self._append_message(ASSISTANT_ROLE, answer)
+        return answer
+
+    def ask(self, api_key: str, message: str, context_window: ContextWindow | None = None) -> str:
+        history = self._begin_turn(message, context_window)
+        try:
+            response = lazy_import("openai").ChatCompletion.create(model=CHAT_MODEL, messages=self._messages, api_key=api_key)
+        except BaseException:
+            self._restore_history(history)
+            raise
+        return self._finish_turn(response, context_window)
+
+    def ask_stream(self, api_key: str, message: str, context_window: ContextWindow | None = None) -> Iterator[str]:
+        history = self._begin_turn(message, context_window)
+        answer_parts = []
+        # a stream which fails or is abandoned part way leaves no turn in the history
+        try:
+            response = lazy_import("openai").ChatCompletion.create(model=CHAT_MODEL, messages=self._messages, api_key=api_key, stream=True)
+            for chunk in response:
+                delta = chunk["choices"][0]["delta"].get("content")
+                if delta:
+                    answer_parts.append(delta)
+                    yield delta
+        except BaseException:
+            self._restore_history(history)
+            raise
+
+        self._append_message(ASSISTANT_ROLE, "".join(answer_parts))
+
+    async def ask_async(self, ai_clients: AsyncAIClients, api_key: str, message: str,
+                        context_window: ContextWindow | None = None) -> str:
+        history = self._begin_turn(message, context_window)
+        try:
+            response = await ai_clients.chat_completion(api_key, CHAT_MODEL, self._messages)
+        except BaseException:
+            self._restore_history(history)
+            raise
+        return self._finish_turn(response, context_window)
+
+    async def ask_stream_async(self, ai_clients: AsyncAIClients, api_key: str, message: str,
+                               context_window: ContextWindow | None = None) -> AsyncIterator[str]:
+        history = self._begin_turn(message, context_window)
+        answer_parts = []
+        try:
+            async for chunk in await ai_clients.chat_completion(api_key, CHAT_MODEL, self._messages, stream=True):
+                delta = chunk["choices"][0]["delta"].get("content")
+                if delta:
+                    answer_parts.append(delta)
+                    yield delta
+        except BaseException:
+            self._restore_history(history)
+            raise
+
+        self._append_message(ASSISTANT_ROLE, "".join(answer_parts))
+
+    def estimate_size(self) -> int:
+        return sum(len(message["content"]) for message in self._messages)
+
+    def to_dict(self) -> dict:
+        return {
+            "assistant_role": self._assistant_role,
+            "messages": [
+                [message["role"], message["content"], token_count]
+                for message, token_count in zip(self._messages, self._token_counts)
+            ]
+        }
+
+    @staticmethod
+    def from_dict(chat_data: dict) -> "AssistantChat":
+        messages = [{"role": message[0], "content": message[1]} for message in chat_data["messages"]]
+        token_counts = [message[2] if len(message) > 2 else count_tokens(message[1]) for message in chat_data["messages"]]
+        return AssistantChat(chat_data["assistant_role"], messages, token_counts)
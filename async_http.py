@@ -0,0 +1,118 @@
+import asyncio
+import logging
+
+import aiohttp
+from viberbot.api.bot_configuration import BotConfiguration
+from viberbot.api.consts import VIBER_BOT_API_URL, VIBER_BOT_USER_AGENT, BOT_API_ENDPOINT
+
+from metrics import metrics_registry
+from rate_limiter import TokenBucket
+from utils import FileTooLargeError, SpooledMediaFile
+from viber_sender import RETRYABLE_STATUS_CODES, OutboundMessageBuffer, build_message_bodies, get_message_token
+
+logger = logging.getLogger(__name__)
+
+class AsyncViberMessageSender:
+    # Asyncio counterpart of ViberMessageSender, the aiohttp session is created on first use inside the event loop.
+    def __init__(self, bot_configuration: BotConfiguration, api_url: str = VIBER_BOT_API_URL,
+                 rate_limiter: TokenBucket | None = None, max_retries: int = 3, backoff_seconds: float = 0.5,
+                 timeout: float = 10.0, pool_size: int = 100):
+        self._bot_configuration = bot_configuration
+        self._send_message_url = f"{api_url.rstrip('/')}/{BOT_API_ENDPOINT.SEND_MESSAGE}"
+        self._rate_limiter = rate_limiter
+        self._max_retries = max_retries
+        self._backoff_seconds = backoff_seconds
+        # separate connect and read timeouts like requests, only a connect timeout is safe to retry
+        self._timeout = aiohttp.ClientTimeout(sock_connect=timeout, sock_read=timeout)
+        self._pool_size = pool_size
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._pool_size),
+                headers={
+                    "User-Agent": VIBER_BOT_USER_AGENT,
+                    "X-Viber-Auth-Token": self._bot_configuration.auth_token
+                }
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def send_messages(self, to: str, messages: list, keyboard_json: str | None = None) -> list:
+        # messages of one reply are sent one after another so they arrive in order
+        return [
+            get_message_token(await self._post(body))
+            for body in build_message_bodies(self._bot_configuration, to, messages, keyboard_json)
+        ]
+
+    async def _post(self, payload: bytes) -> dict:
+        attempt = 0
+        while True:
+            if self._rate_limiter is not None:
+                await self._rate_limiter.acquire_async()
+
+            retry_after = None
+            try:
+                with metrics_registry.timer("viber_send"):
+                    async with self._get_session().post(self._send_message_url, data=payload, timeout=self._timeout) as response:
+                        if response.status not in RETRYABLE_STATUS_CODES:
+                            if not response.ok:
+                                logger.warning(f"Sending Viber message failed with status code {response.status}, it is not sent again.")
+                            response.raise_for_status()
+                            return await response.json(content_type=None)
+                        retry_after = response.headers.get("Retry-After")
+                        error = f"status code {response.status}"
+            except (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError) as e:
+                # the request was not sent when no connection could be established
+                error = str(e) or type(e).__name__
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                logger.warning(f"Sending Viber message failed ({str(e) or type(e).__name__}), it may have been delivered and is not sent again.")
+                raise
+
+            if attempt >= self._max_retries:
+                raise Exception(f"Failed to send Viber message after {attempt + 1} attempts: {error}")
+
+            delay = self._backoff_seconds * 2 ** attempt
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, float(retry_after))
+            logger.warning(f"Sending Viber message failed ({error}), retrying in {delay} seconds.")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+class AsyncOutboundMessageBuffer(OutboundMessageBuffer):
+    # handlers fill the buffer the same way in both serving modes, only sending is awaited
+    async def flush(self):
+        pending = self._take_pending()
+        if pending is not None:
+            await self._sender.send_messages(self._user_id, *pending)
+
+async def download_media_async(session: aiohttp.ClientSession, url: str, file_name: str, max_bytes: int,
+                               spool_threshold: int = 5 * 1024 * 1024, expected_size: int | None = None,
+                               timeout: aiohttp.ClientTimeout = aiohttp.ClientTimeout(sock_connect=5.0, sock_read=30.0)) -> SpooledMediaFile:
+    # the same limits as utils.download_media, big files are spilled to disk chunk by chunk
+    if expected_size is not None and expected_size > max_bytes:
+        raise FileTooLargeError(f"File size {expected_size} exceeds the limit of {max_bytes} bytes")
+
+    media_file = SpooledMediaFile(file_name, spool_threshold)
+    try:
+        async with session.get(url, timeout=timeout) as response:
+            if response.status != 200:
+                raise Exception(f"Failed to download file. Status code: {response.status}")
+
+            if response.content_length is not None and response.content_length > max_bytes:
+                raise FileTooLargeError(f"File size {response.content_length} exceeds the limit of {max_bytes} bytes")
+
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                if media_file.size + len(chunk) > max_bytes:
+                    raise FileTooLargeError(f"File exceeds the limit of {max_bytes} bytes")
+                media_file.write(chunk)
+        media_file.seek(0)
+        return media_file
+    except BaseException:
+        media_file.close()
+        raise
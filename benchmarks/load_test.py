@@ -0,0 +1,388 @@
+# Replays synthetic, signed Viber callbacks against the bot with the Viber API and OpenAI replaced by local stubs.
+# Every virtual user walks through all ChatState paths: conversation start, api key, one-shot question,
+# assistant chat, image generation, media transcription, help and cancel.
+#
+# Usage:
+#   python benchmarks/load_test.py --users 50 --concurrency 8
+#   python benchmarks/load_test.py --http --save-baseline benchmarks/baseline.json
+#   python benchmarks/load_test.py --compare benchmarks/baseline.json --tolerance 0.2
+import argparse
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO_ROOT)
+
+AUTH_TOKEN = "benchmark-auth-token"
+FILE_SIZE = 256 * 1024
+
+def percentile(values: list[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    sorted_values = sorted(values)
+    index = max(0, min(len(sorted_values) - 1, int(round(percent / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def sign(body: bytes) -> str:
+    return hmac.new(AUTH_TOKEN.encode(), body, hashlib.sha256).hexdigest()
+
+class StatementCounter:
+    # counts sqlite statements executed by the current thread, connections report them via set_trace_callback
+    def __init__(self):
+        self._local = threading.local()
+
+    def count_statement(self, statement: str):
+        self._local.count = getattr(self._local, "count", 0) + 1
+
+    def reset(self):
+        self._local.count = 0
+
+    def get(self) -> int:
+        return getattr(self._local, "count", 0)
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._paths = {}
+        self._sent_at = {}
+        self._done_events = {}
+        self.ingress_latencies = []
+        self.ingress_statements = []
+        self.failures = 0
+
+    def expect(self, token: int, path: str) -> threading.Event:
+        event = threading.Event()
+        with self._lock:
+            self._paths[token] = {"path": path}
+            self._done_events[token] = event
+            self._sent_at[token] = time.perf_counter()
+        return event
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+
+    def record_ingress(self, latency: float, statements: int | None):
+        with self._lock:
+            self.ingress_latencies.append(latency)
+            if statements is not None:
+                self.ingress_statements.append(statements)
+
+    def record_processing(self, token: int, latency: float, statements: int, failed: bool):
+        finished_at = time.perf_counter()
+        with self._lock:
+            entry = self._paths.get(token)
+            if entry is None:
+                return
+            entry.update({
+                "latency": latency,
+                "end_to_end": finished_at - self._sent_at[token],
+                "statements": statements
+            })
+            if failed:
+                self.failures += 1
+            self._done_events.pop(token).set()
+
+    def results_by_path(self) -> dict:
+        by_path = {}
+        with self._lock:
+            for entry in self._paths.values():
+                if "latency" in entry:
+                    by_path.setdefault(entry["path"], []).append(entry)
+        return by_path
+
+def user_script(user_id: str, keyboards) -> list[tuple[str, dict]]:
+    def text_message(text: str) -> dict:
+        return {"event": "message", "sender": {"id": user_id, "name": "Benchmark"}, "message": {"type": "text", "text": text}}
+
+    def button(button: dict) -> dict:
+        return text_message(keyboards.get_button_action(button))
+
+    return [
+        ("conversation_started", {"event": "conversation_started", "type": "open", "subscribed": False,
+                                  "user": {"id": user_id, "name": "Benchmark"}}),
+        ("set_api_key", button(keyboards.SET_API_KEY_BUTTON)),
+        ("api_key", text_message(f"sk-benchmark-{user_id}")),
+        ("question", text_message(f"What is the capital of country number {user_id}?")),
+        ("start_chat", button(keyboards.START_CHAT_BUTTON)),
+        ("select_role", text_message(keyboards.ROLE_BUTTON_ACTIONS[0])),
+        ("chat_message", text_message("Tell me something interesting.")),
+        ("chat_message", text_message("Tell me more about it, please.")),
+        ("end_chat", button(keyboards.END_CHAT_BUTTON)),
+        ("generate_image", button(keyboards.GENERATE_IMAGE_BUTTON)),
+        ("image_description", text_message("A cat sitting on a windowsill at sunset")),
+        ("image_count", text_message(keyboards.IMAGE_COUNT_BUTTON_ACTIONS[1])),
+        ("image_size", text_message(keyboards.IMAGE_SIZE_BUTTON_ACTIONS[0])),
+        ("transcript_media", button(keyboards.TRANSCRIPT_MEDIA_BUTTON)),
+        ("file", {"event": "message", "sender": {"id": user_id, "name": "Benchmark"},
+                  "message": {"type": "file", "media": "https://media.example/voice.mp3", "file_name": "voice.mp3", "size": FILE_SIZE}}),
+        ("help", button(keyboards.HELP_BUTTON)),
+        ("cancel", button(keyboards.CANCEL_BUTTON))
+    ]
+
+def install_stubs(bot_module, openai_latency: float, viber_latency: float):
+    import openai
+    from ai_clients import AIClients
+    from utils import SpooledMediaFile
+    from viber_sender import ViberMessageSender
+
+    class StubAIClients(AIClients):
+        def ask_question(self, api_key, question):
+            time.sleep(openai_latency)
+            return "Stub answer to the question."
+
+        def stream_question(self, api_key, question):
+            time.sleep(openai_latency)
+            for word in ["Stub", "answer", "to", "the", "question.", "\n\n"] * 20:
+                yield word + " "
+
+        def generate_image(self, api_key, description, size):
+            time.sleep(openai_latency)
+            return ["https://images.example/stub.png"]
+
+        def transcribe(self, api_key, media_file):
+            time.sleep(openai_latency)
+            return f"Stub transcription of {len(media_file.read())} bytes."
+
+    # the assistant chat calls openai directly
+    def chat_completion_create(model=None, messages=None, stream=False, **kwargs):
+        time.sleep(openai_latency)
+        words = ["Stub", "assistant", "reply", "number", str(len(messages)) + "."] * 20
+        if stream:
+            return iter([{"choices": [{"delta": {"content": word + " "}}]} for word in words])
+        return {"choices": [{"message": {"content": " ".join(words)}}], "usage": {"prompt_tokens": 100}}
+
+    def download_media(url, file_name, max_bytes, spool_threshold=5 * 1024 * 1024, expected_size=None, **kwargs):
+        media_file = SpooledMediaFile(file_name, spool_threshold)
+        media_file.write(b"\0" * (expected_size or FILE_SIZE))
+        media_file.seek(0)
+        return media_file
+
+    def post(sender, payload: bytes) -> dict:
+        time.sleep(viber_latency)
+        return {"status": 0, "message_token": 1}
+
+    openai.ChatCompletion.create = chat_completion_create
+    bot_module.download_media = download_media
+    ViberMessageSender._post = post
+    return StubAIClients()
+
+def load_app(work_dir: str, statement_counter: StatementCounter, recorder: Recorder, args):
+    os.chdir(work_dir)
+    from cryptography.fernet import Fernet
+    config = {
+        "API_KEYS_DB_ENCRYPTION_KEY": os.getenv("API_KEYS_DB_ENCRYPTION_KEY") or Fernet.generate_key().decode(),
+        "VIBER_BOT_TOKEN": AUTH_TOKEN,
+        "LOG_LEVEL": os.getenv("LOG_LEVEL") or "WARNING",
+        "OPENAI_REQUESTS_PER_MINUTE": os.getenv("OPENAI_REQUESTS_PER_MINUTE") or "100000",
+        "STREAMING_ENABLED": os.getenv("STREAMING_ENABLED") or ("true" if args.streaming else "false")
+    }
+
+    from DBService.connection_pool import SQLiteConnectionPool
+    create_connection = SQLiteConnectionPool._create_connection
+
+    def create_traced_connection(pool):
+        connection = create_connection(pool)
+        connection.set_trace_callback(statement_counter.count_statement)
+        return connection
+    SQLiteConnectionPool._create_connection = create_traced_connection
+
+    import bot as bot_module
+    ai_clients = install_stubs(bot_module, args.openai_latency, args.viber_latency)
+
+    handle_request = bot_module.ViberBot._handle_request
+
+    def timed_handle_request(viber_bot, request_data: bytes):
+        token = json.loads(request_data).get("message_token")
+        statement_counter.reset()
+        started_at = time.perf_counter()
+        failed = False
+        try:
+            handle_request(viber_bot, request_data)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            recorder.record_processing(token, time.perf_counter() - started_at, statement_counter.get(), failed)
+    bot_module.ViberBot._handle_request = timed_handle_request
+    return bot_module.create_app(config, ai_clients=ai_clients)
+
+def run(args) -> dict:
+    statement_counter = StatementCounter()
+    recorder = Recorder()
+    work_dir = tempfile.mkdtemp(prefix="viber_bot_benchmark_")
+    app = load_app(work_dir, statement_counter, recorder, args)
+    # the worker is initialized up front like a server hook would do, so it does not distort the first latencies
+    worker = app.extensions["viber_bot"].get()
+    import keyboards
+
+    server = None
+    if args.http:
+        import requests
+        from werkzeug.serving import make_server
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}/"
+        session = requests.Session()
+
+        def send(body: bytes) -> int:
+            return session.post(url, data=body, headers={"X-Viber-Content-Signature": sign(body)}).status_code
+    else:
+        client = app.test_client()
+
+        def send(body: bytes) -> int:
+            return client.post("/", data=body, headers={"X-Viber-Content-Signature": sign(body)}).status_code
+
+    tokens = itertools.count(int(time.time() * 1000))
+    users = queue.Queue()
+    for user_index in range(args.users):
+        users.put(f"benchmark-user-{user_index}")
+
+    def virtual_user():
+        # users are closed loop: the next message is sent after the previous one was processed
+        while True:
+            try:
+                user_id = users.get_nowait()
+            except queue.Empty:
+                return
+            for path, payload in user_script(user_id, keyboards):
+                payload = dict(payload, timestamp=int(time.time() * 1000), message_token=next(tokens))
+                body = json.dumps(payload).encode()
+                done = recorder.expect(payload["message_token"], path)
+                statement_counter.reset()
+                started_at = time.perf_counter()
+                status_code = send(body)
+                recorder.record_ingress(time.perf_counter() - started_at, None if args.http else statement_counter.get())
+                if status_code != 200 or not done.wait(args.timeout):
+                    recorder.record_failure()
+
+    started_at = time.perf_counter()
+    threads = [threading.Thread(target=virtual_user) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started_at
+    if server is not None:
+        server.shutdown()
+
+    results_by_path = recorder.results_by_path()
+    requests_count = sum(len(entries) for entries in results_by_path.values())
+    paths = {}
+    for path, entries in sorted(results_by_path.items()):
+        latencies = [entry["latency"] * 1000 for entry in entries]
+        end_to_end = [entry["end_to_end"] * 1000 for entry in entries]
+        paths[path] = {
+            "count": len(entries),
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+            "p99_ms": percentile(latencies, 99),
+            "end_to_end_p95_ms": percentile(end_to_end, 95),
+            "sql_statements_per_request": sum(entry["statements"] for entry in entries) / len(entries)
+        }
+    ingress_latencies = [latency * 1000 for latency in recorder.ingress_latencies]
+    return {
+        "config": {
+            "mode": "http" if args.http else "in-process",
+            "users": args.users,
+            "concurrency": args.concurrency,
+            "openai_latency": args.openai_latency,
+            "viber_latency": args.viber_latency,
+            "streaming": args.streaming
+        },
+        "startup": {
+            "worker_init_seconds": worker.init_seconds,
+            "import_to_first_request_seconds": worker.import_to_first_request_seconds
+        },
+        "requests": requests_count,
+        "failures": recorder.failures,
+        "elapsed_seconds": elapsed,
+        "requests_per_second": requests_count / elapsed if elapsed else 0.0,
+        "ingress": {
+            "p50_ms": percentile(ingress_latencies, 50),
+            "p95_ms": percentile(ingress_latencies, 95),
+            "p99_ms": percentile(ingress_latencies, 99),
+            "sql_statements_per_request": sum(recorder.ingress_statements) / len(recorder.ingress_statements) if recorder.ingress_statements else None
+        },
+        "paths": paths
+    }
+
+def print_report(results: dict):
+    print(f"mode: {results['config']['mode']}, users: {results['config']['users']}, concurrency: {results['config']['concurrency']}")
+    print(f"requests: {results['requests']}, failures: {results['failures']}, "
+          f"elapsed: {results['elapsed_seconds']:.2f} s, throughput: {results['requests_per_second']:.1f} req/s")
+    startup = results["startup"]
+    print(f"startup: worker init {startup['worker_init_seconds'] * 1000:.1f} ms, "
+          f"import to first request {startup['import_to_first_request_seconds'] * 1000:.1f} ms")
+    ingress = results["ingress"]
+    ingress_statements = "n/a" if ingress["sql_statements_per_request"] is None else f"{ingress['sql_statements_per_request']:.1f}"
+    print(f"ingress: p50 {ingress['p50_ms']:.2f} ms, p95 {ingress['p95_ms']:.2f} ms, p99 {ingress['p99_ms']:.2f} ms, sql/request {ingress_statements}")
+    print(f"{'path':<22}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'e2e p95':>10}{'sql/req':>9}")
+    for path, stats in results["paths"].items():
+        print(f"{path:<22}{stats['count']:>7}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}"
+              f"{stats['end_to_end_p95_ms']:>10.2f}{stats['sql_statements_per_request']:>9.1f}")
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    if results["requests_per_second"] < baseline["requests_per_second"] * (1 - tolerance):
+        regressions.append(f"throughput {results['requests_per_second']:.1f} req/s < baseline {baseline['requests_per_second']:.1f} req/s")
+    for path, stats in results["paths"].items():
+        baseline_stats = baseline["paths"].get(path)
+        if baseline_stats is None:
+            continue
+        if stats["p95_ms"] > baseline_stats["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{path}: p95 {stats['p95_ms']:.2f} ms > baseline {baseline_stats['p95_ms']:.2f} ms")
+        if stats["sql_statements_per_request"] > baseline_stats["sql_statements_per_request"]:
+            regressions.append(f"{path}: {stats['sql_statements_per_request']:.1f} sql statements per request > "
+                               f"baseline {baseline_stats['sql_statements_per_request']:.1f}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the Viber bot with stubbed Viber and OpenAI APIs.")
+    parser.add_argument("--users", type=int, default=20, help="number of virtual users")
+    parser.add_argument("--concurrency", type=int, default=4, help="number of users active at the same time")
+    parser.add_argument("--openai-latency", type=float, default=0.05, help="latency of stubbed OpenAI calls in seconds")
+    parser.add_argument("--viber-latency", type=float, default=0.005, help="latency of stubbed Viber API calls in seconds")
+    parser.add_argument("--streaming", action="store_true", help="stream answers instead of sending them at once")
+    parser.add_argument("--http", action="store_true", help="send callbacks over HTTP to a local server instead of the test client")
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds to wait for a callback to be processed")
+    parser.add_argument("--json", action="store_true", help="print results as json")
+    parser.add_argument("--save-baseline", metavar="FILE", help="store results as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare results with a stored baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression when comparing")
+    args = parser.parse_args()
+    # the benchmark runs in a temporary directory, so paths are resolved before
+    save_baseline = os.path.abspath(args.save_baseline) if args.save_baseline else None
+    baseline = os.path.abspath(args.compare) if args.compare else None
+
+    results = run(args)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
+
+    if save_baseline:
+        with open(save_baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+
+    exit_code = 0
+    if baseline:
+        with open(baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        exit_code = 1 if regressions else 0
+    # worker threads of the bot are not daemons, the process is ended explicitly
+    sys.stdout.flush()
+    os._exit(exit_code)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+# Measures the time a request thread spends per logged event with the old synchronous
+# StreamHandler + FileHandler setup and with the queue based pipeline from logging_setup.
+#
+# Usage: python benchmarks/logging_overhead.py [events]
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from logging_setup import setup_logging
+
+PAYLOAD = '{"event": "message", "sender": {"id": "user"}, "message": {"type": "text", "text": "' + "x" * 200 + '"}}'
+
+def reset_root_logger():
+    root_logger = logging.getLogger()
+    for handler in root_logger.handlers[:]:
+        root_logger.removeHandler(handler)
+        handler.close()
+
+def measure(events: int, level: int) -> float:
+    logger = logging.getLogger("benchmark")
+    started_at = time.perf_counter()
+    for i in range(events):
+        logger.log(level, f"Received message from User {i}.", extra={"payload": PAYLOAD})
+    return (time.perf_counter() - started_at) / events * 1e6
+
+def main():
+    events = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    # console output is discarded so the terminal speed does not distort the numbers
+    sys.stderr = open(os.devnull, "w")
+
+    with tempfile.TemporaryDirectory() as log_dir:
+        reset_root_logger()
+        logging.basicConfig(
+            format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+            level=logging.INFO,
+            handlers=[logging.StreamHandler(), logging.FileHandler(os.path.join(log_dir, "sync.log"))]
+        )
+        sync_info = measure(events, logging.INFO)
+
+        reset_root_logger()
+        listener = setup_logging(log_file=os.path.join(log_dir, "async.log"), level="DEBUG", queue_size=events * 2)
+        async_info = measure(events, logging.INFO)
+        async_debug = measure(events, logging.DEBUG)
+        # the time the listener needs to write out the queue is not part of the request path
+        listener.stop()
+
+    sys.stderr = sys.__stderr__
+    print(f"events per run:                      {events}")
+    print(f"sync handlers, info:                 {sync_info:.2f} us/event")
+    print(f"queue handler, info:                 {async_info:.2f} us/event")
+    print(f"queue handler, sampled debug (1%):   {async_debug:.2f} us/event")
+
+if __name__ == "__main__":
+    main()
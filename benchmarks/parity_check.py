@@ -0,0 +1,315 @@
+# Replays the load test user script through the Flask (threads) and the ASGI (asyncio) serving modes with the same stubs
+# and checks that every user receives exactly the same Viber messages in both modes.
+# It also measures how many slow conversations one asyncio process holds at the same time.
+#
+# Usage:
+#   python benchmarks/parity_check.py --users 20
+#   python benchmarks/parity_check.py --modes asyncio --users 2000 --openai-latency 2.0
+import argparse
+import asyncio
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from load_test import AUTH_TOKEN, FILE_SIZE, install_stubs, sign, user_script
+
+class OutboundRecorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.messages_by_user = {}
+
+    def record(self, payload: bytes):
+        message = json.loads(payload)
+        with self._lock:
+            self.messages_by_user.setdefault(message["receiver"], []).append(message)
+
+class ThreadSampler:
+    # samples the thread count of the process, the asyncio mode should not need a thread per conversation
+    def __init__(self, interval: float = 0.05):
+        self._interval = interval
+        self._stop_event = threading.Event()
+        self.peak_threads = threading.active_count()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop_event.wait(self._interval):
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop_event.set()
+        self._thread.join()
+
+def make_config(work_dir: str, args) -> dict:
+    import constants
+    from cryptography.fernet import Fernet
+    return {
+        constants.API_KEYS_DB_ENCRYPTION_KEY_ENV: Fernet.generate_key().decode(),
+        constants.VIBER_BOT_TOKEN_ENV: AUTH_TOKEN,
+        constants.LOG_LEVEL_ENV: "WARNING",
+        constants.LOG_FILE_ENV: os.path.join(work_dir, "viber_bot.log"),
+        constants.USER_DATA_DB_ENV: os.path.join(work_dir, "user_data.db"),
+        constants.JOB_QUEUE_DB_ENV: os.path.join(work_dir, "jobs.db"),
+        constants.OPENAI_REQUESTS_PER_MINUTE_ENV: "100000",
+        constants.VIBER_SEND_RATE_PER_SECOND_ENV: "1000000",
+        constants.STREAMING_ENABLED_ENV: "true" if args.streaming else "false"
+    }
+
+def user_requests(user_index: int) -> list[bytes]:
+    import keyboards
+    # tokens and timestamps are fixed, so both modes receive identical callbacks
+    bodies = []
+    for step, (path, payload) in enumerate(user_script(f"parity-user-{user_index}", keyboards)):
+        payload = dict(payload, timestamp=1700000000000, message_token=user_index * 1000 + step + 1)
+        bodies.append(json.dumps(payload).encode())
+    return bodies
+
+def install_async_stubs(bot_asgi_module, openai_latency: float, viber_latency: float, recorder: OutboundRecorder):
+    from ai_clients import AsyncAIClients
+    from async_http import AsyncViberMessageSender
+    from utils import SpooledMediaFile
+
+    # the answers match the sync stubs of the load test
+    class StubAsyncAIClients(AsyncAIClients):
+        async def ask_question(self, api_key, question):
+            await asyncio.sleep(openai_latency)
+            return "Stub answer to the question."
+
+        async def stream_question(self, api_key, question):
+            await asyncio.sleep(openai_latency)
+            for word in ["Stub", "answer", "to", "the", "question.", "\n\n"] * 20:
+                yield word + " "
+
+        async def chat_completion(self, api_key, model, messages, stream=False):
+            await asyncio.sleep(openai_latency)
+            words = ["Stub", "assistant", "reply", "number", str(len(messages)) + "."] * 20
+            if stream:
+                async def chunks():
+                    for word in words:
+                        yield {"choices": [{"delta": {"content": word + " "}}]}
+                return chunks()
+            return {"choices": [{"message": {"content": " ".join(words)}}], "usage": {"prompt_tokens": 100}}
+
+        async def generate_image(self, api_key, description, size):
+            await asyncio.sleep(openai_latency)
+            return ["https://images.example/stub.png"]
+
+        async def transcribe(self, api_key, media_file):
+            await asyncio.sleep(openai_latency)
+            return f"Stub transcription of {len(media_file.read())} bytes."
+
+    async def download_media_async(session, url, file_name, max_bytes, spool_threshold=5 * 1024 * 1024, expected_size=None, **kwargs):
+        media_file = SpooledMediaFile(file_name, spool_threshold)
+        media_file.write(b"\0" * (expected_size or FILE_SIZE))
+        media_file.seek(0)
+        return media_file
+
+    async def post(sender, payload: bytes) -> dict:
+        await asyncio.sleep(viber_latency)
+        recorder.record(payload)
+        return {"status": 0, "message_token": 1}
+
+    bot_asgi_module.download_media_async = download_media_async
+    AsyncViberMessageSender._post = post
+    return StubAsyncAIClients()
+
+def run_sync(args, users: list[list[bytes]]) -> dict:
+    import bot as bot_module
+    from viber_sender import ViberMessageSender
+
+    recorder = OutboundRecorder()
+    ai_clients = install_stubs(bot_module, args.openai_latency, args.viber_latency)
+    stub_post = ViberMessageSender._post
+
+    def post(sender, payload: bytes) -> dict:
+        result = stub_post(sender, payload)
+        recorder.record(payload)
+        return result
+    ViberMessageSender._post = post
+
+    done_events = {}
+    handle_request = bot_module.ViberBot.handle_request
+
+    def tracked_handle_request(viber_bot, request_data: bytes):
+        try:
+            handle_request(viber_bot, request_data)
+        finally:
+            done_events[json.loads(request_data)["message_token"]].set()
+    bot_module.ViberBot.handle_request = tracked_handle_request
+
+    app = bot_module.create_app(make_config(tempfile.mkdtemp(prefix="viber_bot_parity_sync_"), args), ai_clients=ai_clients)
+    app.extensions["viber_bot"].get()
+    client = app.test_client()
+    failures = []
+
+    def replay(bodies: list[bytes]):
+        for body in bodies:
+            token = json.loads(body)["message_token"]
+            done_events[token] = threading.Event()
+            status_code = client.post("/", data=body, headers={"X-Viber-Content-Signature": sign(body)}).status_code
+            if status_code != 200 or not done_events[token].wait(args.timeout):
+                failures.append(token)
+
+    started_at = time.perf_counter()
+    with ThreadSampler() as sampler, ThreadPoolExecutor(args.concurrency) as executor:
+        list(executor.map(replay, users))
+    return {
+        "elapsed_seconds": time.perf_counter() - started_at,
+        "peak_threads": sampler.peak_threads,
+        "failures": len(failures),
+        "messages_by_user": recorder.messages_by_user
+    }
+
+async def asgi_request(app, method: str, path: str, body: bytes = b"", headers: list | None = None) -> int:
+    scope = {"type": "http", "method": method, "path": path, "query_string": b"", "headers": headers or []}
+    received = False
+    status = []
+
+    async def receive():
+        nonlocal received
+        if received:
+            await asyncio.Event().wait()
+        received = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status.append(message["status"])
+
+    await app(scope, receive, send)
+    return status[0]
+
+class Lifespan:
+    def __init__(self, app):
+        self._app = app
+        self._messages = asyncio.Queue()
+        self._events = asyncio.Queue()
+        self._task = None
+
+    async def _send(self, message):
+        await self._events.put(message["type"])
+
+    async def startup(self):
+        self._task = asyncio.create_task(self._app({"type": "lifespan"}, self._messages.get, self._send))
+        await self._messages.put({"type": "lifespan.startup"})
+        event = await self._events.get()
+        if event != "lifespan.startup.complete":
+            raise RuntimeError(event)
+
+    async def shutdown(self):
+        await self._messages.put({"type": "lifespan.shutdown"})
+        await self._events.get()
+        await self._task
+
+async def run_asyncio(args, users: list[list[bytes]]) -> dict:
+    import bot_asgi
+
+    recorder = OutboundRecorder()
+    ai_clients = install_async_stubs(bot_asgi, args.openai_latency, args.viber_latency, recorder)
+    done_events = {}
+    handle_request_async = bot_asgi.AsyncViberBot.handle_request_async
+
+    async def tracked_handle_request_async(viber_bot, request_data: bytes):
+        try:
+            await handle_request_async(viber_bot, request_data)
+        finally:
+            done_events[json.loads(request_data)["message_token"]].set()
+    bot_asgi.AsyncViberBot.handle_request_async = tracked_handle_request_async
+
+    app = bot_asgi.create_asgi_app(make_config(tempfile.mkdtemp(prefix="viber_bot_parity_asyncio_"), args), ai_clients=ai_clients)
+    lifespan = Lifespan(app)
+    await lifespan.startup()
+    worker = await app.get_worker()
+    failures = []
+    peak_in_flight = 0
+
+    async def replay(bodies: list[bytes]):
+        nonlocal peak_in_flight
+        for body in bodies:
+            token = json.loads(body)["message_token"]
+            done_events[token] = asyncio.Event()
+            status_code = await asgi_request(app, "POST", "/", body, [(b"x-viber-content-signature", sign(body).encode())])
+            peak_in_flight = max(peak_in_flight, len(worker.request_dispatcher._in_flight_tasks))
+            try:
+                if status_code != 200:
+                    raise asyncio.TimeoutError
+                await asyncio.wait_for(done_events[token].wait(), args.timeout)
+            except asyncio.TimeoutError:
+                failures.append(token)
+
+    started_at = time.perf_counter()
+    # every user is active at the same time, each of them waits for the stubbed OpenAI latency on most steps
+    with ThreadSampler() as sampler:
+        await asyncio.gather(*(replay(bodies) for bodies in users))
+    elapsed = time.perf_counter() - started_at
+    await lifespan.shutdown()
+    return {
+        "elapsed_seconds": elapsed,
+        "peak_threads": sampler.peak_threads,
+        "peak_jobs_in_flight": peak_in_flight,
+        "failures": len(failures),
+        "messages_by_user": recorder.messages_by_user
+    }
+
+def compare(sync_messages: dict, asyncio_messages: dict) -> list[str]:
+    mismatches = []
+    for user_id in sorted(set(sync_messages) | set(asyncio_messages)):
+        expected = sync_messages.get(user_id, [])
+        actual = asyncio_messages.get(user_id, [])
+        if len(expected) != len(actual):
+            mismatches.append(f"{user_id}: {len(expected)} messages in sync mode, {len(actual)} in asyncio mode")
+            continue
+        for index, (expected_message, actual_message) in enumerate(zip(expected, actual)):
+            if expected_message != actual_message:
+                mismatches.append(f"{user_id}: message {index} differs: {expected_message} != {actual_message}")
+                break
+    return mismatches
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks that the sync and asyncio serving modes reply identically.")
+    parser.add_argument("--users", type=int, default=20, help="number of virtual users")
+    parser.add_argument("--concurrency", type=int, default=8, help="number of users active at the same time in sync mode")
+    parser.add_argument("--openai-latency", type=float, default=0.05, help="latency of stubbed OpenAI calls in seconds")
+    parser.add_argument("--viber-latency", type=float, default=0.005, help="latency of stubbed Viber API calls in seconds")
+    parser.add_argument("--streaming", action="store_true", help="stream answers instead of sending them at once")
+    parser.add_argument("--modes", default="sync,asyncio", help="comma separated serving modes to run")
+    parser.add_argument("--timeout", type=float, default=120.0, help="seconds to wait for a callback to be processed")
+    args = parser.parse_args()
+    modes = args.modes.split(",")
+
+    users = [user_requests(user_index) for user_index in range(args.users)]
+    results = {}
+    if "sync" in modes:
+        results["sync"] = run_sync(args, users)
+    if "asyncio" in modes:
+        results["asyncio"] = asyncio.run(run_asyncio(args, users))
+
+    requests_count = sum(len(bodies) for bodies in users)
+    for mode, result in results.items():
+        messages_count = sum(len(messages) for messages in result["messages_by_user"].values())
+        in_flight = f", peak jobs in flight {result['peak_jobs_in_flight']}" if "peak_jobs_in_flight" in result else ""
+        print(f"{mode}: {requests_count} requests, {messages_count} messages sent, failures {result['failures']}, "
+              f"elapsed {result['elapsed_seconds']:.2f} s, peak threads {result['peak_threads']}{in_flight}")
+    print(f"max rss: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+
+    exit_code = 1 if any(result["failures"] for result in results.values()) else 0
+    if len(results) == 2:
+        mismatches = compare(results["sync"]["messages_by_user"], results["asyncio"]["messages_by_user"])
+        for mismatch in mismatches:
+            print(f"MISMATCH: {mismatch}")
+        print("parity: " + ("FAILED" if mismatches else "OK"))
+        exit_code = exit_code or (1 if mismatches else 0)
+    # worker threads of the sync mode are not daemons, the process is ended explicitly
+    sys.stdout.flush()
+    os._exit(exit_code)
+
+if __name__ == "__main__":
+    main()
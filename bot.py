@@ -1,328 +1,728 @@
-import logging
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO,
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler("viber_bot.log"),
-    ]
-)
-logger = logging.getLogger(__name__)
+import time
+_IMPORT_STARTED_AT = time.perf_counter()
 
+import atexit
+import functools
+import logging
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
 import constants
 import keyboards
-import json
 
-from OpenAIClients.ChatGPT.chat_gpt_client import ChatGPTClient, TextDavinciClient
-from OpenAIClients.DALLE.dalle_client import DALLEClient, ImageRequestData, ImageSize
-from OpenAIClients.WhisperClient.whisper_client import WhisperClient, get_file_extension
+from ai_clients import AIClients, ONE_SHOT_MAX_TOKENS, ONE_SHOT_MODEL, lazy_import_stats
 from DBService.db_service import UserDataDatabaseService
+from DBService.job_queue_service import JobQueueDatabaseService
+from DBService.message_dedup_service import MessageDedupDatabaseService
 from chat_state import ChatState
-from utils import download_file, is_media_file
-
-from flask import Flask, request, Response
+from state_machine import FALLBACK_ACTION, StateMachineDispatcher
+from user_session import UserSession
+from chat_session_store import ChatSessionStore
+from context_window import ContextWindow, count_tokens
+from response_cache import ResponseCache, make_cache_key
+from api_key_limiter import ApiKeyLimiter, RateLimitExceededError
+from text_chunking import StreamChunker, StreamingStats
+from image_generation import generate_images_concurrently
+from transcription import TranscriptionPipeline
+from request_dispatcher import DurableRequestDispatcher, get_request_routing_info
+from message_deduplicator import MessageDeduplicator
+from rate_limiter import TokenBucket
+from viber_sender import OutboundMessageBuffer, ViberMessageSender
+from logging_setup import setup_logging
+from metrics import SamplingProfiler, metrics_registry
+from utils import FileTooLargeError, Settings, download_media, is_admin_request, is_media_file
+
+from flask import Flask, jsonify, request, Response
 from viberbot import Api
 from viberbot.api.bot_configuration import BotConfiguration
-from viberbot.api.messages.text_message import TextMessage
-from viberbot.api.messages.keyboard_message import KeyboardMessage
+from viberbot.api.consts import VIBER_BOT_API_URL
 from viberbot.api.messages.picture_message import PictureMessage
 from viberbot.api.messages.file_message import FileMessage
 from viberbot.api.viber_requests import ViberConversationStartedRequest, ViberFailedRequest, ViberMessageRequest, ViberSubscribedRequest, ViberUnsubscribedRequest
 
+logger = logging.getLogger(__name__)
+
 
 class ViberBot:
-    def __init__(self):
-        db_encryption_key = os.getenv(constants.API_KEYS_DB_ENCRYPTION_KEY_ENV)
-        if not db_encryption_key:
-            logger.error("API_KEYS_DB_ENCRYPTION_KEY_ENV was not found in environment variables")
-        self._user_data_db = UserDataDatabaseService(db_encryption_key, "user_data.db")
-        self._chat_gpt_clients = dict()
-
-    def _get_chat_state(self, user_id: str) -> ChatState:
-        chat_state_value = self._user_data_db.get_chat_state(user_id)
-        return ChatState(chat_state_value)
-    
-    def _set_chat_state(self, user_id: str, chat_state: ChatState):
-        self._user_data_db.set_chat_state(user_id, chat_state.value)
-
-    def _get_openai_api_key(self, user_id: str) -> str | None:
-        api_key = self._user_data_db.get_api_key(user_id)
-        return api_key.strip() if api_key else None
+    def __init__(self, settings: Settings, viber_api: Api, message_sender: ViberMessageSender,
+                 user_data_db: UserDataDatabaseService, ai_clients: AIClients):
+        self._viber_api = viber_api
+        self._message_sender = message_sender
+        self._user_data_db = user_data_db
+        self._ai_clients = ai_clients
+        self._chat_sessions = ChatSessionStore(
+            self._user_data_db,
+            max_sessions=settings.get_int(constants.CHAT_SESSIONS_MAX_COUNT_ENV, 1000),
+            max_memory_bytes=settings.get_int(constants.CHAT_SESSIONS_MAX_MEMORY_BYTES_ENV, 64 * 1024 * 1024),
+            idle_timeout=settings.get_float(constants.CHAT_SESSIONS_IDLE_TIMEOUT_ENV, 1800.0)
+        )
+        self._context_window = ContextWindow(settings.get_int(constants.CHAT_CONTEXT_TOKEN_BUDGET_ENV, 3000))
+        self._streaming_enabled = settings.get_bool(constants.STREAMING_ENABLED_ENV, True)
+        self._stream_min_chunk_size = settings.get_int(constants.STREAM_MIN_CHUNK_SIZE_ENV, 200)
+        self._stream_flush_interval = settings.get_float(constants.STREAM_FLUSH_INTERVAL_ENV, 2.0)
+        self._streaming_stats = StreamingStats()
+        self._api_key_limiter = ApiKeyLimiter(
+            requests_per_minute=settings.get_float(constants.OPENAI_REQUESTS_PER_MINUTE_ENV, 60.0),
+            tokens_per_minute=settings.get_float(constants.OPENAI_TOKENS_PER_MINUTE_ENV, 90000.0),
+            max_in_flight=settings.get_int(constants.OPENAI_MAX_IN_FLIGHT_ENV, 2),
+            queue_timeout=settings.get_float(constants.OPENAI_QUEUE_TIMEOUT_ENV, 30.0)
+        )
+        self._response_cache = ResponseCache(
+            max_size=settings.get_int(constants.RESPONSE_CACHE_SIZE_ENV, 1000),
+            ttl_seconds=settings.get_float(constants.RESPONSE_CACHE_TTL_ENV, 3600.0)
+        ) if settings.get_bool(constants.RESPONSE_CACHE_ENABLED_ENV, False) else None
+        self._dispatcher = self._build_dispatcher()
+        self._image_executor = ThreadPoolExecutor(settings.get_int(constants.IMAGE_GENERATION_WORKERS_ENV, 8), thread_name_prefix="image-generation")
+        transcription_workers = settings.get_int(constants.TRANSCRIPTION_WORKERS_ENV, 4)
+        self._transcription_pipeline = TranscriptionPipeline(
+            ThreadPoolExecutor(transcription_workers, thread_name_prefix="transcription"),
+            segment_seconds=settings.get_float(constants.TRANSCRIPTION_SEGMENT_SECONDS_ENV, 600.0),
+            overlap_seconds=settings.get_float(constants.TRANSCRIPTION_OVERLAP_SECONDS_ENV, 2.0),
+            split_threshold_bytes=settings.get_int(constants.TRANSCRIPTION_SPLIT_THRESHOLD_BYTES_ENV, 24 * 1024 * 1024),
+            max_parallel_segments=transcription_workers
+        )
+        self._media_max_bytes = settings.get_int(constants.MEDIA_MAX_BYTES_ENV, 200 * 1024 * 1024)
+        self._media_spool_threshold = settings.get_int(constants.MEDIA_SPOOL_THRESHOLD_BYTES_ENV, 5 * 1024 * 1024)
+
+    @property
+    def streaming_stats(self) -> StreamingStats:
+        return self._streaming_stats
+
+    @property
+    def dispatcher(self) -> StateMachineDispatcher:
+        return self._dispatcher
+
+    @property
+    def api_key_limiter(self) -> ApiKeyLimiter:
+        return self._api_key_limiter
+
+    @property
+    def response_cache(self) -> ResponseCache | None:
+        return self._response_cache
+
+    @property
+    def context_window(self) -> ContextWindow:
+        return self._context_window
+
+    @property
+    def chat_sessions(self) -> ChatSessionStore:
+        return self._chat_sessions
+
+    @property
+    def user_data_db(self) -> UserDataDatabaseService:
+        return self._user_data_db
 
     def handle_request(self, request_data: bytes):
-        viber_request = viber.parse_request(request_data)
+        try:
+            with metrics_registry.timer("handle_request"):
+                self._handle_request(request_data)
+            metrics_registry.count_request()
+        finally:
+            metrics_registry.clear_context()
+
+    def _handle_request(self, request_data: bytes):
+        viber_request = self._parse_request(request_data)
+        user_id = self._get_session_user_id(viber_request)
+        if user_id is None:
+            self._handle_sessionless_request(viber_request)
+            return
+
+        session = UserSession(self._user_data_db, user_id)
+        outbound = OutboundMessageBuffer(self._message_sender, user_id)
+        self._set_metrics_context(session)
+        try:
+            self._route_request(viber_request, session, outbound)
+        except RateLimitExceededError as e:
+            self._handle_rate_limit_exceeded(e, session, outbound)
+        finally:
+            try:
+                outbound.flush()
+            finally:
+                session.flush()
+
+    def _parse_request(self, request_data: bytes):
+        with metrics_registry.timer("parse_request"):
+            return self._viber_api.parse_request(request_data)
+
+    @staticmethod
+    def _get_session_user_id(viber_request) -> str | None:
+        if isinstance(viber_request, (ViberConversationStartedRequest, ViberSubscribedRequest)):
+            return viber_request.user.id
+        elif isinstance(viber_request, ViberMessageRequest):
+            return viber_request.sender.id
+        return None
 
-        if isinstance(viber_request, ViberConversationStartedRequest):
-            self._handle_conversation_started_request(viber_request)
-        elif isinstance(viber_request, ViberSubscribedRequest):
-            self._handle_subscribed_request(viber_request)
-        elif isinstance(viber_request, ViberUnsubscribedRequest):
+    def _handle_sessionless_request(self, viber_request):
+        if isinstance(viber_request, ViberUnsubscribedRequest):
             self._handle_unsubscribed_request(viber_request)
-        elif isinstance(viber_request, ViberMessageRequest):
-            self._handle_message_request(viber_request)
         elif isinstance(viber_request, ViberFailedRequest):
             self._handle_failed_request(viber_request)
 
-    def _send_text_message(self, user_id: str, message: str):
-        viber.send_messages(user_id, [TextMessage(text=message)])
+    @staticmethod
+    def _set_metrics_context(session: UserSession):
+        if metrics_registry.enabled:
+            # handlers of features overwrite the feature label
+            metrics_registry.set_context(chat_state=session.chat_state.name, feature="menu")
 
-    def _send_keyboard(self, user_id: str, keyboard: dict):
-        extended_keyboard = keyboards.append_buttons(keyboard, [keyboards.HELP_BUTTON])
-        keyboard_message = KeyboardMessage(keyboard=extended_keyboard)
-        viber.send_messages(user_id, [keyboard_message])
-        self._user_data_db.set_last_keyboard(user_id, json.dumps(keyboard))
+    def _route_request(self, viber_request, session: UserSession, outbound: OutboundMessageBuffer):
+        # handlers of the asyncio serving mode may return a coroutine, it is passed on to the caller
+        session.record_activity()
+        if not isinstance(viber_request, ViberConversationStartedRequest):
+            session.mark_subscribed()
 
-    def _send_initial_message(self, request: ViberConversationStartedRequest | ViberSubscribedRequest):
-        user_id = request.user.id
+        if isinstance(viber_request, ViberConversationStartedRequest):
+            return self._handle_conversation_started_request(viber_request, session, outbound)
+        elif isinstance(viber_request, ViberSubscribedRequest):
+            return self._handle_subscribed_request(viber_request, session, outbound)
+        elif isinstance(viber_request, ViberMessageRequest):
+            return self._handle_message_request(viber_request, session, outbound)
+
+    def _handle_rate_limit_exceeded(self, error: RateLimitExceededError, session: UserSession, outbound: OutboundMessageBuffer):
+        logger.warning(f"Request of User {session.user_id} rejected: {error}")
+        outbound.add_text(constants.TOO_MANY_REQUESTS_MESSAGE)
+        # the last keyboard is unknown for new users, users cleared by retention and unmapped legacy rows
+        keyboard_id = keyboards.resolve_keyboard_id(session.last_keyboard)
+        if not keyboard_id:
+            keyboard_id = keyboards.MAIN_KEYBOARD_ID if session.api_key else keyboards.SET_API_KEY_KEYBOARD_ID
+        self._send_keyboard(session, outbound, keyboard_id)
+
+    def _send_keyboard(self, session: UserSession, outbound: OutboundMessageBuffer, keyboard_id: str):
+        outbound.set_keyboard(keyboards.get_registered_keyboard(keyboard_id))
+        session.last_keyboard = keyboard_id
+
+    def _send_streamed_answer(self, outbound: OutboundMessageBuffer, answer_deltas):
+        def send_chunk(chunk: str):
+            outbound.add_text(chunk)
+            outbound.flush()
+
+        chunker = StreamChunker(
+            send_chunk,
+            min_chunk_size=self._stream_min_chunk_size,
+            flush_interval=self._stream_flush_interval,
+            stats=self._streaming_stats
+        )
+        answer = []
+        for delta in answer_deltas:
+            answer.append(delta)
+            chunker.feed(delta)
+        # the last part stays buffered so the keyboard is attached to it
+        for chunk in chunker.finish():
+            outbound.add_text(chunk)
+        return "".join(answer)
+
+    def _answer_question(self, outbound: OutboundMessageBuffer, api_key: str, question: str):
+        def ask() -> str:
+            # max_tokens of the completion counts towards the tokens per minute limit as well
+            with self._api_key_limiter.limit(api_key, count_tokens(question) + ONE_SHOT_MAX_TOKENS), metrics_registry.timer("openai"):
+                if self._streaming_enabled:
+                    return self._send_streamed_answer(outbound, self._ai_clients.stream_question(api_key, question))
+                answer = self._ai_clients.ask_question(api_key, question)
+                outbound.add_text(answer)
+                return answer
+
+        if self._response_cache is None:
+            ask()
+            return
+
+        cache_key = make_cache_key(api_key, question, {"model": ONE_SHOT_MODEL, "max_tokens": ONE_SHOT_MAX_TOKENS})
+        answer, computed = self._response_cache.get_or_compute(cache_key, ask)
+        if not computed:
+            outbound.add_text(answer)
+
+    def _send_initial_message(self, session: UserSession, outbound: OutboundMessageBuffer):
+        user_id = session.user_id
         logger.info(f"_send_initial_message called for User {user_id}")
 
         reply_message = constants.WELCOME_USER_MESSAGE
-        keyboard = keyboards.MAIN_KEYBOARD
-        if not self._get_openai_api_key(user_id):
+        keyboard_id = keyboards.MAIN_KEYBOARD_ID
+        if not session.api_key:
             reply_message += f" {constants.API_KEY_REQUEST_MESSAGE}"
-            keyboard = keyboards.SET_API_KEY_KEYBOARD
+            keyboard_id = keyboards.SET_API_KEY_KEYBOARD_ID
 
-        self._send_text_message(user_id, reply_message)
-        self._send_keyboard(user_id, keyboard)
+        outbound.add_text(reply_message)
+        self._send_keyboard(session, outbound, keyboard_id)
 
-    def _handle_conversation_started_request(self, request: ViberConversationStartedRequest):
+    def _handle_conversation_started_request(self, request: ViberConversationStartedRequest, session: UserSession, outbound: OutboundMessageBuffer):
         logger.info(f"_handle_subscribed_request called for User {request.user.id}")
-        self._send_initial_message(request)
+        self._send_initial_message(session, outbound)
 
-    def _handle_subscribed_request(self, request: ViberSubscribedRequest):
+    def _handle_subscribed_request(self, request: ViberSubscribedRequest, session: UserSession, outbound: OutboundMessageBuffer):
         logger.info(f"_handle_subscribed_request called for User {request.user.id}")
-        self._send_initial_message(request)
+        self._send_initial_message(session, outbound)
 
     def _handle_unsubscribed_request(self, request: ViberUnsubscribedRequest):
         logger.info(f"User {request.user_id} unsubscribed.")
+        # unsubscribed users are excluded from broadcasts
+        self._user_data_db.mark_unsubscribed([request.user_id])
 
     def _handle_failed_request(self, request: ViberFailedRequest):
         logger.error(f"Client failed receiving message. failure: {request}")
 
-    def _handle_message_request(self, request: ViberMessageRequest):
+    def _build_dispatcher(self) -> StateMachineDispatcher:
+        dispatcher = StateMachineDispatcher()
+
+        # buttons which work in every state, even without an api key
+        dispatcher.register(keyboards.get_button_action(keyboards.HELP_BUTTON), self._handle_help_button)
+        dispatcher.register(keyboards.get_button_action(keyboards.CANCEL_BUTTON), self._handle_cancel_button)
+        dispatcher.register(keyboards.get_button_action(keyboards.SET_API_KEY_BUTTON), self._handle_set_api_key_button)
+
+        # menu buttons which work in every state
+        dispatcher.register(keyboards.get_button_action(keyboards.START_CHAT_BUTTON), self._requires_api_key(self._handle_start_chat_button))
+        dispatcher.register(keyboards.get_button_action(keyboards.GENERATE_IMAGE_BUTTON), self._requires_api_key(self._handle_generate_image_button))
+        dispatcher.register(keyboards.get_button_action(keyboards.TRANSCRIPT_MEDIA_BUTTON), self._requires_api_key(self._handle_transcript_media_button))
+
+        # buttons which belong to a single state, in other states they are handled as a text message
+        state_buttons = [
+            ([keyboards.get_button_action(keyboards.END_CHAT_BUTTON)], ChatState.HAVING_CONVERSATION_WITH_ASSISTANT, self._handle_end_chat_button),
+            (keyboards.ROLE_BUTTON_ACTIONS, ChatState.SELECTING_ASSISTANT_ROLE, self._handle_assistant_role_button),
+            (keyboards.IMAGE_COUNT_BUTTON_ACTIONS, ChatState.SELECTING_IMAGES_COUNT, self._handle_images_count_button),
+            (keyboards.IMAGE_SIZE_BUTTON_ACTIONS, ChatState.SELECTING_IMAGES_SIZE, self._handle_images_size_button)
+        ]
+        for actions, state, handler in state_buttons:
+            for action in actions:
+                dispatcher.register(action, self._requires_api_key(handler), states=[state])
+                dispatcher.register(action, self._requires_api_key(self._handle_as_text_message))
+
+        # text messages
+        dispatcher.register_fallback(ChatState.MAIN, self._handle_question)
+        dispatcher.register_fallback(ChatState.PROVIDING_API_KEY, self._handle_api_key_input)
+        dispatcher.register_fallback(ChatState.HAVING_CONVERSATION_WITH_ASSISTANT, self._handle_chat_message)
+        dispatcher.register_fallback(ChatState.PROVIDING_IMAGES_DESCRIPTION, self._handle_images_description_input)
+        for state in (ChatState.SELECTING_ASSISTANT_ROLE, ChatState.SELECTING_IMAGES_COUNT,
+                      ChatState.SELECTING_IMAGES_SIZE, ChatState.PROVIDING_MEDIA_FILE):
+            dispatcher.register_fallback(state, self._handle_unexpected_text)
+
+        dispatcher.compile()
+        return dispatcher
+
+    def _requires_api_key(self, handler):
+        def handle_if_api_key_set(request: ViberMessageRequest, session: UserSession, outbound: OutboundMessageBuffer):
+            if session.api_key:
+                return handler(request, session, outbound)
+            else:
+                outbound.add_text(constants.SOMETHING_WENT_WRONG_MESSAGE + constants.API_KEY_REQUEST_MESSAGE)
+                self._send_keyboard(session, outbound, keyboards.SET_API_KEY_KEYBOARD_ID)
+                session.chat_state = ChatState.MAIN
+        return handle_if_api_key_set
+
+    def _handle_message_request(self, request: ViberMessageRequest, session: UserSession, outbound: OutboundMessageBuffer):
         user_id = request.sender.id
 
         if isinstance(request.message, FileMessage):
             logger.info(f'Received file message from User {user_id}.')
-            self._handle_file_message_request(request)
+            return self._handle_file_message_request(request, session, outbound)
         else:
             message = request.message.text
-            logger.info(f'Received message "{message}" from User {user_id}.')
+            logger.info(f'Received message from User {user_id}.', extra={"payload": message})
+            return self._dispatcher.dispatch(session.chat_state, message, request, session, outbound)
 
-            if message in keyboards.BUTTON_ACTIONS:
-                self._handle_keyboard_button_click(request)
-            else:
-                self._handle_text_message_request(request)
-            
-
-    def _handle_text_message_request(self, request: ViberMessageRequest):
-        user_id = request.sender.id
-        logger.info(f'_handle_text_message_request for User {user_id}.')
-
-        message = request.message.text
-        api_key = self._get_openai_api_key(user_id)
-        chat_state = self._get_chat_state(user_id)
-        if not chat_state: chat_state = ChatState.MAIN
-        logger.info(f"User's {user_id} chat state is {chat_state}.")
-
-        if chat_state == ChatState.MAIN:
-            if api_key:
-                self._send_text_message(user_id, constants.ASSISTANT_IS_ANSWERING_MESSAGE)
-                answer = TextDavinciClient.ask_question(api_key, message)
-                self._send_text_message(user_id, answer)
-                bot._send_keyboard(user_id, keyboards.MAIN_KEYBOARD)
-            else:
-                self._send_text_message(user_id, constants.API_KEY_REQUEST_MESSAGE)
-                self._send_keyboard(user_id, keyboards.SET_API_KEY_KEYBOARD)
-
-        elif chat_state == ChatState.PROVIDING_API_KEY:
-            api_key = message
-            self._user_data_db.store_api_key(user_id, api_key)
-            self._send_text_message(user_id, constants.API_KEY_SET_SUCCESSFULLY_MESSAGE)
-            self._send_keyboard(user_id, keyboards.MAIN_KEYBOARD)
-            self._set_chat_state(user_id, ChatState.MAIN)
-
-        elif chat_state == ChatState.HAVING_CONVERSATION_WITH_ASSISTANT:
-            chat_gpt_client = self._chat_gpt_clients[user_id]
-            self._send_text_message(user_id, constants.ASSISTANT_IS_ANSWERING_MESSAGE)
-            response = chat_gpt_client.ask_chat(message)
-            self._send_text_message(user_id, response)
-            self._send_keyboard(user_id, keyboards.END_CHAT_KEYBOARD)
-
-        elif chat_state == ChatState.PROVIDING_IMAGES_DESCRIPTION:
-            self._user_data_db.set_img_description(user_id, message)
-            self._send_text_message(user_id, constants.IMAGE_COUNT_REQUEST_MESSAGE)
-            self._send_keyboard(user_id, keyboards.IMAGE_COUNT_KEYBOARD)
-            self._set_chat_state(user_id, ChatState.SELECTING_IMAGES_COUNT)
+    def _handle_as_text_message(self, request: ViberMessageRequest, session: UserSession, outbound: OutboundMessageBuffer):
+        return self._dispatcher.dispatch(session.chat_state, FALLBACK_ACTION, request, session, outbound)
 
+    def _handle_question(self, request: ViberMessageRequest, session: UserSession, outbound: OutboundMessageBuffer):
+        metrics_registry.set_context(feature="one_shot")
+        api_key = session.api_key
+        if api_key:
+            outbound.add_text(constants.ASSISTANT_IS_ANSWERING_MESSAGE)
+            outbound.flush()
+            self._answer_question(outbound, api_key, request.message.text)
+            self._send_keyboard(session, outbound, keyboards.MAIN_KEYBOARD_ID)
         else:
-            self._send_text_message(user_id, constants.HELP_MESSAGE)
-            self._send_keyboard(user_id, keyboards.MAIN_KEYBOARD)
+            outbound.add_text(constants.API_KEY_REQUEST_MESSAGE)
+            self._send_keyboard(session, outbound, keyboards.SET_API_KEY_KEYBOARD_ID)
 
-    def _handle_keyboard_button_click(self, request: ViberMessageRequest):
-        message = request.message.text
-        user_id = request.sender.id
-        logger.info(f'_handle_keyboard_button_click for User {request.sender.id}.')
-
-        api_key = self._get_openai_api_key(user_id)
+    def _handle_api_key_input(self, request: ViberMessageRequest, session: UserSession, outbound: OutboundMessageBuffer):
+        session.api_key = request.message.text
+        outbound.add_text(constants.API_KEY_SET_SUCCESSFULLY_MESSAGE)
+        self._send_keyboard(session, outbound, keyboards.MAIN_KEYBOARD_ID)
+        session.chat_state = ChatState.MAIN
 
-        if message == keyboards.get_button_action(keyboards.HELP_BUTTON):
-            self._send_text_message(user_id, constants.HELP_MESSAGE)
-            # return previous keyboard to user
-            last_user_keyboard_data = self._user_data_db.get_last_keyboard(user_id)
-            if last_user_keyboard_data:
-                keyboard = json.loads(last_user_keyboard_data)
-                self._send_keyboard(user_id, keyboard)
-            else:
-                if api_key:
-                    self._send_keyboard(user_id, keyboards.MAIN_KEYBOARD)
+    def _handle_chat_message(self, request: ViberMessageRequest, session: UserSession, outbound: OutboundMessageBuffer):
+        metrics_registry.set_context(feature="chat")
+        user_id = request.sender.id
+        message = request.message.text
+        api_key = session.api_key
+        assistant_chat = self._chat_sessions.get(user_id)
+        if assistant_chat:
+            outbound.add_text(constants.ASSISTANT_IS_ANSWERING_MESSAGE)
+            outbound.flush()
+            prompt_tokens = min(assistant_chat.prompt_tokens + count_tokens(message), self._context_window.token_budget)
+            with self._api_key_limiter.limit(api_key, prompt_tokens), metrics_registry.timer("openai"):
+                if self._streaming_enabled:
+                    self._send_streamed_answer(outbound, assistant_chat.ask_stream(api_key, message, self._context_window))
+                    self._chat_sessions.save(user_id, assistant_chat)
                 else:
-                    self._send_keyboard(user_id, keyboards.SET_API_KEY_KEYBOARD)
-                self._set_chat_state(user_id, ChatState.MAIN)
-
-        elif message == keyboards.get_button_action(keyboards.CANCEL_BUTTON):
-            self._set_chat_state(user_id, ChatState.MAIN)
-            if api_key:
-                self._send_keyboard(user_id, keyboards.MAIN_KEYBOARD)
+                    response = assistant_chat.ask(api_key, message, self._context_window)
+                    self._chat_sessions.save(user_id, assistant_chat)
+                    outbound.add_text(response)
+            self._send_keyboard(session, outbound, keyboards.END_CHAT_KEYBOARD_ID)
+        else:
+            outbound.add_text(constants.CHAT_SESSION_NOT_FOUND_MESSAGE)
+            self._send_keyboard(session, outbound, keyboards.MAIN_KEYBOARD_ID)
+            session.chat_state = ChatState.MAIN
+
+    def _handle_images_description_input(self, request: ViberMessageRequest, session: UserSession, outbound: OutboundMessageBuffer):
+        session.img_description = request.message.text
+        outbound.add_text(constants.IMAGE_COUNT_REQUEST_MESSAGE)
+        self._send_keyboard(session, outbound, keyboards.IMAGE_COUNT_KEYBOARD_ID)
+        session.chat_state = ChatState.SELECTING_IMAGES_COUNT
+
+    def _handle_unexpected_text(self, request: ViberMessageRequest, session: UserSession, outbound: OutboundMessageBuffer):
+        outbound.add_text(constants.HELP_MESSAGE)
+        self._send_keyboard(session, outbound, keyboards.MAIN_KEYBOARD_ID)
+
+    def _handle_help_button(self, request: ViberMessageRequest, session: UserSession, outbound: OutboundMessageBuffer):
+        outbound.add_text(constants.HELP_MESSAGE)
+        # return previous keyboard to user
+        last_keyboard_id = keyboards.resolve_keyboard_id(session.last_keyboard)
+        if last_keyboard_id:
+            self._send_keyboard(session, outbound, last_keyboard_id)
+        else:
+            if session.api_key:
+                self._send_keyboard(session, outbound, keyboards.MAIN_KEYBOARD_ID)
             else:
-                self._send_keyboard(user_id, keyboards.SET_API_KEY_KEYBOARD)
-            self._set_chat_state(user_id, ChatState.MAIN)
-
-        elif message == keyboards.get_button_action(keyboards.SET_API_KEY_BUTTON):
-            self._send_text_message(user_id, constants.PLEASE_SEND_API_KEY_MESSAGE)
-            self._send_keyboard(user_id, keyboards.CANCEL_KEYBOARD)
-            self._set_chat_state(user_id, ChatState.PROVIDING_API_KEY)
-
-        elif api_key:
-            chat_state = self._get_chat_state(user_id)
-
-            if message == keyboards.get_button_action(keyboards.START_CHAT_BUTTON):
-                self._send_text_message(user_id, constants.ASSISTANT_ROLE_REQUEST_MESSAGE)
-                self._send_keyboard(user_id, keyboards.ASSISTANT_ROLES_KEYBOARD)
-                self._set_chat_state(user_id, ChatState.SELECTING_ASSISTANT_ROLE)
-
-            elif message in keyboards.ROLE_BUTTON_ACTIONS :
-                if chat_state == ChatState.SELECTING_ASSISTANT_ROLE:
-                    assistant_role = keyboards.parse_assistant_role(message)
-                    chat_gpt_client = ChatGPTClient(api_key, assistant_role)
-                    self._chat_gpt_clients[user_id] = chat_gpt_client
-                    self._send_text_message(user_id, constants.CHAT_STARTED_MESSAGE)
-                    self._send_keyboard(user_id, keyboards.END_CHAT_KEYBOARD)
-                    self._set_chat_state(user_id, ChatState.HAVING_CONVERSATION_WITH_ASSISTANT)
-                else:
-                    self._handle_text_message_request(request)
-
-            elif message == keyboards.get_button_action(keyboards.END_CHAT_BUTTON):
-                if chat_state == ChatState.HAVING_CONVERSATION_WITH_ASSISTANT:
-                    if user_id in self._chat_gpt_clients:
-                        del self._chat_gpt_clients[user_id]
-                    self._send_text_message(user_id, constants.CHAT_ENDED_MESSAGE)
-                    self._send_keyboard(user_id, keyboards.MAIN_KEYBOARD)
-                    self._set_chat_state(user_id, ChatState.MAIN)
-                else:
-                    self._handle_text_message_request(request)
-
-            elif message == keyboards.get_button_action(keyboards.GENERATE_IMAGE_BUTTON):
-                self._send_text_message(user_id, constants.IMAGE_DESCRIPTION_REQUEST_MESSAGE)
-                self._send_keyboard(user_id, keyboards.CANCEL_KEYBOARD)
-                self._set_chat_state(user_id, ChatState.PROVIDING_IMAGES_DESCRIPTION)
-
-            elif message in keyboards.IMAGE_COUNT_BUTTON_ACTIONS:
-                if chat_state == ChatState.SELECTING_IMAGES_COUNT:
-                    images_count = keyboards.parse_images_count(message)
-                    self._user_data_db.set_img_count(user_id, images_count)
-                    self._send_text_message(user_id, constants.IMAGE_SIZE_REQUEST_MESSAGE)
-                    self._send_keyboard(user_id, keyboards.IMAGE_SIZE_KEYBOARD)
-                    self._set_chat_state(user_id, ChatState.SELECTING_IMAGES_SIZE)
-                else:
-                    self._handle_text_message_request(request)
-
-            elif message in keyboards.IMAGE_SIZE_BUTTON_ACTIONS:
-                if chat_state == ChatState.SELECTING_IMAGES_SIZE:
-                    size = ImageSize[keyboards.parse_images_size(message).upper()]
-                    count = self._user_data_db.get_img_count(user_id)
-                    description = self._user_data_db.get_img_description(user_id)
-
-                    self._send_text_message(user_id, constants.IMAGE_GENERATION_IN_PROGRESS_MESSAGE)
-                    images_data = ImageRequestData(description, count, size)
-                    image_urls = DALLEClient.generate_images(api_key, images_data)
-                    if image_urls:
-                        image_messages = [PictureMessage(media=url) for url in image_urls]
-                        viber.send_messages(user_id, image_messages)
-                        self._send_text_message(user_id, constants.HERE_ARE_YOUR_IMAGES_MESSAGE)
-                        self._set_chat_state(user_id, ChatState.MAIN)
-                        self._send_keyboard(user_id, keyboards.MAIN_KEYBOARD)
-                    else:
-                        self._send_text_message(user_id, constants.SOMETHING_WENT_WRONG_MESSAGE)
-                        self._send_keyboard(user_id, keyboards.IMAGE_SIZE_KEYBOARD)
-                else:
-                    self._handle_text_message_request(request)
-
-            elif message == keyboards.get_button_action(keyboards.TRANSCRIPT_MEDIA_BUTTON):
-                self._send_text_message(user_id, constants.MEDIA_FILE_REQUEST_MESSAGE)
-                self._send_keyboard(user_id, keyboards.CANCEL_KEYBOARD)
-                self._set_chat_state(user_id, ChatState.PROVIDING_MEDIA_FILE)
+                self._send_keyboard(session, outbound, keyboards.SET_API_KEY_KEYBOARD_ID)
+            session.chat_state = ChatState.MAIN
 
-            else:
-                self._send_text_message(user_id, "This feature is not supported yet.")
+    def _handle_cancel_button(self, request: ViberMessageRequest, session: UserSession, outbound: OutboundMessageBuffer):
+        if session.api_key:
+            self._send_keyboard(session, outbound, keyboards.MAIN_KEYBOARD_ID)
+        else:
+            self._send_keyboard(session, outbound, keyboards.SET_API_KEY_KEYBOARD_ID)
+        session.chat_state = ChatState.MAIN
+
+    def _handle_set_api_key_button(self, request: ViberMessageRequest, session: UserSession, outbound: OutboundMessageBuffer):
+        outbound.add_text(constants.PLEASE_SEND_API_KEY_MESSAGE)
+        self._send_keyboard(session, outbound, keyboards.CANCEL_KEYBOARD_ID)
+        session.chat_state = ChatState.PROVIDING_API_KEY
+
+    def _handle_start_chat_button(self, request: ViberMessageRequest, session: UserSession, outbound: OutboundMessageBuffer):
+        outbound.add_text(constants.ASSISTANT_ROLE_REQUEST_MESSAGE)
+        self._send_keyboard(session, outbound, keyboards.ASSISTANT_ROLES_KEYBOARD_ID)
+        session.chat_state = ChatState.SELECTING_ASSISTANT_ROLE
+
+    def _handle_assistant_role_button(self, request: ViberMessageRequest, session: UserSession, outbound: OutboundMessageBuffer):
+        assistant_role = keyboards.parse_assistant_role(request.message.text)
+        self._chat_sessions.start(request.sender.id, assistant_role)
+        outbound.add_text(constants.CHAT_STARTED_MESSAGE)
+        self._send_keyboard(session, outbound, keyboards.END_CHAT_KEYBOARD_ID)
+        session.chat_state = ChatState.HAVING_CONVERSATION_WITH_ASSISTANT
+
+    def _handle_end_chat_button(self, request: ViberMessageRequest, session: UserSession, outbound: OutboundMessageBuffer):
+        self._chat_sessions.end(request.sender.id)
+        outbound.add_text(constants.CHAT_ENDED_MESSAGE)
+        self._send_keyboard(session, outbound, keyboards.MAIN_KEYBOARD_ID)
+        session.chat_state = ChatState.MAIN
+
+    def _handle_generate_image_button(self, request: ViberMessageRequest, session: UserSession, outbound: OutboundMessageBuffer):
+        outbound.add_text(constants.IMAGE_DESCRIPTION_REQUEST_MESSAGE)
+        self._send_keyboard(session, outbound, keyboards.CANCEL_KEYBOARD_ID)
+        session.chat_state = ChatState.PROVIDING_IMAGES_DESCRIPTION
+
+    def _handle_images_count_button(self, request: ViberMessageRequest, session: UserSession, outbound: OutboundMessageBuffer):
+        session.img_count = keyboards.parse_images_count(request.message.text)
+        outbound.add_text(constants.IMAGE_SIZE_REQUEST_MESSAGE)
+        self._send_keyboard(session, outbound, keyboards.IMAGE_SIZE_KEYBOARD_ID)
+        session.chat_state = ChatState.SELECTING_IMAGES_SIZE
+
+    def _handle_images_size_button(self, request: ViberMessageRequest, session: UserSession, outbound: OutboundMessageBuffer):
+        metrics_registry.set_context(feature="image")
+        size = keyboards.parse_images_size(request.message.text)
+        count = session.img_count
+        description = session.img_description
+
+        outbound.add_text(constants.IMAGE_GENERATION_IN_PROGRESS_MESSAGE)
+        outbound.flush()
+        # persist pending changes before the long running generation call
+        session.flush()
+
+        def send_image(image_url: str):
+            outbound.add_messages([PictureMessage(media=image_url)])
+            outbound.flush()
+
+        generated_count = generate_images_concurrently(
+            self._image_executor, self._ai_clients, session.api_key, description, count, size, send_image, limiter=self._api_key_limiter
+        )
+        if generated_count:
+            if generated_count < count:
+                outbound.add_text(constants.SOME_IMAGES_FAILED_MESSAGE.format(failed=count - generated_count, count=count))
+            outbound.add_text(constants.HERE_ARE_YOUR_IMAGES_MESSAGE)
+            session.chat_state = ChatState.MAIN
+            self._send_keyboard(session, outbound, keyboards.MAIN_KEYBOARD_ID)
         else:
-            self._send_text_message(user_id, constants.SOMETHING_WENT_WRONG_MESSAGE + constants.API_KEY_REQUEST_MESSAGE)
-            self._send_keyboard(user_id, keyboards.SET_API_KEY_KEYBOARD)
-            self._set_chat_state(user_id, ChatState.MAIN)
+            outbound.add_text(constants.SOMETHING_WENT_WRONG_MESSAGE)
+            self._send_keyboard(session, outbound, keyboards.IMAGE_SIZE_KEYBOARD_ID)
+
+    def _handle_transcript_media_button(self, request: ViberMessageRequest, session: UserSession, outbound: OutboundMessageBuffer):
+        outbound.add_text(constants.MEDIA_FILE_REQUEST_MESSAGE)
+        self._send_keyboard(session, outbound, keyboards.CANCEL_KEYBOARD_ID)
+        session.chat_state = ChatState.PROVIDING_MEDIA_FILE
 
-    def _handle_file_message_request(self, request: ViberMessageRequest):
+    def _handle_file_message_request(self, request: ViberMessageRequest, session: UserSession, outbound: OutboundMessageBuffer):
         user_id = request.sender.id
         message = request.message
-        logger.info(f'_handle_file_message_request called for User {user_id}. Received file: {message.file_name} (size: {message.size} bytes) URL: {message.media}')
+        metrics_registry.set_context(feature="transcription")
+        logger.info(f'_handle_file_message_request called for User {user_id}. Received file of {message.size} bytes.', extra={"payload": message.media})
 
-        api_key = self._get_openai_api_key(user_id)
+        api_key = session.api_key
         if api_key:
-            chat_state = self._get_chat_state(user_id)
+            chat_state = session.chat_state
             if chat_state == ChatState.PROVIDING_MEDIA_FILE:
                 if is_media_file(message.file_name):
-                    file_extension = get_file_extension(message.file_name)[1]
-                    media_filename = f"user_media_{user_id}.{file_extension}"
                     try:
-                        download_file(message.media, media_filename)
-                        self._send_text_message(user_id, constants.TRANSCRIPTION_IN_PROGRESS_MESSAGE)
-                        transcription = WhisperClient.transcript_media_file(api_key, f"{media_filename}")
-                        if chat_state == ChatState.PROVIDING_MEDIA_FILE:
-                            self._send_text_message(user_id, transcription)
+                        with download_media(message.media, message.file_name, self._media_max_bytes,
+                                            self._media_spool_threshold, expected_size=message.size) as media_file:
+                            outbound.add_text(constants.TRANSCRIPTION_IN_PROGRESS_MESSAGE)
+                            outbound.flush()
+
+                            def transcribe(media) -> str:
+                                with metrics_registry.timer("openai", feature="transcription"):
+                                    return self._ai_clients.transcribe(api_key, media)
+
+                            def send_part(transcription: str):
+                                # the previous part goes out now and the last one stays buffered to carry the keyboard
+                                outbound.flush()
+                                outbound.add_text(transcription)
+
+                            # one limiter slot covers all segments of the file, taking one per segment would queue
+                            # the segments behind each other and time out in the middle of a long file
+                            with self._api_key_limiter.limit(api_key):
+                                self._transcription_pipeline.transcribe_file(media_file, transcribe, send_part)
+                    except FileTooLargeError:
+                        outbound.add_text(constants.FILE_TOO_LARGE_MESSAGE.format(max_size_mb=self._media_max_bytes // (1024 * 1024)))
+                    except RateLimitExceededError:
+                        outbound.add_text(constants.TOO_MANY_REQUESTS_MESSAGE)
                     except Exception:
-                        self._send_text_message(user_id, constants.FILE_DOWNLOADING_ERROR)
+                        outbound.add_text(constants.FILE_DOWNLOADING_ERROR)
 
-                    if os.path.exists(media_filename):
-                        os.remove(media_filename)
-
-                    self._send_keyboard(user_id, keyboards.MAIN_KEYBOARD)
+                    self._send_keyboard(session, outbound, keyboards.MAIN_KEYBOARD_ID)
                 else:
-                    self._send_text_message(user_id, constants.INCORRECT_FILE_TYPE_MESSAGE)
-                    self._send_keyboard(user_id, keyboards.CANCEL_KEYBOARD)
+                    outbound.add_text(constants.INCORRECT_FILE_TYPE_MESSAGE)
+                    self._send_keyboard(session, outbound, keyboards.CANCEL_KEYBOARD_ID)
         else:
-            self._send_text_message(user_id, constants.SOMETHING_WENT_WRONG_MESSAGE + constants.API_KEY_REQUEST_MESSAGE)
-            self._send_keyboard(user_id, keyboards.SET_API_KEY_KEYBOARD)
-
-        self._set_chat_state(user_id, ChatState.MAIN)
-
-app = Flask(__name__)
-viber = Api(BotConfiguration(
-    name='Your Smart Assistant',
-    avatar='',
-    auth_token=os.getenv(constants.VIBER_BOT_TOKEN_ENV)
-))
-bot = ViberBot()
-
-@app.route('/', methods=['POST'])
-def incoming():
-    logger.info("Received request. post data: {0}".format(request.get_data()))
-    # every viber message is signed, verify the signature
-    if not viber.verify_signature(request.get_data(), request.headers.get('X-Viber-Content-Signature')):
-        return Response(status=403)
+            outbound.add_text(constants.SOMETHING_WENT_WRONG_MESSAGE + constants.API_KEY_REQUEST_MESSAGE)
+            self._send_keyboard(session, outbound, keyboards.SET_API_KEY_KEYBOARD_ID)
+
+        session.chat_state = ChatState.MAIN
+
+def configure_logging(settings: Settings):
+    return setup_logging(
+        log_file=settings.get_str(constants.LOG_FILE_ENV, "viber_bot.log"),
+        level=settings.get_str(constants.LOG_LEVEL_ENV, "INFO"),
+        max_bytes=settings.get_int(constants.LOG_MAX_BYTES_ENV, 10 * 1024 * 1024),
+        backup_count=settings.get_int(constants.LOG_BACKUP_COUNT_ENV, 5),
+        rotation_when=settings.get_str(constants.LOG_ROTATION_WHEN_ENV, ""),
+        json_format=settings.get_bool(constants.LOG_JSON_ENV, True),
+        redact_payloads=settings.get_bool(constants.LOG_REDACT_PAYLOADS_ENV, True),
+        debug_sample_rate=settings.get_float(constants.LOG_DEBUG_SAMPLE_RATE_ENV, 0.01)
+    )
+
+def create_bot_configuration(settings: Settings) -> BotConfiguration:
+    return BotConfiguration(
+        name='Your Smart Assistant',
+        avatar='',
+        auth_token=settings.get_str(constants.VIBER_BOT_TOKEN_ENV, None)
+    )
+
+def create_user_data_db(settings: Settings) -> UserDataDatabaseService:
+    db_encryption_key = settings.get_str(constants.API_KEYS_DB_ENCRYPTION_KEY_ENV, None)
+    if not db_encryption_key:
+        logger.error("API_KEYS_DB_ENCRYPTION_KEY_ENV was not found in environment variables")
+    return UserDataDatabaseService(
+        db_encryption_key,
+        settings.get_str(constants.USER_DATA_DB_ENV, "user_data.db"),
+        pool_size=settings.get_int(constants.DB_POOL_SIZE_ENV, 4),
+        synchronous=settings.get_str(constants.DB_SYNCHRONOUS_ENV, "NORMAL"),
+        cache_size=settings.get_int(constants.DB_CACHE_SIZE_ENV, -8000),
+        mmap_size=settings.get_int(constants.DB_MMAP_SIZE_ENV, 0),
+        api_key_cache_size=settings.get_int(constants.API_KEY_CACHE_SIZE_ENV, 1024) if settings.get_bool(constants.API_KEY_CACHE_ENABLED_ENV, True) else 0,
+        api_key_cache_ttl=settings.get_float(constants.API_KEY_CACHE_TTL_ENV, 600.0)
+    )
+
+class BotWorker:
+    # Resources which own connections, locks or threads, every worker process creates its own set.
+    def __init__(self, settings: Settings, bot_configuration: BotConfiguration, viber_api: Api, ai_clients: AIClients,
+                 user_data_db_factory: Callable[[Settings], UserDataDatabaseService]):
+        started_at = time.perf_counter()
+        self.pid = os.getpid()
+        # the log listener is a thread as well, so logging is configured in the worker
+        self.log_listener = configure_logging(settings)
+        self.message_sender = ViberMessageSender(
+            bot_configuration,
+            api_url=settings.get_str(constants.VIBER_API_URL_ENV, VIBER_BOT_API_URL),
+            rate_limiter=TokenBucket(settings.get_float(constants.VIBER_SEND_RATE_PER_SECOND_ENV, 25.0)),
+            pool_size=settings.get_int(constants.WEBHOOK_WORKERS_ENV, 4)
+        )
+        self.bot = ViberBot(settings, viber_api, self.message_sender, user_data_db_factory(settings), ai_clients)
+        job_lease_seconds = settings.get_float(constants.JOB_LEASE_SECONDS_ENV, 60.0)
+        self.job_queue = JobQueueDatabaseService(
+            settings.get_str(constants.JOB_QUEUE_DB_ENV, "jobs.db"),
+            lease_seconds=job_lease_seconds,
+            max_attempts=settings.get_int(constants.JOB_MAX_ATTEMPTS_ENV, 3)
+        )
+        self.request_dispatcher = DurableRequestDispatcher(
+            self.job_queue,
+            self.bot.handle_request,
+            settings.get_int(constants.WEBHOOK_WORKERS_ENV, 4),
+            max_backlog=settings.get_int(constants.JOB_MAX_BACKLOG_ENV, 64),
+            retention_seconds=settings.get_float(constants.JOB_RETENTION_SECONDS_ENV, 3600.0),
+            lease_seconds=job_lease_seconds
+        )
+        atexit.register(self.request_dispatcher.shutdown)
+        self.message_deduplicator = MessageDeduplicator(
+            settings.get_float(constants.DEDUP_WINDOW_SECONDS_ENV, 3600.0),
+            settings.get_int(constants.DEDUP_MAX_SIZE_ENV, 10000),
+            MessageDedupDatabaseService(settings.get_str(constants.DEDUP_DB_ENV, "message_dedup.db")) if settings.get_bool(constants.DEDUP_PERSISTENT_ENV, False) else None
+        )
+        self.profiler = SamplingProfiler(settings.get_float(constants.PROFILER_INTERVAL_ENV, 0.01)) if settings.get_bool(constants.PROFILER_ENABLED_ENV, False) else None
+        self.init_seconds = time.perf_counter() - started_at
+        self.import_to_first_request_seconds = None
+
+    def record_request_served(self):
+        if self.import_to_first_request_seconds is not None:
+            return
+        # a lost race only writes a slightly later time
+        self.import_to_first_request_seconds = time.perf_counter() - _IMPORT_STARTED_AT
+        metrics_registry.observe_stage("import_to_first_request", self.import_to_first_request_seconds, feature="startup")
+        logger.info(f"Worker {self.pid} served its first request {self.import_to_first_request_seconds:.3f} s after bot was imported.")
+
+class BotWorkerProvider:
+    # A pre-forking server creates the app in the master process, the worker resources are created in the process
+    # which serves the requests, by the post_worker_init hook in gunicorn.conf.py or else on first use.
+    # Resources inherited through fork are dropped in the child.
+    def __init__(self, create_worker: Callable[[], BotWorker]):
+        self._create_worker = create_worker
+        self._lock = threading.Lock()
+        self._worker = None
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._worker = None
+
+    @property
+    def initialized(self) -> bool:
+        return self._worker is not None
+
+    def get(self) -> BotWorker:
+        worker = self._worker
+        if worker is None:
+            with self._lock:
+                if self._worker is None:
+                    self._worker = self._create_worker()
+                worker = self._worker
+        return worker
+
+def create_app(config: dict | None = None, viber_api: Api | None = None, ai_clients: AIClients | None = None,
+               user_data_db_factory: Callable[[Settings], UserDataDatabaseService] | None = None) -> Flask:
+    started_at = time.perf_counter()
+    settings = Settings(config)
+    metrics_registry.enabled = settings.get_bool(constants.METRICS_ENABLED_ENV, True)
+    bot_configuration = create_bot_configuration(settings)
+    viber_api = viber_api or Api(bot_configuration)
+    ai_clients = ai_clients or AIClients()
+    workers = BotWorkerProvider(
+        lambda: BotWorker(settings, bot_configuration, viber_api, ai_clients, user_data_db_factory or create_user_data_db)
+    )
+
+    app = Flask(__name__)
+    # servers call app.extensions["viber_bot"].get() to start the worker before its first request, see gunicorn.conf.py
+    app.extensions["viber_bot"] = workers
+    admin_token = settings.get_str(constants.ADMIN_TOKEN_ENV, None)
+    create_app_seconds = time.perf_counter() - started_at
+
+    def admin_only(view):
+        @functools.wraps(view)
+        def view_if_authorized(*args, **kwargs):
+            # the app is public for the webhook, unauthorized requests get the same answer as unknown paths
+            if not is_admin_request(admin_token, request.headers.get('Authorization')):
+                return Response(status=404)
+            return view(*args, **kwargs)
+        return view_if_authorized
+
+    @app.route('/', methods=['POST'])
+    def incoming():
+        worker = workers.get()
+        request_data = request.get_data()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received request.", extra={"payload": request_data.decode("utf-8", errors="replace")})
+        # every viber message is signed, verify the signature
+        with metrics_registry.timer("verify_signature", feature="webhook"):
+            signature_valid = viber_api.verify_signature(request_data, request.headers.get('X-Viber-Content-Signature'))
+        if not signature_valid:
+            return Response(status=403)
+
+        routing_info = get_request_routing_info(request_data)
+        # viber redelivers callbacks which were not acknowledged in time, they must not be handled twice
+        if worker.message_deduplicator.is_duplicate(routing_info.event, routing_info.message_token):
+            logger.info(f"Dropped duplicate {routing_info.event} callback with message token {routing_info.message_token}.")
+            return Response(status=200)
+
+        # the request is persisted before acknowledging, requests of the same user are processed in order
+        try:
+            worker.request_dispatcher.submit(routing_info.user_id, request_data)
+        except Exception:
+            # the callback is not acknowledged, its redelivery must not be dropped as a duplicate
+            worker.message_deduplicator.forget(routing_info.event, routing_info.message_token)
+            raise
+        worker.record_request_served()
+
+        return Response(status=200)
+
+    @app.route('/stats', methods=['GET'])
+    @admin_only
+    def stats():
+        worker = workers.get()
+        bot = worker.bot
+        stats = worker.request_dispatcher.stats()
+        stats["deduplication"] = worker.message_deduplicator.stats()
+        stats["chat_sessions"] = bot.chat_sessions.stats()
+        stats["context_window"] = bot.context_window.stats()
+        stats["streaming"] = bot.streaming_stats.stats()
+        stats["api_key_limiter"] = bot.api_key_limiter.stats()
+        stats["transitions"] = bot.dispatcher.stats()
+        if bot.response_cache is not None:
+            stats["response_cache"] = bot.response_cache.stats()
+        api_key_cache_stats = bot.user_data_db.api_key_cache_stats()
+        if api_key_cache_stats is not None:
+            stats["api_key_cache"] = api_key_cache_stats
+        stats["startup"] = {
+            "pid": worker.pid,
+            "import_seconds": _IMPORT_SECONDS,
+            "create_app_seconds": create_app_seconds,
+            "worker_init_seconds": worker.init_seconds,
+            "import_to_first_request_seconds": worker.import_to_first_request_seconds,
+            "lazy_imports_seconds": lazy_import_stats()
+        }
+        return jsonify(stats)
+
+    @app.route('/metrics', methods=['GET'])
+    @admin_only
+    def metrics():
+        return Response(metrics_registry.render(), mimetype="text/plain; version=0.0.4")
+
+    if settings.get_bool(constants.PROFILER_ENABLED_ENV, False):
+        @app.route('/debug/profiler', methods=['GET', 'POST'])
+        @admin_only
+        def profiler_control():
+            profiler = workers.get().profiler
+            # POST ?enabled=true|false starts or stops sampling, GET returns the collapsed stacks collected so far
+            if request.method == 'POST':
+                if request.args.get('enabled', 'true').lower() in ('1', 'true', 'yes', 'on'):
+                    profiler.reset()
+                    profiler.start()
+                else:
+                    profiler.stop()
+                return jsonify({"running": profiler.is_running})
+            return Response(profiler.render_collapsed(), mimetype="text/plain")
 
-    bot.handle_request(request.get_data())
+    return app
 
-    return Response(status=200)
+_IMPORT_SECONDS = time.perf_counter() - _IMPORT_STARTED_AT
 
 if __name__ == "__main__":
+    app = create_app()
+    # jobs left in the queue by a previous run are processed right away, not after the next webhook
+    app.extensions["viber_bot"].get()
     app.run(port='8087')
@@ -0,0 +1,517 @@
+import time
+_IMPORT_STARTED_AT = time.perf_counter()
+
+import asyncio
+import contextvars
+import inspect
+import json
+import logging
+import os
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import AsyncIterator, Callable
+from urllib.parse import parse_qs
+
+import aiohttp
+
+import constants
+import keyboards
+from ai_clients import AsyncAIClients, ONE_SHOT_MAX_TOKENS, ONE_SHOT_MODEL, lazy_import_stats
+from async_http import AsyncOutboundMessageBuffer, AsyncViberMessageSender, download_media_async
+from bot import ViberBot, configure_logging, create_bot_configuration, create_user_data_db
+from chat_state import ChatState
+from context_window import count_tokens
+from DBService.db_service import UserDataDatabaseService
+from DBService.job_queue_service import JobQueueDatabaseService
+from DBService.message_dedup_service import MessageDedupDatabaseService
+from api_key_limiter import RateLimitExceededError
+from image_generation import generate_images_async
+from message_deduplicator import MessageDeduplicator
+from metrics import SamplingProfiler, metrics_registry
+from rate_limiter import TokenBucket
+from request_dispatcher import AsyncRequestDispatcher, get_request_routing_info
+from response_cache import make_cache_key
+from text_chunking import StreamChunker
+from user_session import UserSession
+from utils import FileTooLargeError, Settings, is_admin_request, is_media_file
+
+from viberbot import Api
+from viberbot.api.bot_configuration import BotConfiguration
+from viberbot.api.consts import VIBER_BOT_API_URL
+from viberbot.api.messages.picture_message import PictureMessage
+from viberbot.api.viber_requests import ViberMessageRequest
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncViberBot(ViberBot):
+    # Runs the ViberBot handlers on asyncio. Handlers which only change the session run on the small db executor
+    # together with their SQLite access, handlers which call OpenAI or download media are coroutines on the event loop.
+    def __init__(self, settings: Settings, viber_api: Api, message_sender: AsyncViberMessageSender,
+                 user_data_db: UserDataDatabaseService, ai_clients: AsyncAIClients, db_executor: Executor,
+                 media_session: aiohttp.ClientSession):
+        super().__init__(settings, viber_api, message_sender, user_data_db, ai_clients)
+        self._db_executor = db_executor
+        self._media_session = media_session
+
+    async def _run_db(self, function, *args):
+        # the context is copied so sqlite timings keep the metric labels of the request
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self._db_executor, context.run, function, *args)
+
+    async def handle_request_async(self, request_data: bytes):
+        try:
+            with metrics_registry.timer("handle_request"):
+                await self._handle_request_async(request_data)
+            metrics_registry.count_request()
+        finally:
+            metrics_registry.clear_context()
+
+    async def _handle_request_async(self, request_data: bytes):
+        viber_request = self._parse_request(request_data)
+        user_id = self._get_session_user_id(viber_request)
+        if user_id is None:
+            await self._run_db(self._handle_sessionless_request, viber_request)
+            return
+
+        session = await self._run_db(UserSession, self._user_data_db, user_id)
+        outbound = AsyncOutboundMessageBuffer(self._message_sender, user_id)
+        self._set_metrics_context(session)
+        try:
+            result = await self._run_db(self._route_request, viber_request, session, outbound)
+            if inspect.isawaitable(result):
+                await result
+        except RateLimitExceededError as e:
+            self._handle_rate_limit_exceeded(e, session, outbound)
+        finally:
+            try:
+                await outbound.flush()
+            finally:
+                await self._run_db(session.flush)
+
+    async def _send_streamed_answer_async(self, outbound: AsyncOutboundMessageBuffer, answer_deltas: AsyncIterator[str]) -> str:
+        chunks = []
+        chunker = StreamChunker(
+            chunks.append,
+            min_chunk_size=self._stream_min_chunk_size,
+            flush_interval=self._stream_flush_interval,
+            stats=self._streaming_stats
+        )
+        answer = []
+        async for delta in answer_deltas:
+            answer.append(delta)
+            chunker.feed(delta)
+            if chunks:
+                for chunk in chunks:
+                    outbound.add_text(chunk)
+                chunks.clear()
+                await outbound.flush()
+        # the last part stays buffered so the keyboard is attached to it
+        for chunk in chunker.finish():
+            outbound.add_text(chunk)
+        return "".join(answer)
+
+    async def _answer_question_async(self, outbound: AsyncOutboundMessageBuffer, api_key: str, question: str):
+        async def ask() -> str:
+            async with self._api_key_limiter.limit_async(api_key, count_tokens(question) + ONE_SHOT_MAX_TOKENS):
+                with metrics_registry.timer("openai"):
+                    if self._streaming_enabled:
+                        return await self._send_streamed_answer_async(outbound, self._ai_clients.stream_question(api_key, question))
+                    answer = await self._ai_clients.ask_question(api_key, question)
+                    outbound.add_text(answer)
+                    return answer
+
+        if self._response_cache is None:
+            await ask()
+            return
+
+        cache_key = make_cache_key(api_key, question, {"model": ONE_SHOT_MODEL, "max_tokens": ONE_SHOT_MAX_TOKENS})
+        answer, computed = await self._response_cache.get_or_compute_async(cache_key, ask)
+        if not computed:
+            outbound.add_text(answer)
+
+    async def _handle_question(self, request: ViberMessageRequest, session: UserSession, outbound: AsyncOutboundMessageBuffer):
+        metrics_registry.set_context(feature="one_shot")
+        api_key = session.api_key
+        if api_key:
+            outbound.add_text(constants.ASSISTANT_IS_ANSWERING_MESSAGE)
+            await outbound.flush()
+            await self._answer_question_async(outbound, api_key, request.message.text)
+            self._send_keyboard(session, outbound, keyboards.MAIN_KEYBOARD_ID)
+        else:
+            outbound.add_text(constants.API_KEY_REQUEST_MESSAGE)
+            self._send_keyboard(session, outbound, keyboards.SET_API_KEY_KEYBOARD_ID)
+
+    async def _handle_chat_message(self, request: ViberMessageRequest, session: UserSession, outbound: AsyncOutboundMessageBuffer):
+        metrics_registry.set_context(feature="chat")
+        user_id = request.sender.id
+        message = request.message.text
+        api_key = session.api_key
+        assistant_chat = await self._run_db(self._chat_sessions.get, user_id)
+        if assistant_chat:
+            outbound.add_text(constants.ASSISTANT_IS_ANSWERING_MESSAGE)
+            await outbound.flush()
+            prompt_tokens = min(assistant_chat.prompt_tokens + count_tokens(message), self._context_window.token_budget)
+            async with self._api_key_limiter.limit_async(api_key, prompt_tokens):
+                with metrics_registry.timer("openai"):
+                    if self._streaming_enabled:
+                        await self._send_streamed_answer_async(
+                            outbound, assistant_chat.ask_stream_async(self._ai_clients, api_key, message, self._context_window)
+                        )
+                    else:
+                        outbound.add_text(await assistant_chat.ask_async(self._ai_clients, api_key, message, self._context_window))
+                    await self._run_db(self._chat_sessions.save, user_id, assistant_chat)
+            self._send_keyboard(session, outbound, keyboards.END_CHAT_KEYBOARD_ID)
+        else:
+            outbound.add_text(constants.CHAT_SESSION_NOT_FOUND_MESSAGE)
+            self._send_keyboard(session, outbound, keyboards.MAIN_KEYBOARD_ID)
+            session.chat_state = ChatState.MAIN
+
+    async def _handle_images_size_button(self, request: ViberMessageRequest, session: UserSession, outbound: AsyncOutboundMessageBuffer):
+        metrics_registry.set_context(feature="image")
+        size = keyboards.parse_images_size(request.message.text)
+        count = session.img_count
+        description = session.img_description
+
+        outbound.add_text(constants.IMAGE_GENERATION_IN_PROGRESS_MESSAGE)
+        await outbound.flush()
+        # persist pending changes before the long running generation call
+        await self._run_db(session.flush)
+
+        async def send_image(image_url: str):
+            outbound.add_messages([PictureMessage(media=image_url)])
+            await outbound.flush()
+
+        generated_count = await generate_images_async(
+            self._ai_clients, session.api_key, description, count, size, send_image, limiter=self._api_key_limiter
+        )
+        if generated_count:
+            if generated_count < count:
+                outbound.add_text(constants.SOME_IMAGES_FAILED_MESSAGE.format(failed=count - generated_count, count=count))
+            outbound.add_text(constants.HERE_ARE_YOUR_IMAGES_MESSAGE)
+            session.chat_state = ChatState.MAIN
+            self._send_keyboard(session, outbound, keyboards.MAIN_KEYBOARD_ID)
+        else:
+            outbound.add_text(constants.SOMETHING_WENT_WRONG_MESSAGE)
+            self._send_keyboard(session, outbound, keyboards.IMAGE_SIZE_KEYBOARD_ID)
+
+    async def _handle_file_message_request(self, request: ViberMessageRequest, session: UserSession, outbound: AsyncOutboundMessageBuffer):
+        user_id = request.sender.id
+        message = request.message
+        metrics_registry.set_context(feature="transcription")
+        logger.info(f'_handle_file_message_request called for User {user_id}. Received file of {message.size} bytes.', extra={"payload": message.media})
+
+        api_key = session.api_key
+        if api_key:
+            chat_state = session.chat_state
+            if chat_state == ChatState.PROVIDING_MEDIA_FILE:
+                if is_media_file(message.file_name):
+                    try:
+                        media_file = await download_media_async(self._media_session, message.media, message.file_name, self._media_max_bytes,
+                                                                self._media_spool_threshold, expected_size=message.size)
+                        with media_file:
+                            outbound.add_text(constants.TRANSCRIPTION_IN_PROGRESS_MESSAGE)
+                            await outbound.flush()
+
+                            async def transcribe(media) -> str:
+                                with metrics_registry.timer("openai", feature="transcription"):
+                                    return await self._ai_clients.transcribe(api_key, media)
+
+                            async def send_part(transcription: str):
+                                # the previous part goes out now and the last one stays buffered to carry the keyboard
+                                await outbound.flush()
+                                outbound.add_text(transcription)
+
+                            # one limiter slot covers all segments of the file, as in ViberBot
+                            async with self._api_key_limiter.limit_async(api_key):
+                                await self._transcription_pipeline.transcribe_file_async(media_file, transcribe, send_part)
+                    except FileTooLargeError:
+                        outbound.add_text(constants.FILE_TOO_LARGE_MESSAGE.format(max_size_mb=self._media_max_bytes // (1024 * 1024)))
+                    except RateLimitExceededError:
+                        outbound.add_text(constants.TOO_MANY_REQUESTS_MESSAGE)
+                    except Exception:
+                        outbound.add_text(constants.FILE_DOWNLOADING_ERROR)
+
+                    self._send_keyboard(session, outbound, keyboards.MAIN_KEYBOARD_ID)
+                else:
+                    outbound.add_text(constants.INCORRECT_FILE_TYPE_MESSAGE)
+                    self._send_keyboard(session, outbound, keyboards.CANCEL_KEYBOARD_ID)
+        else:
+            outbound.add_text(constants.SOMETHING_WENT_WRONG_MESSAGE + constants.API_KEY_REQUEST_MESSAGE)
+            self._send_keyboard(session, outbound, keyboards.SET_API_KEY_KEYBOARD_ID)
+
+        session.chat_state = ChatState.MAIN
+
+class AsyncBotWorker:
+    # Resources of one ASGI worker process, they are created inside its event loop.
+    def __init__(self, settings: Settings, bot_configuration: BotConfiguration, viber_api: Api, ai_clients: AsyncAIClients,
+                 user_data_db_factory: Callable[[Settings], UserDataDatabaseService]):
+        self._settings = settings
+        self._bot_configuration = bot_configuration
+        self._viber_api = viber_api
+        self._ai_clients = ai_clients
+        self._user_data_db_factory = user_data_db_factory
+        self.pid = os.getpid()
+        self.init_seconds = None
+        self.import_to_first_request_seconds = None
+
+    async def start(self):
+        started_at = time.perf_counter()
+        settings = self._settings
+        loop = asyncio.get_running_loop()
+        self.log_listener = configure_logging(settings)
+        # every SQLite call goes through this executor, the event loop never waits on the database
+        self.db_executor = ThreadPoolExecutor(settings.get_int(constants.DB_EXECUTOR_WORKERS_ENV, 4), thread_name_prefix="sqlite")
+        http_pool_size = settings.get_int(constants.ASGI_HTTP_POOL_SIZE_ENV, 100)
+        self.message_sender = AsyncViberMessageSender(
+            self._bot_configuration,
+            api_url=settings.get_str(constants.VIBER_API_URL_ENV, VIBER_BOT_API_URL),
+            rate_limiter=TokenBucket(settings.get_float(constants.VIBER_SEND_RATE_PER_SECOND_ENV, 25.0)),
+            pool_size=http_pool_size
+        )
+        # media is downloaded with its own session, the Viber auth token must not be sent to media hosts
+        self.media_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=http_pool_size))
+        user_data_db = await loop.run_in_executor(self.db_executor, self._user_data_db_factory, settings)
+        self.bot = AsyncViberBot(settings, self._viber_api, self.message_sender, user_data_db, self._ai_clients,
+                                 self.db_executor, self.media_session)
+
+        job_lease_seconds = settings.get_float(constants.JOB_LEASE_SECONDS_ENV, 60.0)
+        self.job_queue = await loop.run_in_executor(self.db_executor, lambda: JobQueueDatabaseService(
+            settings.get_str(constants.JOB_QUEUE_DB_ENV, "jobs.db"),
+            lease_seconds=job_lease_seconds,
+            max_attempts=settings.get_int(constants.JOB_MAX_ATTEMPTS_ENV, 3)
+        ))
+        self.request_dispatcher = AsyncRequestDispatcher(
+            self.job_queue,
+            self.bot.handle_request_async,
+            self.db_executor,
+            max_in_flight=settings.get_int(constants.ASGI_MAX_IN_FLIGHT_JOBS_ENV, 1000),
+            retention_seconds=settings.get_float(constants.JOB_RETENTION_SECONDS_ENV, 3600.0),
+            lease_seconds=job_lease_seconds
+        )
+        await self.request_dispatcher.start()
+
+        dedup_db = None
+        if settings.get_bool(constants.DEDUP_PERSISTENT_ENV, False):
+            dedup_db = await loop.run_in_executor(
+                self.db_executor, MessageDedupDatabaseService, settings.get_str(constants.DEDUP_DB_ENV, "message_dedup.db")
+            )
+        self._dedup_persistent = dedup_db is not None
+        self.message_deduplicator = MessageDeduplicator(
+            settings.get_float(constants.DEDUP_WINDOW_SECONDS_ENV, 3600.0),
+            settings.get_int(constants.DEDUP_MAX_SIZE_ENV, 10000),
+            dedup_db
+        )
+        self.profiler = SamplingProfiler(settings.get_float(constants.PROFILER_INTERVAL_ENV, 0.01)) if settings.get_bool(constants.PROFILER_ENABLED_ENV, False) else None
+        self.init_seconds = time.perf_counter() - started_at
+
+    async def is_duplicate(self, event: str | None, message_token) -> bool:
+        if self._dedup_persistent:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.db_executor, self.message_deduplicator.is_duplicate, event, message_token
+            )
+        return self.message_deduplicator.is_duplicate(event, message_token)
+
+    async def forget_message(self, event: str | None, message_token):
+        if self._dedup_persistent:
+            await asyncio.get_running_loop().run_in_executor(
+                self.db_executor, self.message_deduplicator.forget, event, message_token
+            )
+            return
+        self.message_deduplicator.forget(event, message_token)
+
+    def record_request_served(self):
+        if self.import_to_first_request_seconds is not None:
+            return
+        self.import_to_first_request_seconds = time.perf_counter() - _IMPORT_STARTED_AT
+        metrics_registry.observe_stage("import_to_first_request", self.import_to_first_request_seconds, feature="startup")
+        logger.info(f"Worker {self.pid} served its first request {self.import_to_first_request_seconds:.3f} s after bot_asgi was imported.")
+
+    async def close(self):
+        await self.request_dispatcher.shutdown(timeout=30.0)
+        await self.message_sender.close()
+        await self.media_session.close()
+        await self._ai_clients.close()
+        self.db_executor.shutdown(wait=True)
+        self.log_listener.stop()
+
+async def _read_body(receive) -> bytes:
+    body = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        body.append(message.get("body", b""))
+        more_body = message.get("more_body", False)
+    return b"".join(body)
+
+async def _send_response(send, status: int, body: bytes = b"", content_type: str = "text/plain"):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())]
+    })
+    await send({"type": "http.response.body", "body": body})
+
+def _json_body(value) -> bytes:
+    return json.dumps(value).encode()
+
+class ViberBotAsgiApp:
+    # ASGI application serving the same routes as the Flask app of bot.py.
+    def __init__(self, settings: Settings, viber_api: Api, bot_configuration: BotConfiguration, ai_clients: AsyncAIClients,
+                 user_data_db_factory: Callable[[Settings], UserDataDatabaseService], create_app_seconds: float):
+        self._settings = settings
+        self._viber_api = viber_api
+        self._bot_configuration = bot_configuration
+        self._ai_clients = ai_clients
+        self._user_data_db_factory = user_data_db_factory
+        self._create_app_seconds = create_app_seconds
+        self._profiler_enabled = settings.get_bool(constants.PROFILER_ENABLED_ENV, False)
+        self._admin_token = settings.get_str(constants.ADMIN_TOKEN_ENV, None)
+        self._worker = None
+        self._worker_lock = None
+
+    async def get_worker(self) -> AsyncBotWorker:
+        # ASGI servers fork before they start the event loop, so the worker is always created in the serving process
+        if self._worker is None:
+            if self._worker_lock is None:
+                self._worker_lock = asyncio.Lock()
+            async with self._worker_lock:
+                if self._worker is None:
+                    worker = AsyncBotWorker(self._settings, self._bot_configuration, self._viber_api, self._ai_clients,
+                                            self._user_data_db_factory)
+                    await worker.start()
+                    self._worker = worker
+        return self._worker
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._handle_lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._handle_http(scope, receive, send)
+
+    async def _handle_lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await self.get_worker()
+                except Exception as e:
+                    logger.exception("Failed to initialize the worker")
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self._worker is not None:
+                    await self._worker.close()
+                    self._worker = None
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _handle_http(self, scope, receive, send):
+        path, method = scope["path"], scope["method"]
+        routes = {"/": {"POST": self._incoming}}
+        # the app is public for the webhook, unauthorized requests get the same answer as unknown paths
+        authorization = dict(scope["headers"]).get(b"authorization")
+        if is_admin_request(self._admin_token, authorization.decode("latin-1") if authorization else None):
+            routes["/stats"] = {"GET": self._stats}
+            routes["/metrics"] = {"GET": self._metrics}
+            if self._profiler_enabled:
+                routes["/debug/profiler"] = {"GET": self._profiler_control, "POST": self._profiler_control}
+
+        methods = routes.get(path)
+        if methods is None:
+            await _send_response(send, 404)
+            return
+        route = methods.get(method)
+        if route is None:
+            await _send_response(send, 405)
+            return
+        await route(scope, await _read_body(receive), send)
+
+    async def _incoming(self, scope, request_data: bytes, send):
+        worker = await self.get_worker()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received request.", extra={"payload": request_data.decode("utf-8", errors="replace")})
+        headers = dict(scope["headers"])
+        signature = headers.get(b"x-viber-content-signature")
+        # every viber message is signed, verify the signature
+        with metrics_registry.timer("verify_signature", feature="webhook"):
+            signature_valid = self._viber_api.verify_signature(request_data, signature.decode() if signature else None)
+        if not signature_valid:
+            await _send_response(send, 403)
+            return
+
+        routing_info = get_request_routing_info(request_data)
+        # viber redelivers callbacks which were not acknowledged in time, they must not be handled twice
+        if await worker.is_duplicate(routing_info.event, routing_info.message_token):
+            logger.info(f"Dropped duplicate {routing_info.event} callback with message token {routing_info.message_token}.")
+            await _send_response(send, 200)
+            return
+
+        # the request is persisted before acknowledging, requests of the same user are processed in order
+        try:
+            await worker.request_dispatcher.submit(routing_info.user_id, request_data)
+        except Exception:
+            # the callback is not acknowledged, its redelivery must not be dropped as a duplicate
+            await worker.forget_message(routing_info.event, routing_info.message_token)
+            raise
+        worker.record_request_served()
+        await _send_response(send, 200)
+
+    async def _stats(self, scope, request_data: bytes, send):
+        worker = await self.get_worker()
+        bot = worker.bot
+        stats = await worker.request_dispatcher.stats()
+        stats["deduplication"] = worker.message_deduplicator.stats()
+        stats["chat_sessions"] = bot.chat_sessions.stats()
+        stats["context_window"] = bot.context_window.stats()
+        stats["streaming"] = bot.streaming_stats.stats()
+        stats["api_key_limiter"] = bot.api_key_limiter.stats()
+        stats["transitions"] = bot.dispatcher.stats()
+        if bot.response_cache is not None:
+            stats["response_cache"] = bot.response_cache.stats()
+        api_key_cache_stats = bot.user_data_db.api_key_cache_stats()
+        if api_key_cache_stats is not None:
+            stats["api_key_cache"] = api_key_cache_stats
+        stats["startup"] = {
+            "pid": worker.pid,
+            "import_seconds": _IMPORT_SECONDS,
+            "create_app_seconds": self._create_app_seconds,
+            "worker_init_seconds": worker.init_seconds,
+            "import_to_first_request_seconds": worker.import_to_first_request_seconds,
+            "lazy_imports_seconds": lazy_import_stats()
+        }
+        await _send_response(send, 200, _json_body(stats), "application/json")
+
+    async def _metrics(self, scope, request_data: bytes, send):
+        await _send_response(send, 200, metrics_registry.render().encode(), "text/plain; version=0.0.4")
+
+    async def _profiler_control(self, scope, request_data: bytes, send):
+        profiler = (await self.get_worker()).profiler
+        # POST ?enabled=true|false starts or stops sampling, GET returns the collapsed stacks collected so far
+        if scope["method"] == "POST":
+            enabled = parse_qs(scope.get("query_string", b"").decode()).get("enabled", ["true"])[0]
+            if enabled.lower() in ('1', 'true', 'yes', 'on'):
+                profiler.reset()
+                profiler.start()
+            else:
+                profiler.stop()
+            await _send_response(send, 200, _json_body({"running": profiler.is_running}), "application/json")
+            return
+        await _send_response(send, 200, profiler.render_collapsed().encode())
+
+def create_asgi_app(config: dict | None = None, viber_api: Api | None = None, ai_clients: AsyncAIClients | None = None,
+                    user_data_db_factory: Callable[[Settings], UserDataDatabaseService] | None = None) -> ViberBotAsgiApp:
+    started_at = time.perf_counter()
+    settings = Settings(config)
+    metrics_registry.enabled = settings.get_bool(constants.METRICS_ENABLED_ENV, True)
+    bot_configuration = create_bot_configuration(settings)
+    return ViberBotAsgiApp(
+        settings,
+        viber_api or Api(bot_configuration),
+        bot_configuration,
+        ai_clients or AsyncAIClients(settings.get_int(constants.ASGI_HTTP_POOL_SIZE_ENV, 100)),
+        user_data_db_factory or create_user_data_db,
+        time.perf_counter() - started_at
+    )
+
+_IMPORT_SECONDS = time.perf_counter() - _IMPORT_STARTED_AT
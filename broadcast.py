@@ -0,0 +1,226 @@
+import argparse
+import logging
+import math
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Iterator
+
+import constants
+from DBService.broadcast_service import BroadcastDatabaseService, BroadcastStatus
+from DBService.db_service import UserDataDatabaseService
+from rate_limiter import TokenBucket
+from text_chunking import split_text
+from utils import Settings
+from viber_sender import BROADCAST_MAX_RECIPIENTS, ViberMessageSender
+
+from viberbot.api.consts import VIBER_BOT_API_URL
+from viberbot.api.messages.text_message import TextMessage
+
+logger = logging.getLogger(__name__)
+
+# status of a failed_list entry for a receiver who is not subscribed to the bot
+RECEIVER_NOT_SUBSCRIBED_STATUS = 6
+
+def estimate_broadcast(user_data_db: UserDataDatabaseService, text: str, concurrency: int, rate_per_second: float,
+                       call_seconds: float, batch_size: int = BROADCAST_MAX_RECIPIENTS) -> dict:
+    recipients = user_data_db.count_subscribed_users()
+    batches = math.ceil(recipients / batch_size)
+    messages = len(split_text(text))
+    calls = batches * messages
+    # the messages of a batch are sent one after another, batches run in parallel up to the rate limit
+    estimated_seconds = max(calls / rate_per_second, math.ceil(batches / concurrency) * messages * call_seconds)
+    return {
+        "recipients": recipients,
+        "batches": batches,
+        "messages_per_batch": messages,
+        "calls": calls,
+        "estimated_seconds": estimated_seconds
+    }
+
+class Broadcaster:
+    # Sends an announcement to all subscribed users with the Viber broadcast API. User ids are paged out of the database
+    # in user id order and sent in batches of the maximum recipient count, several batches at a time.
+    def __init__(self, user_data_db: UserDataDatabaseService, broadcast_db: BroadcastDatabaseService, sender: ViberMessageSender,
+                 concurrency: int = 4, page_size: int = 3000, batch_size: int = BROADCAST_MAX_RECIPIENTS):
+        self._user_data_db = user_data_db
+        self._broadcast_db = broadcast_db
+        self._sender = sender
+        self._concurrency = concurrency
+        self._page_size = page_size
+        self._batch_size = min(batch_size, BROADCAST_MAX_RECIPIENTS)
+
+    def create(self, text: str) -> int:
+        return self._broadcast_db.create(text)
+
+    def _iter_batches(self, after_user_id: str | None) -> Iterator[list[str]]:
+        while True:
+            user_ids = self._user_data_db.get_subscribed_user_ids(after_user_id, self._page_size)
+            if not user_ids:
+                return
+            for start in range(0, len(user_ids), self._batch_size):
+                yield user_ids[start:start + self._batch_size]
+            after_user_id = user_ids[-1]
+
+    def _send_batch(self, receivers: list[str], messages: list) -> list[tuple[str, int | None, str | None]]:
+        try:
+            failed_list = self._sender.broadcast_messages(receivers, messages)
+        except Exception as e:
+            # the whole batch is recorded without a status and sent again when the broadcast is resumed
+            logger.warning(f"Broadcast batch of {len(receivers)} receivers starting at {receivers[0]} failed: {e}")
+            return [(receiver, None, str(e)) for receiver in receivers]
+
+        failures = {}
+        for entry in failed_list:
+            failures.setdefault(entry["receiver"], (entry["receiver"], entry.get("status"), entry.get("status_message")))
+        not_subscribed = [receiver for receiver, status, _ in failures.values() if status == RECEIVER_NOT_SUBSCRIBED_STATUS]
+        if not_subscribed:
+            self._user_data_db.mark_unsubscribed(not_subscribed)
+        return list(failures.values())
+
+    def _send_batches(self, batches: Iterator[list[str]], messages: list,
+                      on_batch_sent: Callable[[int, list[str], list[tuple[str, int | None, str | None]]], None]) -> int:
+        batches = enumerate(batches)
+        in_flight = {}
+        sent_batches_count = 0
+
+        with ThreadPoolExecutor(self._concurrency, thread_name_prefix="broadcast") as executor:
+            def submit_next() -> bool:
+                item = next(batches, None)
+                if item is None:
+                    return False
+                index, receivers = item
+                in_flight[executor.submit(self._send_batch, receivers, messages)] = (index, receivers)
+                return True
+
+            while len(in_flight) < self._concurrency and submit_next():
+                pass
+
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index, receivers = in_flight.pop(future)
+                    on_batch_sent(index, receivers, future.result())
+                    sent_batches_count += 1
+                    submit_next()
+        return sent_batches_count
+
+    def _resend_unsent(self, broadcast_id: int, messages: list) -> int:
+        receivers = self._broadcast_db.get_unsent_receivers(broadcast_id)
+        if not receivers:
+            return 0
+
+        logger.info(f"Broadcast {broadcast_id} sends again to {len(receivers)} receivers of failed batches.")
+        batches = (receivers[start:start + self._batch_size] for start in range(0, len(receivers), self._batch_size))
+        return self._send_batches(
+            batches, messages,
+            lambda index, batch_receivers, failures: self._broadcast_db.save_resent(broadcast_id, batch_receivers, failures)
+        )
+
+    def run(self, broadcast_id: int) -> dict:
+        broadcast = self._broadcast_db.load(broadcast_id)
+        if broadcast is None:
+            raise ValueError(f"Broadcast {broadcast_id} does not exist")
+
+        started_at = time.perf_counter()
+        batches_count = 0
+        if broadcast.status != BroadcastStatus.DONE:
+            messages = [TextMessage(text=chunk) for chunk in split_text(broadcast.text)]
+            # batches which failed as a whole in an earlier run are sent first, they are behind the checkpoint
+            batches_count += self._resend_unsent(broadcast_id, messages)
+
+            completed = {}
+            next_index = 0
+
+            def on_batch_sent(index: int, receivers: list[str], failures: list[tuple[str, int | None, str | None]]):
+                nonlocal next_index
+                completed[index] = (receivers[-1], len(receivers), failures)
+                # the checkpoint only moves over batches completed without a gap, so a resumed broadcast skips nobody.
+                # batches completed after the gap are sent again on resume.
+                checkpoint_user_id, sent_count, progress_failures = None, 0, []
+                while next_index in completed:
+                    last_user_id, receivers_count, batch_failures = completed.pop(next_index)
+                    checkpoint_user_id = last_user_id
+                    sent_count += receivers_count - len(batch_failures)
+                    progress_failures.extend(batch_failures)
+                    next_index += 1
+                if checkpoint_user_id is not None:
+                    self._broadcast_db.save_progress(broadcast_id, checkpoint_user_id, sent_count, progress_failures)
+                    logger.info(f"Broadcast {broadcast_id} reached user {checkpoint_user_id} after {next_index} batches.")
+
+            batches_count += self._send_batches(self._iter_batches(broadcast.checkpoint_user_id), messages, on_batch_sent)
+            # the broadcast stays running until the receivers of failed batches were sent to by a resumed run
+            unsent_count = len(self._broadcast_db.get_unsent_receivers(broadcast_id))
+            if unsent_count:
+                logger.warning(f"Broadcast {broadcast_id} could not be sent to {unsent_count} receivers, "
+                               f"send it to them with --resume {broadcast_id}.")
+            else:
+                self._broadcast_db.finish(broadcast_id)
+            broadcast = self._broadcast_db.load(broadcast_id)
+
+        return {
+            "broadcast_id": broadcast_id,
+            "status": broadcast.status.value,
+            "batches": batches_count,
+            "sent": broadcast.sent_count,
+            "failed": broadcast.failed_count,
+            "checkpoint_user_id": broadcast.checkpoint_user_id,
+            "elapsed_seconds": time.perf_counter() - started_at
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description="Broadcast an announcement to all subscribed users.")
+    parser.add_argument("text", nargs="?", help="text of the announcement")
+    parser.add_argument("--resume", type=int, metavar="ID", help="continue an interrupted broadcast from its checkpoint")
+    parser.add_argument("--dry-run", action="store_true", help="only report the batch count and the estimated duration")
+    parser.add_argument("--failures", type=int, metavar="ID", help="list the receivers a broadcast failed for")
+    parser.add_argument("--call-seconds", type=float, default=0.5, help="expected latency of one broadcast call for the estimate")
+    args = parser.parse_args()
+    if not args.text and args.resume is None and args.failures is None:
+        parser.error("text, --resume or --failures is required")
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    settings = Settings()
+    concurrency = settings.get_int(constants.BROADCAST_CONCURRENCY_ENV, 4)
+    rate_per_second = settings.get_float(constants.BROADCAST_RATE_PER_SECOND_ENV, 50.0)
+    # bot imports flask and the bot handlers, it is only needed for the database settings
+    from bot import create_bot_configuration, create_user_data_db
+    user_data_db = create_user_data_db(settings)
+    broadcast_db = BroadcastDatabaseService(settings.get_str(constants.BROADCAST_DB_ENV, "broadcasts.db"))
+
+    if args.failures is not None:
+        for user_id, status, status_message in broadcast_db.get_failures(args.failures):
+            print(f"{user_id}\t{status}\t{status_message}")
+        return
+
+    broadcast = broadcast_db.load(args.resume) if args.resume is not None else None
+    if args.resume is not None and broadcast is None:
+        parser.error(f"broadcast {args.resume} does not exist")
+
+    if args.dry_run:
+        text = args.text if broadcast is None else broadcast.text
+        estimate = estimate_broadcast(user_data_db, text, concurrency, rate_per_second, args.call_seconds)
+        print(f"Recipients: {estimate['recipients']}")
+        print(f"Batches: {estimate['batches']} of up to {BROADCAST_MAX_RECIPIENTS} recipients, "
+              f"{estimate['messages_per_batch']} messages each ({estimate['calls']} calls)")
+        print(f"Estimated duration: {estimate['estimated_seconds']:.1f} s at {rate_per_second} calls/s and concurrency {concurrency}")
+        return
+
+    sender = ViberMessageSender(
+        create_bot_configuration(settings),
+        api_url=settings.get_str(constants.VIBER_API_URL_ENV, VIBER_BOT_API_URL),
+        rate_limiter=TokenBucket(rate_per_second),
+        pool_size=concurrency
+    )
+    broadcaster = Broadcaster(
+        user_data_db, broadcast_db, sender,
+        concurrency=concurrency,
+        page_size=settings.get_int(constants.BROADCAST_PAGE_SIZE_ENV, 3000)
+    )
+    broadcast_id = args.resume if args.resume is not None else broadcaster.create(args.text)
+    print(f"Broadcast {broadcast_id} started, resume it with --resume {broadcast_id} if it is interrupted.")
+    result = broadcaster.run(broadcast_id)
+    print(f"Broadcast {broadcast_id} {result['status']}: {result['sent']} sent, {result['failed']} failed, "
+          f"{result['batches']} batches in {result['elapsed_seconds']:.1f} s")
+
+if __name__ == "__main__":
+    main()
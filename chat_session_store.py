@@ -0,0 +1,103 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from assistant_chat import AssistantChat
+from DBService.db_service import UserDataDatabaseService
+
+class ChatSessionStore:
+    def __init__(self, user_data_db: UserDataDatabaseService, max_sessions: int = 1000,
+                 max_memory_bytes: int = 64 * 1024 * 1024, idle_timeout: float = 1800.0):
+        self._user_data_db = user_data_db
+        self._max_sessions = max(1, max_sessions)
+        self._max_memory_bytes = max_memory_bytes
+        self._idle_timeout = idle_timeout
+        # user_id -> (chat, last used time, estimated size, persisted updated_at), ordered from least to most recently used
+        self._sessions = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._evictions = 0
+        self._rehydrations = 0
+        self._stale_reloads = 0
+
+    def start(self, user_id: str, assistant_role: str) -> AssistantChat:
+        chat = AssistantChat(assistant_role)
+        self.save(user_id, chat)
+        return chat
+
+    def get(self, user_id: str) -> AssistantChat | None:
+        with self._lock:
+            self._evict()
+            session = self._sessions.get(user_id)
+
+        if session is not None:
+            # another worker process may have saved or ended this chat since it was cached here
+            chat, _, size, updated_at = session
+            if self._user_data_db.get_chat_session_updated_at(user_id) == updated_at:
+                with self._lock:
+                    if self._sessions.get(user_id) is session:
+                        self._sessions[user_id] = (chat, time.monotonic(), size, updated_at)
+                        self._sessions.move_to_end(user_id)
+                return chat
+            with self._lock:
+                self._stale_reloads += 1
+                if self._sessions.get(user_id) is session:
+                    self._remove(user_id)
+
+        # evicted, stale and sessions of a previous process are restored from their persisted form
+        chat_session = self._user_data_db.load_chat_session(user_id)
+        if chat_session is None:
+            return None
+
+        chat_data, updated_at = chat_session
+        chat = AssistantChat.from_dict(json.loads(chat_data))
+        with self._lock:
+            self._rehydrations += 1
+            self._put(user_id, chat, updated_at)
+        return chat
+
+    def save(self, user_id: str, chat: AssistantChat):
+        updated_at = self._user_data_db.save_chat_session(user_id, json.dumps(chat.to_dict(), ensure_ascii=False))
+        with self._lock:
+            self._put(user_id, chat, updated_at)
+
+    def end(self, user_id: str):
+        with self._lock:
+            self._remove(user_id)
+        self._user_data_db.delete_chat_session(user_id)
+
+    def _put(self, user_id: str, chat: AssistantChat, updated_at: float):
+        self._remove(user_id)
+        size = chat.estimate_size()
+        self._sessions[user_id] = (chat, time.monotonic(), size, updated_at)
+        self._memory_bytes += size
+        self._evict()
+
+    def _remove(self, user_id: str):
+        session = self._sessions.pop(user_id, None)
+        if session is not None:
+            self._memory_bytes -= session[2]
+
+    def _evict(self):
+        # sessions are persisted on every change, so eviction only drops the in-memory copy
+        idle_deadline = time.monotonic() - self._idle_timeout
+        while self._sessions:
+            oldest_user_id, (_, last_used_time, _, _) = next(iter(self._sessions.items()))
+            is_idle = last_used_time < idle_deadline
+            over_limit = len(self._sessions) > self._max_sessions or \
+                (self._memory_bytes > self._max_memory_bytes and len(self._sessions) > 1)
+            if not is_idle and not over_limit:
+                return
+            self._remove(oldest_user_id)
+            self._evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "live_sessions": len(self._sessions),
+                "memory_bytes": self._memory_bytes,
+                "evictions": self._evictions,
+                "rehydrations": self._rehydrations,
+                "stale_reloads": self._stale_reloads
+            }
@@ -1,6 +1,79 @@
 # environment variables
 VIBER_BOT_TOKEN_ENV = "VIBER_BOT_TOKEN"
 API_KEYS_DB_ENCRYPTION_KEY_ENV = "API_KEYS_DB_ENCRYPTION_KEY"
+VIBER_API_URL_ENV = "VIBER_API_URL"
+VIBER_SEND_RATE_PER_SECOND_ENV = "VIBER_SEND_RATE_PER_SECOND"
+# logging
+LOG_FILE_ENV = "LOG_FILE"
+LOG_LEVEL_ENV = "LOG_LEVEL"
+LOG_MAX_BYTES_ENV = "LOG_MAX_BYTES"
+LOG_BACKUP_COUNT_ENV = "LOG_BACKUP_COUNT"
+LOG_ROTATION_WHEN_ENV = "LOG_ROTATION_WHEN"
+LOG_JSON_ENV = "LOG_JSON"
+LOG_REDACT_PAYLOADS_ENV = "LOG_REDACT_PAYLOADS"
+LOG_DEBUG_SAMPLE_RATE_ENV = "LOG_DEBUG_SAMPLE_RATE"
+# metrics and profiling
+METRICS_ENABLED_ENV = "METRICS_ENABLED"
+PROFILER_ENABLED_ENV = "PROFILER_ENABLED"
+PROFILER_INTERVAL_ENV = "PROFILER_INTERVAL"
+# bearer token for /stats, /metrics and /debug/profiler, they answer 404 without it
+ADMIN_TOKEN_ENV = "ADMIN_TOKEN"
+# user data database tuning
+USER_DATA_DB_ENV = "USER_DATA_DB"
+DB_POOL_SIZE_ENV = "DB_POOL_SIZE"
+DB_SYNCHRONOUS_ENV = "DB_SYNCHRONOUS"
+DB_CACHE_SIZE_ENV = "DB_CACHE_SIZE"
+DB_MMAP_SIZE_ENV = "DB_MMAP_SIZE"
+API_KEY_CACHE_ENABLED_ENV = "API_KEY_CACHE_ENABLED"
+API_KEY_CACHE_SIZE_ENV = "API_KEY_CACHE_SIZE"
+API_KEY_CACHE_TTL_ENV = "API_KEY_CACHE_TTL"
+# assistant chat sessions
+CHAT_SESSIONS_MAX_COUNT_ENV = "CHAT_SESSIONS_MAX_COUNT"
+CHAT_SESSIONS_MAX_MEMORY_BYTES_ENV = "CHAT_SESSIONS_MAX_MEMORY_BYTES"
+CHAT_SESSIONS_IDLE_TIMEOUT_ENV = "CHAT_SESSIONS_IDLE_TIMEOUT"
+CHAT_CONTEXT_TOKEN_BUDGET_ENV = "CHAT_CONTEXT_TOKEN_BUDGET"
+# streaming of assistant answers
+STREAMING_ENABLED_ENV = "STREAMING_ENABLED"
+STREAM_MIN_CHUNK_SIZE_ENV = "STREAM_MIN_CHUNK_SIZE"
+STREAM_FLUSH_INTERVAL_ENV = "STREAM_FLUSH_INTERVAL"
+# per API key limits of OpenAI requests
+OPENAI_REQUESTS_PER_MINUTE_ENV = "OPENAI_REQUESTS_PER_MINUTE"
+OPENAI_TOKENS_PER_MINUTE_ENV = "OPENAI_TOKENS_PER_MINUTE"
+OPENAI_MAX_IN_FLIGHT_ENV = "OPENAI_MAX_IN_FLIGHT"
+OPENAI_QUEUE_TIMEOUT_ENV = "OPENAI_QUEUE_TIMEOUT"
+# response cache for one-shot questions
+RESPONSE_CACHE_ENABLED_ENV = "RESPONSE_CACHE_ENABLED"
+RESPONSE_CACHE_SIZE_ENV = "RESPONSE_CACHE_SIZE"
+RESPONSE_CACHE_TTL_ENV = "RESPONSE_CACHE_TTL"
+# image generation
+IMAGE_GENERATION_WORKERS_ENV = "IMAGE_GENERATION_WORKERS"
+# media transcription
+TRANSCRIPTION_WORKERS_ENV = "TRANSCRIPTION_WORKERS"
+TRANSCRIPTION_SEGMENT_SECONDS_ENV = "TRANSCRIPTION_SEGMENT_SECONDS"
+TRANSCRIPTION_OVERLAP_SECONDS_ENV = "TRANSCRIPTION_OVERLAP_SECONDS"
+TRANSCRIPTION_SPLIT_THRESHOLD_BYTES_ENV = "TRANSCRIPTION_SPLIT_THRESHOLD_BYTES"
+MEDIA_MAX_BYTES_ENV = "MEDIA_MAX_BYTES"
+MEDIA_SPOOL_THRESHOLD_BYTES_ENV = "MEDIA_SPOOL_THRESHOLD_BYTES"
+# webhook processing
+WEBHOOK_WORKERS_ENV = "WEBHOOK_WORKERS"
+JOB_QUEUE_DB_ENV = "JOB_QUEUE_DB"
+JOB_LEASE_SECONDS_ENV = "JOB_LEASE_SECONDS"
+JOB_MAX_ATTEMPTS_ENV = "JOB_MAX_ATTEMPTS"
+JOB_MAX_BACKLOG_ENV = "JOB_MAX_BACKLOG"
+JOB_RETENTION_SECONDS_ENV = "JOB_RETENTION_SECONDS"
+DEDUP_WINDOW_SECONDS_ENV = "DEDUP_WINDOW_SECONDS"
+DEDUP_MAX_SIZE_ENV = "DEDUP_MAX_SIZE"
+DEDUP_PERSISTENT_ENV = "DEDUP_PERSISTENT"
+DEDUP_DB_ENV = "DEDUP_DB"
+# asyncio serving mode
+ASGI_MAX_IN_FLIGHT_JOBS_ENV = "ASGI_MAX_IN_FLIGHT_JOBS"
+ASGI_HTTP_POOL_SIZE_ENV = "ASGI_HTTP_POOL_SIZE"
+DB_EXECUTOR_WORKERS_ENV = "DB_EXECUTOR_WORKERS"
+# broadcasts
+BROADCAST_DB_ENV = "BROADCAST_DB"
+BROADCAST_CONCURRENCY_ENV = "BROADCAST_CONCURRENCY"
+BROADCAST_RATE_PER_SECOND_ENV = "BROADCAST_RATE_PER_SECOND"
+BROADCAST_PAGE_SIZE_ENV = "BROADCAST_PAGE_SIZE"
 
 # Predefinded messages
 BOT_MENU_HELP_MESSAGE = "For more details see Help section."
@@ -13,6 +86,7 @@ API_KEY_SET_SUCCESSFULLY_MESSAGE = "API key set successfully! Now you can use bo
 ASSISTANT_ROLE_REQUEST_MESSAGE = "Please select role of your assistant from the given list or send me your option."
 ASSISTANT_IS_ANSWERING_MESSAGE = "Assistant is answering on your message. Please wait..."
 CHAT_STARTED_MESSAGE = "Chat with your assistant has been started. Feel free to ask something 😊"
+CHAT_SESSION_NOT_FOUND_MESSAGE = "Your chat with assistant was not found. Please start a new one."
 CHAT_ENDED_MESSAGE = "Chat with your assistant has been ended. It was a pleasure to communicate with you 😊"
 # Image Generation
 IMAGE_DESCRIPTION_REQUEST_MESSAGE = "Please provide description of image which you want to generate."
@@ -20,14 +94,17 @@ IMAGE_COUNT_REQUEST_MESSAGE = "How much images do you want to generate?"
 IMAGE_SIZE_REQUEST_MESSAGE = "Please select images size."
 IMAGE_GENERATION_IN_PROGRESS_MESSAGE = "Images are generating at the moment. Please wait..."
 HERE_ARE_YOUR_IMAGES_MESSAGE = "Here are your images 😊"
+SOME_IMAGES_FAILED_MESSAGE = "{failed} of {count} images could not be generated 😢"
 # Media file transcription
 TRANSCRIPT_MEDIA_HELP = "If you want transcript some media file or voice message than use `Transcript Media` menu button and provide bot with voice message, audio or video file."
 MEDIA_FILE_REQUEST_MESSAGE = "Please provide media file which you want to transcript. It can be voice message, audio or video file.\nSupported formats: ['m4a', 'mp3', 'webm', 'mp4', 'mpga', 'wav', 'mpeg']"
 TRANSCRIPTION_IN_PROGRESS_MESSAGE = "Transcription in progress. Please wait..."
 FILE_DOWNLOADING_ERROR = "File downloading failed 😢. Please try again later."
+FILE_TOO_LARGE_MESSAGE = "Provided file is too large 😢. Maximum supported file size is {max_size_mb} MB."
 INCORRECT_FILE_TYPE_MESSAGE = "Provided file is not a media file. Please provide me with audio or video file with one of the next formats: ['m4a', 'mp3', 'webm', 'mp4', 'mpga', 'wav', 'mpeg']"
 # Errors
 SOMETHING_WENT_WRONG_MESSAGE = "Something went wrong."
+TOO_MANY_REQUESTS_MESSAGE = "You are sending too many requests at the moment ⏳. Please wait a bit and try again."
 TRY_AGAIN_MESSAGE = "An error occurred. Please try again."
 # Help
 HELP_MESSAGE = '''
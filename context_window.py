@@ -0,0 +1,67 @@
+import threading
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# every chat message costs a few tokens for its role and separators on top of its content
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_encoding = tiktoken.get_encoding("cl100k_base") if tiktoken else None
+
+def count_tokens(text: str) -> int:
+    if _encoding is not None:
+        return len(_encoding.encode(text)) + MESSAGE_OVERHEAD_TOKENS
+    # rough estimate of ~4 characters per token when tiktoken is not installed
+    return len(text) // 4 + 1 + MESSAGE_OVERHEAD_TOKENS
+
+class ContextWindow:
+    def __init__(self, token_budget: int = 3000):
+        self._token_budget = token_budget
+        self._lock = threading.Lock()
+        self._turns = 0
+        self._trimmed_messages = 0
+        self._prompt_tokens_total = 0
+        self._prompt_tokens_max = 0
+        self._last_prompt_tokens = 0
+        self._reported_prompt_tokens_total = 0
+
+    @property
+    def token_budget(self) -> int:
+        return self._token_budget
+
+    def fit(self, token_counts: list[int], pinned_count: int) -> int:
+        # Returns how many of the oldest unpinned messages have to be dropped so the prompt fits the budget.
+        # Pinned messages (the role prompt) and the latest message are always kept.
+        prompt_tokens = sum(token_counts)
+        first_droppable = pinned_count
+        while prompt_tokens > self._token_budget and first_droppable < len(token_counts) - 1:
+            prompt_tokens -= token_counts[first_droppable]
+            first_droppable += 1
+
+        dropped_count = first_droppable - pinned_count
+        with self._lock:
+            self._turns += 1
+            self._trimmed_messages += dropped_count
+            self._prompt_tokens_total += prompt_tokens
+            self._prompt_tokens_max = max(self._prompt_tokens_max, prompt_tokens)
+            self._last_prompt_tokens = prompt_tokens
+        return dropped_count
+
+    def report_usage(self, prompt_tokens: int):
+        with self._lock:
+            self._reported_prompt_tokens_total += prompt_tokens
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "token_budget": self._token_budget,
+                "turns": self._turns,
+                "trimmed_messages": self._trimmed_messages,
+                "prompt_tokens_avg": self._prompt_tokens_total / self._turns if self._turns else 0.0,
+                "prompt_tokens_max": self._prompt_tokens_max,
+                "last_prompt_tokens": self._last_prompt_tokens,
+                "estimated_prompt_tokens_total": self._prompt_tokens_total,
+                "reported_prompt_tokens_total": self._reported_prompt_tokens_total
+            }
@@ -0,0 +1,6 @@
+# gunicorn loads this file from the working directory
+
+def post_worker_init(worker):
+    # the bot worker of every process is started before its first request, so jobs left in jobs.db by a previous run
+    # or a crashed worker are processed without waiting for the next webhook
+    worker.wsgi.extensions["viber_bot"].get()
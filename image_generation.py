@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import Executor, as_completed
+from contextlib import nullcontext
+from typing import Awaitable, Callable
+
+from ai_clients import AIClients, AsyncAIClients
+from api_key_limiter import ApiKeyLimiter, RateLimitExceededError
+from metrics import metrics_registry
+
+logger = logging.getLogger(__name__)
+
+def _generate_single_image(ai_clients: AIClients, api_key: str, description: str, size: str, max_retries: int,
+                           backoff_seconds: float, limiter: ApiKeyLimiter | None) -> str | None:
+    for attempt in range(max_retries + 1):
+        try:
+            with limiter.limit(api_key) if limiter is not None else nullcontext():
+                with metrics_registry.timer("openai", feature="image"):
+                    image_urls = ai_clients.generate_image(api_key, description, size)
+            if image_urls:
+                return image_urls[0]
+        except RateLimitExceededError:
+            logger.warning("Image generation rejected by the API key limiter")
+            return None
+        except Exception:
+            logger.exception(f"Image generation attempt {attempt + 1} failed")
+        if attempt < max_retries:
+            time.sleep(backoff_seconds * 2 ** attempt)
+    return None
+
+def generate_images_concurrently(executor: Executor, ai_clients: AIClients, api_key: str, description: str, count: int, size: str,
+                                 on_image: Callable[[str], None], max_retries: int = 1, backoff_seconds: float = 1.0,
+                                 limiter: ApiKeyLimiter | None = None) -> int:
+    # every image is requested separately so finished ones can be delivered while the rest are still generating,
+    # on_image is called from the calling thread in completion order
+    futures = [
+        executor.submit(_generate_single_image, ai_clients, api_key, description, size, max_retries, backoff_seconds, limiter)
+        for _ in range(count)
+    ]
+
+    generated_count = 0
+    for future in as_completed(futures):
+        image_url = future.result()
+        if image_url:
+            generated_count += 1
+            on_image(image_url)
+    return generated_count
+
+async def _generate_single_image_async(ai_clients: AsyncAIClients, api_key: str, description: str, size: str, max_retries: int,
+                                       backoff_seconds: float, limiter: ApiKeyLimiter | None) -> str | None:
+    for attempt in range(max_retries + 1):
+        try:
+            if limiter is not None:
+                async with limiter.limit_async(api_key):
+                    with metrics_registry.timer("openai", feature="image"):
+                        image_urls = await ai_clients.generate_image(api_key, description, size)
+            else:
+                with metrics_registry.timer("openai", feature="image"):
+                    image_urls = await ai_clients.generate_image(api_key, description, size)
+            if image_urls:
+                return image_urls[0]
+        except RateLimitExceededError:
+            logger.warning("Image generation rejected by the API key limiter")
+            return None
+        except Exception:
+            logger.exception(f"Image generation attempt {attempt + 1} failed")
+        if attempt < max_retries:
+            await asyncio.sleep(backoff_seconds * 2 ** attempt)
+    return None
+
+async def generate_images_async(ai_clients: AsyncAIClients, api_key: str, description: str, count: int, size: str,
+                                on_image: Callable[[str], Awaitable[None]], max_retries: int = 1, backoff_seconds: float = 1.0,
+                                limiter: ApiKeyLimiter | None = None) -> int:
+    tasks = [
+        asyncio.ensure_future(_generate_single_image_async(ai_clients, api_key, description, size, max_retries, backoff_seconds, limiter))
+        for _ in range(count)
+    ]
+    generated_count = 0
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            image_url = await next_done
+            if image_url:
+                generated_count += 1
+                await on_image(image_url)
+    finally:
+        for task in tasks:
+            task.cancel()
+    return generated_count
@@ -1,4 +1,5 @@
 import copy
+import json
 
 keyboard_template = {
     "Type": "keyboard",
@@ -119,6 +120,68 @@ IMAGE_SIZE_KEYBOARD[BUTTONS_KEY].extend([
     CANCEL_BUTTON
 ])
 
+class RegisteredKeyboard:
+    def __init__(self, keyboard_id: str, keyboard: dict):
+        self._id = keyboard_id
+        # the stored json matches what was written to user_data.last_keyboard before keyboard ids were introduced
+        self._legacy_json = json.dumps(keyboard)
+        self._payload_json = json.dumps(append_buttons(keyboard, [HELP_BUTTON]), ensure_ascii=False)
+
+    @property
+    def id(self) -> str:
+        return self._id
+
+    @property
+    def legacy_json(self) -> str:
+        return self._legacy_json
+
+    @property
+    def payload_json(self) -> str:
+        return self._payload_json
+
+HELP_KEYBOARD_ID = "help"
+SET_API_KEY_KEYBOARD_ID = "set_api_key"
+CANCEL_KEYBOARD_ID = "cancel"
+MAIN_KEYBOARD_ID = "main"
+END_CHAT_KEYBOARD_ID = "end_chat"
+ASSISTANT_ROLES_KEYBOARD_ID = "assistant_roles"
+IMAGE_COUNT_KEYBOARD_ID = "image_count"
+IMAGE_SIZE_KEYBOARD_ID = "image_size"
+
+# static keyboards are serialized together with the Help button once at import time
+KEYBOARD_REGISTRY = {
+    keyboard_id: RegisteredKeyboard(keyboard_id, keyboard) for keyboard_id, keyboard in [
+        (HELP_KEYBOARD_ID, HELP_KEYBOARD),
+        (SET_API_KEY_KEYBOARD_ID, SET_API_KEY_KEYBOARD),
+        (CANCEL_KEYBOARD_ID, CANCEL_KEYBOARD),
+        (MAIN_KEYBOARD_ID, MAIN_KEYBOARD),
+        (END_CHAT_KEYBOARD_ID, END_CHAT_KEYBOARD),
+        (ASSISTANT_ROLES_KEYBOARD_ID, ASSISTANT_ROLES_KEYBOARD),
+        (IMAGE_COUNT_KEYBOARD_ID, IMAGE_COUNT_KEYBOARD),
+        (IMAGE_SIZE_KEYBOARD_ID, IMAGE_SIZE_KEYBOARD),
+    ]
+}
+
+_KEYBOARD_IDS_BY_LEGACY_JSON = {registered_keyboard.legacy_json: keyboard_id for keyboard_id, registered_keyboard in KEYBOARD_REGISTRY.items()}
+
+def get_registered_keyboard(keyboard_id: str) -> RegisteredKeyboard:
+    return KEYBOARD_REGISTRY[keyboard_id]
+
+def resolve_keyboard_id(stored_keyboard: str | None) -> str | None:
+    if not stored_keyboard:
+        return None
+    if stored_keyboard in KEYBOARD_REGISTRY:
+        return stored_keyboard
+
+    # legacy rows hold the whole keyboard json instead of its id
+    keyboard_id = _KEYBOARD_IDS_BY_LEGACY_JSON.get(stored_keyboard)
+    if keyboard_id is None:
+        try:
+            keyboard_id = _KEYBOARD_IDS_BY_LEGACY_JSON.get(json.dumps(json.loads(stored_keyboard)))
+        except ValueError:
+            keyboard_id = None
+    return keyboard_id
+
 keyboard = {
     "Type": "keyboard",
     "InputFieldState": "regular",
@@ -0,0 +1,106 @@
+import atexit
+import json
+import logging
+import queue
+import random
+import re
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+SECRET_PATTERNS = [
+    (re.compile(r"sk-[A-Za-z0-9_\-]{4,}"), "sk-***"),
+    # values may be json encoded again inside json lines, so the quotes can be escaped
+    (re.compile(r'((?:auth_token|X-Viber-Auth-Token|api_key)\\?"?\s*[:=]\s*\\?"?)[^"\\,\s}]+', re.IGNORECASE), r"\1***")
+]
+
+def redact_secrets(text: str) -> str:
+    for pattern, replacement in SECRET_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
+
+class RedactingFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return redact_secrets(super().format(record))
+
+class JsonFormatter(logging.Formatter):
+    def __init__(self, redact_payloads: bool = True):
+        super().__init__()
+        self._redact_payloads = redact_payloads
+
+    def format(self, record: logging.LogRecord) -> str:
+        log_entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage()
+        }
+        payload = getattr(record, "payload", None)
+        if payload is not None:
+            # message bodies are user data, only their size is logged unless payload logging is turned on
+            log_entry["payload"] = f"<redacted {len(str(payload))} chars>" if self._redact_payloads else str(payload)
+        if record.exc_info:
+            log_entry["exception"] = self.formatException(record.exc_info)
+        return redact_secrets(json.dumps(log_entry, ensure_ascii=False))
+
+class _LogListener(QueueListener):
+    def stop(self):
+        # stop may be called explicitly and then once more at exit
+        if self._thread is not None:
+            super().stop()
+
+class DebugSamplingFilter(logging.Filter):
+    def __init__(self, sample_rate: float):
+        super().__init__()
+        self._sample_rate = sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        # only debug events are sampled, everything from info up is always kept
+        return record.levelno > logging.DEBUG or random.random() < self._sample_rate
+
+class AsyncLogHandler(QueueHandler):
+    # Puts records to a bounded queue which is written by a background listener thread,
+    # formatting and redaction happen there and not on the request thread.
+    # Records are dropped instead of blocking the request when the queue is full.
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped_records = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the arguments are merged right away since they may be changed by the caller later
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped_records += 1
+
+def setup_logging(log_file: str = "viber_bot.log", level: str = "INFO", max_bytes: int = 10 * 1024 * 1024,
+                  backup_count: int = 5, rotation_when: str = "", json_format: bool = True,
+                  redact_payloads: bool = True, debug_sample_rate: float = 0.01, queue_size: int = 10000) -> QueueListener:
+    if rotation_when:
+        file_handler = TimedRotatingFileHandler(log_file, when=rotation_when, backupCount=backup_count, encoding="utf-8")
+    else:
+        file_handler = RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    file_handler.setFormatter(JsonFormatter(redact_payloads) if json_format else RedactingFormatter(TEXT_FORMAT))
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(RedactingFormatter(TEXT_FORMAT))
+
+    log_queue = queue.Queue(queue_size)
+    queue_handler = AsyncLogHandler(log_queue)
+    queue_handler.addFilter(DebugSamplingFilter(debug_sample_rate))
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(level)
+    for handler in root_logger.handlers[:]:
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(queue_handler)
+
+    listener = _LogListener(log_queue, stream_handler, file_handler, respect_handler_level=True)
+    listener.start()
+    # stopping the listener flushes the records which are still in the queue
+    atexit.register(listener.stop)
+    return listener
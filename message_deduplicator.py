@@ -0,0 +1,63 @@
+import threading
+import time
+
+from DBService.message_dedup_service import MessageDedupDatabaseService
+from ttl_cache import LRUTTLCache
+
+class MessageDeduplicator:
+    def __init__(self, window_seconds: float = 3600.0, max_size: int = 10000,
+                 dedup_db: MessageDedupDatabaseService | None = None, prune_interval: float = 300.0):
+        self._window_seconds = window_seconds
+        self._seen_messages = LRUTTLCache(max_size, window_seconds)
+        self._dedup_db = dedup_db
+        self._prune_interval = prune_interval
+        self._last_prune_time = time.monotonic()
+        self._lock = threading.Lock()
+        self._checked = 0
+        self._duplicates_dropped = 0
+
+    @staticmethod
+    def _get_message_key(event: str | None, message_token) -> str:
+        # delivered and seen callbacks reuse the token of the message they refer to
+        return f"{event}:{message_token}"
+
+    def is_duplicate(self, event: str | None, message_token) -> bool:
+        if message_token is None:
+            return False
+
+        message_key = self._get_message_key(event, message_token)
+        is_new = self._seen_messages.set_if_absent(message_key, True)
+        if is_new and self._dedup_db is not None:
+            is_new = self._dedup_db.mark_seen(message_key, self._window_seconds)
+            self._prune_if_needed()
+
+        with self._lock:
+            self._checked += 1
+            self._duplicates_dropped += not is_new
+        return not is_new
+
+    def forget(self, event: str | None, message_token):
+        # called when a callback could not be accepted, so its redelivery is handled
+        if message_token is None:
+            return
+
+        message_key = self._get_message_key(event, message_token)
+        self._seen_messages.pop(message_key)
+        if self._dedup_db is not None:
+            self._dedup_db.forget(message_key)
+
+    def _prune_if_needed(self):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_prune_time < self._prune_interval:
+                return
+            self._last_prune_time = now
+        self._dedup_db.prune(self._window_seconds)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "checked": self._checked,
+                "duplicates_dropped": self._duplicates_dropped,
+                "cached_tokens": len(self._seen_messages)
+            }
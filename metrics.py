@@ -0,0 +1,194 @@
+import bisect
+import contextvars
+import os
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from contextlib import nullcontext
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+UNKNOWN_LABEL = "none"
+
+# disabled timers are a single shared no-op context, so hooks cost one attribute check
+_NULL_TIMER = nullcontext()
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format_labels(label_names: tuple, label_values: tuple, extra: str = "") -> str:
+    labels = [f'{name}="{_escape_label_value(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+class Counter:
+    def __init__(self, name: str, description: str, label_names: tuple):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_values: tuple, amount: float = 1.0):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(self.label_names, label_values)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, description: str, label_names: tuple, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self._buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_values: tuple, value: float):
+        bucket_index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                # per series: a count for every bucket plus +Inf, the sum and the total count
+                series = self._values[label_values] = [[0] * (len(self._buckets) + 1), 0.0, 0]
+            series[0][bucket_index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, (bucket_counts, total, count) in self._values.items():
+                cumulative_count = 0
+                for upper_bound, bucket_count in zip(self._buckets + (float("inf"),), bucket_counts):
+                    cumulative_count += bucket_count
+                    le_label = 'le="+Inf"' if upper_bound == float("inf") else f'le="{upper_bound}"'
+                    lines.append(f"{self.name}_bucket{_format_labels(self.label_names, label_values, le_label)} {cumulative_count}")
+                lines.append(f"{self.name}_sum{_format_labels(self.label_names, label_values)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.label_names, label_values)} {count}")
+        return lines
+
+class _StageTimer:
+    __slots__ = ("_registry", "_stage", "_feature", "_started_at")
+
+    def __init__(self, registry: "MetricsRegistry", stage: str, feature: str | None):
+        self._registry = registry
+        self._stage = stage
+        self._feature = feature
+
+    def __enter__(self):
+        self._started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._registry.observe_stage(self._stage, time.perf_counter() - self._started_at, self._feature, exc_type is not None)
+        return False
+
+class MetricsRegistry:
+    # Stage timings are labeled with the chat state and feature of the request handled by the current thread
+    # or asyncio task, the labels are kept in a context variable which is separate for both.
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._context = contextvars.ContextVar("metrics_context", default=(UNKNOWN_LABEL, UNKNOWN_LABEL))
+        self.stage_duration = Histogram(
+            "viber_bot_stage_duration_seconds", "Time spent in a processing stage.", ("stage", "chat_state", "feature")
+        )
+        self.stage_errors = Counter(
+            "viber_bot_stage_errors_total", "Processing stages which raised an error.", ("stage", "chat_state", "feature")
+        )
+        self.requests = Counter("viber_bot_requests_total", "Handled Viber requests.", ("chat_state", "feature"))
+
+    def set_context(self, chat_state: str | None = None, feature: str | None = None):
+        if not self.enabled:
+            return
+        # the labels are replaced as a whole, copies of the context made for other tasks keep their own labels
+        current_chat_state, current_feature = self._context.get()
+        self._context.set((chat_state or current_chat_state, feature or current_feature))
+
+    def clear_context(self):
+        self._context.set((UNKNOWN_LABEL, UNKNOWN_LABEL))
+
+    def _labels(self, feature: str | None) -> tuple:
+        chat_state, context_feature = self._context.get()
+        return chat_state, feature or context_feature
+
+    def timer(self, stage: str, feature: str | None = None):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _StageTimer(self, stage, feature)
+
+    def observe_stage(self, stage: str, duration: float, feature: str | None = None, failed: bool = False):
+        labels = (stage,) + self._labels(feature)
+        self.stage_duration.observe(labels, duration)
+        if failed:
+            self.stage_errors.inc(labels)
+
+    def count_request(self):
+        if self.enabled:
+            self.requests.inc(self._labels(None))
+
+    def render(self) -> str:
+        lines = []
+        for metric in (self.stage_duration, self.stage_errors, self.requests):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+class SamplingProfiler:
+    # Periodically samples stacks of all threads, the result is in the collapsed format used by flame graph tools.
+    def __init__(self, interval: float = 0.01, max_stacks: int = 10000):
+        self._interval = interval
+        self._max_stacks = max_stacks
+        self._stacks = StackCounter()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop_event.set()
+            thread.join()
+
+    def _run(self):
+        own_thread_id = threading.get_ident()
+        while not self._stop_event.wait(self._interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                collapsed_stack = ";".join(reversed(stack))
+                with self._lock:
+                    if collapsed_stack in self._stacks or len(self._stacks) < self._max_stacks:
+                        self._stacks[collapsed_stack] += 1
+
+    def render_collapsed(self) -> str:
+        with self._lock:
+            return "".join(f"{stack} {count}\n" for stack, count in self._stacks.most_common())
+
+    def reset(self):
+        with self._lock:
+            self._stacks.clear()
+
+metrics_registry = MetricsRegistry()
@@ -0,0 +1,45 @@
+import asyncio
+import threading
+import time
+
+class TokenBucket:
+    def __init__(self, rate_per_second: float, capacity: float | None = None):
+        self._rate_per_second = rate_per_second
+        self._capacity = capacity if capacity is not None else max(1.0, rate_per_second)
+        self._tokens = self._capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self._rate_per_second)
+        self._updated_at = now
+
+    def try_acquire(self, tokens: float = 1.0) -> float:
+        # returns 0 when tokens were taken, otherwise the time to wait until they become available
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            return (tokens - self._tokens) / self._rate_per_second
+
+    def acquire(self, tokens: float = 1.0, timeout: float | None = None) -> bool:
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            wait_time = self.try_acquire(tokens)
+            if wait_time == 0.0:
+                return True
+            if deadline is not None and time.monotonic() + wait_time > deadline:
+                return False
+            time.sleep(wait_time)
+
+    async def acquire_async(self, tokens: float = 1.0, timeout: float | None = None) -> bool:
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            wait_time = self.try_acquire(tokens)
+            if wait_time == 0.0:
+                return True
+            if deadline is not None and time.monotonic() + wait_time > deadline:
+                return False
+            await asyncio.sleep(wait_time)
@@ -0,0 +1,327 @@
+import asyncio
+import json
+import logging
+import queue
+import threading
+import time
+import zlib
+from concurrent.futures import Executor
+from typing import Awaitable, Callable
+
+from DBService.job_queue_service import Job, JobQueueDatabaseService, JobStatus
+
+logger = logging.getLogger(__name__)
+
+class RequestRoutingInfo:
+    def __init__(self, event: str | None, user_id: str | None, message_token):
+        self.event = event
+        self.user_id = user_id
+        self.message_token = message_token
+
+def get_request_routing_info(request_data: bytes) -> RequestRoutingInfo:
+    try:
+        request_dict = json.loads(request_data)
+    except ValueError:
+        return RequestRoutingInfo(None, None, None)
+
+    if 'sender' in request_dict:
+        user_id = request_dict['sender'].get('id')
+    elif 'user' in request_dict:
+        user_id = request_dict['user'].get('id')
+    else:
+        user_id = request_dict.get('user_id')
+    return RequestRoutingInfo(request_dict.get('event'), user_id, request_dict.get('message_token'))
+
+class ShardedWorkerPool:
+    _STOP = object()
+
+    def __init__(self, handler: Callable[[object], None], workers_count: int = 4, name: str = "webhook-worker"):
+        self._handler = handler
+        self._shards = [queue.Queue() for _ in range(max(1, workers_count))]
+        self._stats_lock = threading.Lock()
+        self._submitted = 0
+        self._processed = 0
+        self._failed = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+        self._workers = []
+        for shard_index, shard in enumerate(self._shards):
+            worker = threading.Thread(target=self._worker_loop, args=(shard,), name=f"{name}-{shard_index}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _get_shard(self, shard_key: str | None) -> queue.Queue:
+        # all items with the same key go to the same single-threaded shard, which keeps them ordered
+        if not shard_key:
+            return self._shards[0]
+        return self._shards[zlib.crc32(shard_key.encode()) % len(self._shards)]
+
+    def submit(self, shard_key: str | None, item):
+        self._get_shard(shard_key).put((time.monotonic(), item))
+        with self._stats_lock:
+            self._submitted += 1
+
+    def _worker_loop(self, shard: queue.Queue):
+        while True:
+            entry = shard.get()
+            if entry is self._STOP:
+                shard.task_done()
+                return
+
+            enqueued_at, item = entry
+            wait_time = time.monotonic() - enqueued_at
+            failed = False
+            try:
+                self._handler(item)
+            except Exception:
+                failed = True
+                logger.exception("Failed to process queued request")
+            finally:
+                shard.task_done()
+
+            with self._stats_lock:
+                self._processed += 1
+                self._failed += failed
+                self._wait_time_total += wait_time
+                self._wait_time_max = max(self._wait_time_max, wait_time)
+
+    def stats(self) -> dict:
+        shard_backlogs = [shard.qsize() for shard in self._shards]
+        with self._stats_lock:
+            return {
+                "workers": len(self._shards),
+                "queue_depth": sum(shard_backlogs),
+                "shard_backlogs": shard_backlogs,
+                "submitted": self._submitted,
+                "processed": self._processed,
+                "failed": self._failed,
+                "wait_time_avg": self._wait_time_total / self._processed if self._processed else 0.0,
+                "wait_time_max": self._wait_time_max
+            }
+
+    def shutdown(self, timeout: float | None = None):
+        for shard in self._shards:
+            shard.put(self._STOP)
+        for worker in self._workers:
+            worker.join(timeout)
+
+class DurableRequestDispatcher:
+    def __init__(self, job_queue: JobQueueDatabaseService, handler: Callable[[bytes], None], workers_count: int = 4,
+                 max_backlog: int = 64, poll_interval: float = 1.0, compaction_interval: float = 300.0,
+                 retention_seconds: float = 3600.0, lease_seconds: float = 60.0):
+        self._job_queue = job_queue
+        self._handler = handler
+        self._max_backlog = max_backlog
+        self._poll_interval = poll_interval
+        self._compaction_interval = compaction_interval
+        self._retention_seconds = retention_seconds
+        self._lease_renewal_interval = lease_seconds / 3
+        self._in_flight_job_ids = set()
+        self._in_flight_lock = threading.Lock()
+        self._wakeup_event = threading.Event()
+        self._stop_event = threading.Event()
+
+        requeued_jobs_count = self._job_queue.requeue_unfinished()
+        if requeued_jobs_count:
+            logger.info(f"Re-queued {requeued_jobs_count} unfinished jobs of a previous run.")
+
+        self._worker_pool = ShardedWorkerPool(self._process_job, workers_count)
+        self._feeder = threading.Thread(target=self._feeder_loop, name="job-feeder", daemon=True)
+        self._feeder.start()
+
+    def submit(self, user_id: str | None, request_data: bytes):
+        self._job_queue.enqueue(user_id, request_data)
+        self._wakeup_event.set()
+
+    def _process_job(self, job: Job):
+        status = JobStatus.DONE
+        try:
+            self._handler(job.payload)
+        except Exception:
+            # handlers have side effects (replies, paid upstream calls), so a failed job is not retried
+            status = JobStatus.FAILED
+            raise
+        finally:
+            self._job_queue.complete(job.id, status)
+            with self._in_flight_lock:
+                self._in_flight_job_ids.discard(job.id)
+            self._wakeup_event.set()
+
+    def _feeder_loop(self):
+        last_compaction_time = time.monotonic()
+        last_lease_renewal_time = time.monotonic()
+        while not self._stop_event.is_set():
+            self._wakeup_event.wait(self._poll_interval)
+            self._wakeup_event.clear()
+            if self._stop_event.is_set():
+                return
+
+            try:
+                self._feed_worker_pool()
+
+                now = time.monotonic()
+                if now - last_lease_renewal_time >= self._lease_renewal_interval:
+                    with self._in_flight_lock:
+                        in_flight_job_ids = list(self._in_flight_job_ids)
+                    self._job_queue.renew_leases(in_flight_job_ids)
+                    last_lease_renewal_time = now
+
+                if now - last_compaction_time >= self._compaction_interval:
+                    removed_jobs_count = self._job_queue.compact(self._retention_seconds)
+                    logger.info(f"Job queue compaction removed {removed_jobs_count} finished jobs.")
+                    last_compaction_time = now
+            except Exception:
+                logger.exception("Job feeder iteration failed")
+
+    def _feed_worker_pool(self):
+        # jobs are claimed in bounded batches so a large backlog after restart is replayed gradually
+        while True:
+            with self._in_flight_lock:
+                free_slots = self._max_backlog - len(self._in_flight_job_ids)
+            jobs = self._job_queue.claim(free_slots)
+            if not jobs:
+                return
+
+            with self._in_flight_lock:
+                self._in_flight_job_ids.update(job.id for job in jobs)
+            for job in jobs:
+                self._worker_pool.submit(job.user_id, job)
+
+    def stats(self) -> dict:
+        stats = self._worker_pool.stats()
+        with self._in_flight_lock:
+            stats["jobs_in_flight"] = len(self._in_flight_job_ids)
+        stats["jobs"] = self._job_queue.count_by_status()
+        return stats
+
+    def shutdown(self, timeout: float | None = None):
+        self._stop_event.set()
+        self._wakeup_event.set()
+        self._feeder.join(timeout)
+        self._worker_pool.shutdown(timeout)
+
+class AsyncRequestDispatcher:
+    # Asyncio counterpart of DurableRequestDispatcher for the ASGI serving mode. Jobs are persisted in the same queue,
+    # every job runs as a task and the tasks of one user are chained, so they are processed in order.
+    # The job queue is only accessed from db_executor.
+    def __init__(self, job_queue: JobQueueDatabaseService, handler: Callable[[bytes], Awaitable[None]], db_executor: Executor,
+                 max_in_flight: int = 1000, poll_interval: float = 1.0, compaction_interval: float = 300.0,
+                 retention_seconds: float = 3600.0, lease_seconds: float = 60.0):
+        self._job_queue = job_queue
+        self._handler = handler
+        self._db_executor = db_executor
+        self._max_in_flight = max_in_flight
+        self._poll_interval = poll_interval
+        self._compaction_interval = compaction_interval
+        self._retention_seconds = retention_seconds
+        self._lease_renewal_interval = lease_seconds / 3
+        self._in_flight_tasks = {}
+        self._last_task_by_user = {}
+        self._wakeup_event = None
+        self._stopping = False
+        self._feeder = None
+        self._processed = 0
+        self._failed = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+
+    async def _run_db(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._db_executor, function, *args)
+
+    async def start(self):
+        self._wakeup_event = asyncio.Event()
+        requeued_jobs_count = await self._run_db(self._job_queue.requeue_unfinished)
+        if requeued_jobs_count:
+            logger.info(f"Re-queued {requeued_jobs_count} unfinished jobs of a previous run.")
+        self._feeder = asyncio.create_task(self._feeder_loop())
+
+    async def submit(self, user_id: str | None, request_data: bytes):
+        await self._run_db(self._job_queue.enqueue, user_id, request_data)
+        self._wakeup_event.set()
+
+    async def _process_job(self, job: Job, previous_task: asyncio.Task | None, claimed_at: float):
+        if previous_task is not None:
+            await asyncio.wait([previous_task])
+
+        wait_time = time.monotonic() - claimed_at
+        status = JobStatus.DONE
+        try:
+            await self._handler(job.payload)
+        except Exception:
+            # handlers have side effects (replies, paid upstream calls), so a failed job is not retried
+            status = JobStatus.FAILED
+            logger.exception("Failed to process queued request")
+        finally:
+            try:
+                await self._run_db(self._job_queue.complete, job.id, status)
+            finally:
+                self._in_flight_tasks.pop(job.id, None)
+                if self._last_task_by_user.get(job.user_id) is asyncio.current_task():
+                    del self._last_task_by_user[job.user_id]
+                self._processed += 1
+                self._failed += status == JobStatus.FAILED
+                self._wait_time_total += wait_time
+                self._wait_time_max = max(self._wait_time_max, wait_time)
+                self._wakeup_event.set()
+
+    def _start_job(self, job: Job):
+        previous_task = self._last_task_by_user.get(job.user_id) if job.user_id else None
+        task = asyncio.create_task(self._process_job(job, previous_task, time.monotonic()))
+        self._in_flight_tasks[job.id] = task
+        if job.user_id:
+            self._last_task_by_user[job.user_id] = task
+
+    async def _feeder_loop(self):
+        last_compaction_time = time.monotonic()
+        last_lease_renewal_time = time.monotonic()
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup_event.wait(), self._poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup_event.clear()
+            if self._stopping:
+                return
+
+            try:
+                # jobs are claimed in bounded batches so a large backlog after restart is replayed gradually
+                while True:
+                    jobs = await self._run_db(self._job_queue.claim, self._max_in_flight - len(self._in_flight_tasks))
+                    if not jobs:
+                        break
+                    for job in jobs:
+                        self._start_job(job)
+
+                now = time.monotonic()
+                if now - last_lease_renewal_time >= self._lease_renewal_interval:
+                    await self._run_db(self._job_queue.renew_leases, list(self._in_flight_tasks))
+                    last_lease_renewal_time = now
+
+                if now - last_compaction_time >= self._compaction_interval:
+                    removed_jobs_count = await self._run_db(self._job_queue.compact, self._retention_seconds)
+                    logger.info(f"Job queue compaction removed {removed_jobs_count} finished jobs.")
+                    last_compaction_time = now
+            except Exception:
+                logger.exception("Job feeder iteration failed")
+
+    async def stats(self) -> dict:
+        return {
+            "mode": "asyncio",
+            "tasks_in_flight": len(self._in_flight_tasks),
+            "users_in_flight": len(self._last_task_by_user),
+            "processed": self._processed,
+            "failed": self._failed,
+            "wait_time_avg": self._wait_time_total / self._processed if self._processed else 0.0,
+            "wait_time_max": self._wait_time_max,
+            "jobs": await self._run_db(self._job_queue.count_by_status)
+        }
+
+    async def shutdown(self, timeout: float | None = None):
+        # the feeder is stopped by the flag, wait_for of python 3.11 can swallow a cancellation
+        self._stopping = True
+        if self._feeder is not None:
+            self._wakeup_event.set()
+            await asyncio.gather(self._feeder, return_exceptions=True)
+        # unfinished jobs stay leased in the queue and are re-queued by the next start
+        if self._in_flight_tasks:
+            await asyncio.wait(list(self._in_flight_tasks.values()), timeout=timeout)
@@ -0,0 +1,112 @@
+import asyncio
+import hashlib
+import json
+import re
+import threading
+import time
+from concurrent.futures import Future
+from typing import Awaitable, Callable
+
+from ttl_cache import LRUTTLCache
+
+def make_cache_key(api_key: str, prompt: str, model_params: dict) -> str:
+    # only a hash of the api key is part of the key, answers are never shared between different keys
+    normalized_prompt = re.sub(r"\s+", " ", prompt).strip()
+    key_data = {
+        "api_key": hashlib.sha256(api_key.encode()).hexdigest(),
+        "prompt": normalized_prompt,
+        "params": model_params
+    }
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+class ResponseCache:
+    def __init__(self, max_size: int = 1000, ttl_seconds: float = 3600.0):
+        self._cache = LRUTTLCache(max_size, ttl_seconds)
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._coalesced = 0
+        self._saved_latency = 0.0
+
+    def _begin(self, key: str) -> tuple[str | None, Future | None, bool]:
+        # returns the cached answer, or the future of the upstream request and whether this call has to make it
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                answer, latency = cached
+                self._saved_latency += latency
+                return answer, None, False
+
+            future = self._in_flight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._in_flight[key] = future
+            else:
+                self._coalesced += 1
+            return None, future, is_leader
+
+    def _coalesced_answer(self, result: tuple[str, float]) -> str:
+        answer, latency = result
+        with self._lock:
+            self._saved_latency += latency
+        return answer
+
+    def _finish(self, key: str, future: Future, started_at: float, answer: str | None, error: BaseException | None):
+        if error is not None:
+            # failures are not cached, waiting callers get the same error
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(error)
+            return
+
+        result = (answer, time.monotonic() - started_at)
+        with self._lock:
+            self._cache.set(key, result)
+            del self._in_flight[key]
+        future.set_result(result)
+
+    def get_or_compute(self, key: str, compute: Callable[[], str]) -> tuple[str, bool]:
+        # Returns the answer and whether it was computed by this call.
+        # Concurrent calls with the same key wait for the single upstream request instead of making their own.
+        answer, future, is_leader = self._begin(key)
+        if future is None:
+            return answer, False
+        if not is_leader:
+            return self._coalesced_answer(future.result()), False
+
+        started_at = time.monotonic()
+        try:
+            answer = compute()
+        except BaseException as e:
+            self._finish(key, future, started_at, None, e)
+            raise
+        self._finish(key, future, started_at, answer, None)
+        return answer, True
+
+    async def get_or_compute_async(self, key: str, compute: Callable[[], Awaitable[str]]) -> tuple[str, bool]:
+        answer, future, is_leader = self._begin(key)
+        if future is None:
+            return answer, False
+        if not is_leader:
+            return self._coalesced_answer(await asyncio.wrap_future(future)), False
+
+        started_at = time.monotonic()
+        try:
+            answer = await compute()
+        except BaseException as e:
+            self._finish(key, future, started_at, None, e)
+            raise
+        self._finish(key, future, started_at, answer, None)
+        return answer, True
+
+    def stats(self) -> dict:
+        with self._lock:
+            cache_stats = self._cache.stats()
+            requests_count = cache_stats["hits"] + cache_stats["misses"]
+            cache_stats.update({
+                "coalesced": self._coalesced,
+                "in_flight": len(self._in_flight),
+                "hit_ratio": (cache_stats["hits"] + self._coalesced) / requests_count if requests_count else 0.0,
+                "saved_latency_seconds": self._saved_latency
+            })
+            return cache_stats
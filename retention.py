@@ -0,0 +1,138 @@
+import argparse
+import logging
+import time
+from typing import Callable
+
+from DBService.db_service import UserDataDatabaseService
+from utils import Settings
+
+logger = logging.getLogger(__name__)
+
+DAY_SECONDS = 24 * 60 * 60
+INCREMENTAL_AUTO_VACUUM = 2
+
+class RetentionJob:
+    # Clears per-user state nobody needs anymore and returns the freed pages to the file system. All writes are small
+    # batches with pauses in between, so webhook writes never wait long for the database write lock.
+    def __init__(self, user_data_db: UserDataDatabaseService, idle_days: float = 30.0, api_key_idle_days: float = 365.0,
+                 unsubscribed_grace_days: float = 30.0, batch_size: int = 500, pause_seconds: float = 0.05,
+                 vacuum_pages: int = 256, vacuum_seconds: float = 10.0):
+        self._user_data_db = user_data_db
+        self._idle_seconds = idle_days * DAY_SECONDS
+        self._api_key_idle_seconds = api_key_idle_days * DAY_SECONDS
+        self._unsubscribed_grace_seconds = unsubscribed_grace_days * DAY_SECONDS
+        self._batch_size = batch_size
+        self._pause_seconds = pause_seconds
+        self._vacuum_pages = vacuum_pages
+        self._vacuum_seconds = vacuum_seconds
+        self._max_batch_seconds = 0.0
+
+    def _timed_batch(self, batch: Callable):
+        started_at = time.perf_counter()
+        try:
+            return batch()
+        finally:
+            self._max_batch_seconds = max(self._max_batch_seconds, time.perf_counter() - started_at)
+            time.sleep(self._pause_seconds)
+
+    def _walk_batches(self, batch: Callable[[int, int], tuple[int, int]]) -> int:
+        total_count, after_rowid = 0, 0
+        while True:
+            count, after_rowid = self._timed_batch(lambda: batch(after_rowid, self._batch_size))
+            if not count:
+                return total_count
+            total_count += count
+
+    def _repeat_batches(self, batch: Callable[[int], int]) -> int:
+        total_count = 0
+        while True:
+            count = self._timed_batch(lambda: batch(self._batch_size))
+            if not count:
+                return total_count
+            total_count += count
+
+    def _vacuum(self) -> dict:
+        page_stats = self._user_data_db.get_page_stats()
+        if page_stats["auto_vacuum"] != INCREMENTAL_AUTO_VACUUM:
+            logger.warning("Incremental vacuum is disabled for this database, enable it with: python -m DBService.migrations <db> --vacuum")
+            return {"steps": 0, "free_pages_left": page_stats["freelist_count"]}
+
+        steps = 0
+        deadline = time.monotonic() + self._vacuum_seconds
+        free_pages = page_stats["freelist_count"]
+        while free_pages and time.monotonic() < deadline:
+            self._timed_batch(lambda: self._user_data_db.incremental_vacuum(self._vacuum_pages))
+            free_pages = self._user_data_db.get_page_stats()["freelist_count"]
+            steps += 1
+        # the file shrinks when the WAL is checkpointed
+        self._user_data_db.checkpoint()
+        return {"steps": steps, "free_pages_left": free_pages}
+
+    def run(self) -> dict:
+        started_at = time.perf_counter()
+        self._max_batch_seconds = 0.0
+        now = time.time()
+        page_stats_before = self._user_data_db.get_page_stats()
+        db = self._user_data_db
+
+        report = {
+            "idle_users_cleared": self._walk_batches(
+                lambda after_rowid, limit: db.clear_idle_user_state(now - self._idle_seconds, after_rowid, limit)
+            ),
+            "api_keys_cleared": self._walk_batches(
+                lambda after_rowid, limit: db.clear_idle_api_keys(now - self._api_key_idle_seconds, after_rowid, limit)
+            ) if self._api_key_idle_seconds > 0 else 0,
+            "unsubscribed_users_deleted": self._repeat_batches(
+                lambda limit: db.delete_unsubscribed_users(now - self._unsubscribed_grace_seconds, limit)
+            ),
+            "chat_sessions_deleted": self._repeat_batches(
+                lambda limit: db.delete_stale_chat_sessions(now - self._idle_seconds, limit)
+            )
+        }
+        report["vacuum"] = self._vacuum()
+
+        page_stats_after = self._user_data_db.get_page_stats()
+        report["bytes_reclaimed"] = (page_stats_before["page_count"] - page_stats_after["page_count"]) * page_stats_after["page_size"]
+        report["database_bytes"] = page_stats_after["page_count"] * page_stats_after["page_size"]
+        report["max_batch_seconds"] = self._max_batch_seconds
+        report["elapsed_seconds"] = time.perf_counter() - started_at
+        return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Clear stale user data and reclaim free database pages.")
+    parser.add_argument("--idle-days", type=float, default=30.0, help="clear the transient state and chat sessions of users idle for longer")
+    parser.add_argument("--api-key-idle-days", type=float, default=365.0, help="remove API keys of users idle for longer, 0 keeps them")
+    parser.add_argument("--unsubscribed-grace-days", type=float, default=30.0, help="delete users unsubscribed for longer")
+    parser.add_argument("--batch-size", type=int, default=500, help="rows changed per write transaction")
+    parser.add_argument("--pause", type=float, default=0.05, help="seconds between write transactions")
+    parser.add_argument("--vacuum-pages", type=int, default=256, help="pages freed per incremental vacuum step")
+    parser.add_argument("--vacuum-seconds", type=float, default=10.0, help="time budget of the incremental vacuum")
+    parser.add_argument("--interval", type=float, help="keep running and repeat the job every INTERVAL seconds")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    # bot imports flask and the bot handlers, it is only needed for the database settings
+    from bot import create_user_data_db
+    job = RetentionJob(
+        create_user_data_db(Settings()),
+        idle_days=args.idle_days,
+        api_key_idle_days=args.api_key_idle_days,
+        unsubscribed_grace_days=args.unsubscribed_grace_days,
+        batch_size=args.batch_size,
+        pause_seconds=args.pause,
+        vacuum_pages=args.vacuum_pages,
+        vacuum_seconds=args.vacuum_seconds
+    )
+    while True:
+        report = job.run()
+        print(f"Idle users cleared: {report['idle_users_cleared']}, API keys cleared: {report['api_keys_cleared']}, "
+              f"unsubscribed users deleted: {report['unsubscribed_users_deleted']}, chat sessions deleted: {report['chat_sessions_deleted']}")
+        print(f"Reclaimed {report['bytes_reclaimed']} bytes in {report['vacuum']['steps']} vacuum steps, "
+              f"{report['vacuum']['free_pages_left']} free pages left, database size {report['database_bytes']} bytes")
+        print(f"Longest write transaction {report['max_batch_seconds'] * 1000:.1f} ms, total {report['elapsed_seconds']:.1f} s")
+        if args.interval is None:
+            return
+        time.sleep(args.interval)
+
+if __name__ == "__main__":
+    main()
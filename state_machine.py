@@ -0,0 +1,91 @@
+import inspect
+import threading
+import time
+from typing import Callable, Iterable
+
+from chat_state import ChatState
+
+FALLBACK_ACTION = "__fallback__"
+
+class StateMachineDispatcher:
+    def __init__(self):
+        self._transitions = {}
+        self._default_transitions = {}
+        self._fallbacks = {}
+        self._compiled = None
+        self._stats_lock = threading.Lock()
+        self._transition_stats = {}
+
+    def register(self, action: str, handler: Callable, states: Iterable[ChatState] | None = None):
+        # without states the handler is used in every state which has no own handler for the action
+        if self._compiled is not None:
+            raise RuntimeError("Transitions can't be registered after the dispatcher is compiled")
+        if states is None:
+            self._default_transitions[action] = handler
+        else:
+            for state in states:
+                self._transitions[(state, action)] = handler
+
+    def register_fallback(self, state: ChatState, handler: Callable):
+        # the fallback handles everything which is not a registered action, i.e. free text input
+        if self._compiled is not None:
+            raise RuntimeError("Transitions can't be registered after the dispatcher is compiled")
+        self._fallbacks[state] = handler
+
+    def compile(self, states: Iterable[ChatState] = ChatState):
+        states = list(states)
+        missing_fallbacks = [state.name for state in states if state not in self._fallbacks]
+        if missing_fallbacks:
+            raise ValueError(f"States without a fallback handler: {', '.join(missing_fallbacks)}")
+
+        compiled = {}
+        for state in states:
+            table = dict(self._default_transitions)
+            table.update({action: handler for (handler_state, action), handler in self._transitions.items() if handler_state == state})
+            compiled[state] = (table, self._fallbacks[state])
+        self._compiled = compiled
+
+    def dispatch(self, state: ChatState, action: str, *args):
+        table, fallback = self._compiled[state]
+        handler = table.get(action)
+        if handler is None:
+            handler, action = fallback, FALLBACK_ACTION
+
+        started_at = time.perf_counter()
+        try:
+            result = handler(*args)
+        except BaseException:
+            self._record(state, action, time.perf_counter() - started_at)
+            raise
+        if inspect.isawaitable(result):
+            # coroutine handlers of the asyncio serving mode are timed when they finish
+            return self._record_when_done(state, action, started_at, result)
+        self._record(state, action, time.perf_counter() - started_at)
+        return result
+
+    async def _record_when_done(self, state: ChatState, action: str, started_at: float, awaitable):
+        try:
+            return await awaitable
+        finally:
+            self._record(state, action, time.perf_counter() - started_at)
+
+    def _record(self, state: ChatState, action: str, latency: float):
+        key = (state, action)
+        with self._stats_lock:
+            transition_stats = self._transition_stats.get(key)
+            if transition_stats is None:
+                transition_stats = self._transition_stats[key] = [0, 0.0, 0.0]
+            transition_stats[0] += 1
+            transition_stats[1] += latency
+            transition_stats[2] = max(transition_stats[2], latency)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                f"{state.name}:{action}": {
+                    "count": count,
+                    "latency_avg": latency_total / count,
+                    "latency_max": latency_max
+                }
+                for (state, action), (count, latency_total, latency_max) in self._transition_stats.items()
+            }
@@ -0,0 +1,79 @@
+import hashlib
+import hmac
+import json
+import os
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, "benchmarks"))
+
+AUTH_TOKEN = "test-auth-token"
+ADMIN_TOKEN = "test-admin-token"
+
+def sign(body: bytes) -> str:
+    return hmac.new(AUTH_TOKEN.encode(), body, hashlib.sha256).hexdigest()
+
+def text_message_body(user_id: str, text: str, message_token: int = 1) -> bytes:
+    return json.dumps({
+        "event": "message",
+        "timestamp": 1700000000000,
+        "message_token": message_token,
+        "sender": {"id": user_id, "name": "Test"},
+        "message": {"type": "text", "text": text}
+    }).encode()
+
+def delivered_body(user_id: str, message_token: int) -> bytes:
+    return json.dumps({"event": "delivered", "timestamp": 1700000000000, "message_token": message_token, "user_id": user_id}).encode()
+
+class RecordingSender:
+    # stands in for ViberMessageSender and keeps every send_messages call
+    def __init__(self):
+        self.sent = []
+
+    def send_messages(self, to: str, messages: list, keyboard_json: str | None = None) -> list:
+        self.sent.append((to, [message.to_dict() for message in messages], keyboard_json))
+        return [len(self.sent)] * len(messages)
+
+    def close(self):
+        pass
+
+@pytest.fixture
+def app_config(tmp_path) -> dict:
+    import constants
+    from cryptography.fernet import Fernet
+    return {
+        constants.API_KEYS_DB_ENCRYPTION_KEY_ENV: Fernet.generate_key().decode(),
+        constants.VIBER_BOT_TOKEN_ENV: AUTH_TOKEN,
+        constants.ADMIN_TOKEN_ENV: ADMIN_TOKEN,
+        constants.LOG_LEVEL_ENV: "WARNING",
+        constants.LOG_FILE_ENV: str(tmp_path / "viber_bot.log"),
+        constants.USER_DATA_DB_ENV: str(tmp_path / "user_data.db"),
+        constants.JOB_QUEUE_DB_ENV: str(tmp_path / "jobs.db"),
+        constants.DEDUP_DB_ENV: str(tmp_path / "message_dedup.db")
+    }
+
+@pytest.fixture
+def user_data_db(tmp_path):
+    from cryptography.fernet import Fernet
+    from DBService.db_service import UserDataDatabaseService
+    db = UserDataDatabaseService(Fernet.generate_key().decode(), str(tmp_path / "user_data.db"), pool_size=2)
+    yield db
+    db.close()
+
+@pytest.fixture
+def recording_sender():
+    return RecordingSender()
+
+@pytest.fixture
+def viber_bot(user_data_db, recording_sender):
+    import constants
+    from ai_clients import AIClients
+    from bot import ViberBot
+    from utils import Settings
+    from viberbot import Api
+    from viberbot.api.bot_configuration import BotConfiguration
+    viber_api = Api(BotConfiguration(AUTH_TOKEN, "Test", ""))
+    return ViberBot(Settings({constants.STREAMING_ENABLED_ENV: "false"}), viber_api, recording_sender, user_data_db, AIClients())
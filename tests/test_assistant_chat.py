@@ -0,0 +1,101 @@
+import asyncio
+
+import openai
+import pytest
+
+from assistant_chat import AssistantChat
+from context_window import ContextWindow
+
+class UpstreamError(Exception):
+    pass
+
+def fail(*args, **kwargs):
+    raise UpstreamError("timeout")
+
+def stream_then_fail(*args, **kwargs):
+    yield {"choices": [{"delta": {"content": "Partial"}}]}
+    raise UpstreamError("connection reset")
+
+def reply(model=None, messages=None, stream=False, **kwargs):
+    if stream:
+        return iter([{"choices": [{"delta": {"content": "Streamed answer"}}]}])
+    return {"choices": [{"message": {"content": "Answer"}}], "usage": {"prompt_tokens": 10}}
+
+class StubAsyncAIClients:
+    def __init__(self, response=None, chunks: list | None = None, error: Exception | None = None):
+        self._response = response
+        self._chunks = chunks
+        self._error = error
+
+    async def chat_completion(self, api_key, model, messages, stream=False):
+        if not stream:
+            if self._error:
+                raise self._error
+            return self._response
+
+        async def chunks():
+            for chunk in self._chunks:
+                yield chunk
+            raise self._error
+        return chunks()
+
+def answered_chat() -> AssistantChat:
+    chat = AssistantChat("a poet")
+    for question in ["First question " * 20, "Second question " * 20]:
+        chat._append_message("user", question)
+        chat._append_message("assistant", "An answer " * 20)
+    return chat
+
+def snapshot(chat: AssistantChat) -> dict:
+    return chat.to_dict()
+
+# a small budget makes the failed turn drop the oldest messages, they have to come back as well
+@pytest.mark.parametrize("context_window", [None, ContextWindow(120)], ids=["unlimited", "trimmed"])
+def test_failed_call_leaves_history_unchanged(monkeypatch, context_window):
+    chat = answered_chat()
+    before = snapshot(chat)
+
+    monkeypatch.setattr(openai.ChatCompletion, "create", fail)
+    with pytest.raises(UpstreamError):
+        chat.ask("sk-test", "Third question", context_window)
+    assert snapshot(chat) == before
+
+    monkeypatch.setattr(openai.ChatCompletion, "create", stream_then_fail)
+    with pytest.raises(UpstreamError):
+        list(chat.ask_stream("sk-test", "Third question", context_window))
+    assert snapshot(chat) == before
+
+    monkeypatch.setattr(openai.ChatCompletion, "create", reply)
+    assert chat.ask("sk-test", "Third question", context_window) == "Answer"
+    assert [message["role"] for message in chat.messages[-2:]] == ["user", "assistant"]
+
+def test_abandoned_stream_leaves_history_unchanged(monkeypatch):
+    chat = answered_chat()
+    before = snapshot(chat)
+    monkeypatch.setattr(openai.ChatCompletion, "create", reply)
+
+    stream = chat.ask_stream("sk-test", "Third question")
+    next(stream)
+    stream.close()
+
+    assert snapshot(chat) == before
+
+def test_failed_async_call_leaves_history_unchanged():
+    chat = answered_chat()
+    before = snapshot(chat)
+
+    async def run():
+        with pytest.raises(UpstreamError):
+            await chat.ask_async(StubAsyncAIClients(error=UpstreamError("timeout")), "sk-test", "Third question")
+        assert snapshot(chat) == before
+
+        stream_clients = StubAsyncAIClients(chunks=[{"choices": [{"delta": {"content": "Partial"}}]}], error=UpstreamError("reset"))
+        with pytest.raises(UpstreamError):
+            async for _ in chat.ask_stream_async(stream_clients, "sk-test", "Third question"):
+                pass
+        assert snapshot(chat) == before
+
+        answer = await chat.ask_async(StubAsyncAIClients(response=reply()), "sk-test", "Third question")
+        assert answer == "Answer"
+
+    asyncio.run(run())
@@ -0,0 +1,56 @@
+import threading
+from collections import Counter
+
+import pytest
+
+from broadcast import RECEIVER_NOT_SUBSCRIBED_STATUS, Broadcaster
+from DBService.broadcast_service import BroadcastDatabaseService, BroadcastStatus
+
+class StubBroadcastSender:
+    # fails the calls of the batches starting at the given receivers, once each
+    def __init__(self, failing_batch_starts: set[str] = frozenset(), not_subscribed: set[str] = frozenset()):
+        self._failing_batch_starts = set(failing_batch_starts)
+        self._not_subscribed = not_subscribed
+        self._lock = threading.Lock()
+        self.delivered = Counter()
+
+    def broadcast_messages(self, receivers: list[str], messages: list) -> list[dict]:
+        with self._lock:
+            if receivers[0] in self._failing_batch_starts:
+                self._failing_batch_starts.discard(receivers[0])
+                raise Exception("status code 500")
+            failed_list = [
+                {"receiver": receiver, "status": RECEIVER_NOT_SUBSCRIBED_STATUS, "status_message": "notSubscribed"}
+                for receiver in receivers if receiver in self._not_subscribed
+            ]
+            self.delivered.update(receiver for receiver in receivers if receiver not in self._not_subscribed)
+            return failed_list
+
+@pytest.fixture
+def broadcast_db(tmp_path):
+    db = BroadcastDatabaseService(str(tmp_path / "broadcasts.db"))
+    yield db
+    db.close()
+
+@pytest.fixture
+def user_ids(user_data_db) -> list[str]:
+    user_ids = [f"user-{index:03}" for index in range(25)]
+    for user_id in user_ids:
+        user_data_db.load_user_data(user_id)
+    return user_ids
+
+def test_failed_batch_is_sent_again_on_resume(user_data_db, broadcast_db, user_ids):
+    sender = StubBroadcastSender(failing_batch_starts={"user-010"}, not_subscribed={"user-024"})
+    broadcaster = Broadcaster(user_data_db, broadcast_db, sender, concurrency=2, page_size=10, batch_size=5)
+    broadcast_id = broadcaster.create("Maintenance tonight")
+
+    result = broadcaster.run(broadcast_id)
+    assert result["status"] == BroadcastStatus.RUNNING.value
+    assert (result["sent"], result["failed"]) == (19, 6)
+    assert broadcast_db.get_unsent_receivers(broadcast_id) == user_ids[10:15]
+
+    result = broadcaster.run(broadcast_id)
+    assert result["status"] == BroadcastStatus.DONE.value
+    assert (result["sent"], result["failed"]) == (24, 1)
+    assert broadcast_db.get_failures(broadcast_id) == [("user-024", RECEIVER_NOT_SUBSCRIBED_STATUS, "notSubscribed")]
+    assert sender.delivered == Counter(user_ids[:24])
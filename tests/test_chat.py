@@ -0,0 +1,24 @@
+import openai
+
+import constants
+import keyboards
+
+from conftest import text_message_body
+
+def reply(model=None, messages=None, stream=False, **kwargs):
+    return {"choices": [{"message": {"content": "Paris"}}], "usage": {"prompt_tokens": 10}}
+
+def test_chat_message_is_answered(viber_bot, user_data_db, recording_sender, monkeypatch):
+    user_data_db.load_user_data("user-1")
+    user_data_db.update_user_data("user-1", {"api_key": user_data_db.encrypt_api_key("sk-test")})
+    monkeypatch.setattr(openai.ChatCompletion, "create", reply)
+
+    viber_bot.handle_request(text_message_body("user-1", keyboards.get_button_action(keyboards.START_CHAT_BUTTON), 1))
+    viber_bot.handle_request(text_message_body("user-1", "__chatbot_role__", 2))
+    viber_bot.handle_request(text_message_body("user-1", "What is the capital of France?", 3))
+
+    texts = [message["text"] for _, messages, _ in recording_sender.sent[-2:] for message in messages]
+    assert texts == [constants.ASSISTANT_IS_ANSWERING_MESSAGE, "Paris"]
+    assert recording_sender.sent[-1][2] == keyboards.get_registered_keyboard(keyboards.END_CHAT_KEYBOARD_ID).payload_json
+    chat = viber_bot._chat_sessions.get("user-1")
+    assert [message["content"] for message in chat.messages[-2:]] == ["What is the capital of France?", "Paris"]
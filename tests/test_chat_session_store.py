@@ -0,0 +1,54 @@
+import openai
+import pytest
+from cryptography.fernet import Fernet
+
+from chat_session_store import ChatSessionStore
+from DBService.db_service import UserDataDatabaseService
+
+def reply_with_history_length(model=None, messages=None, **kwargs):
+    return {"choices": [{"message": {"content": f"reply to {len(messages)} messages"}}], "usage": {"prompt_tokens": 10}}
+
+@pytest.fixture
+def worker_stores(tmp_path, monkeypatch):
+    # two stores on one database file stand in for two worker processes
+    monkeypatch.setattr(openai.ChatCompletion, "create", reply_with_history_length)
+    encryption_key = Fernet.generate_key().decode()
+    databases = [UserDataDatabaseService(encryption_key, str(tmp_path / "user_data.db"), pool_size=1) for _ in range(2)]
+    yield [ChatSessionStore(db) for db in databases]
+    for db in databases:
+        db.close()
+
+def test_cached_chat_is_reloaded_after_another_worker_saved_it(worker_stores):
+    first, second = worker_stores
+    first.start("user-1", "a poet")
+    assert first.get("user-1") is not None
+
+    chat = second.get("user-1")
+    chat.ask("sk-test", "Hello")
+    second.save("user-1", chat)
+
+    chat = first.get("user-1")
+    assert [message["role"] for message in chat.messages] == ["system", "user", "assistant"]
+    chat.ask("sk-test", "And again")
+    first.save("user-1", chat)
+
+    assert len(second.get("user-1").messages) == 5
+    assert first.stats()["stale_reloads"] == 1
+    assert second.stats()["stale_reloads"] == 1
+
+def test_cached_chat_is_dropped_after_another_worker_ended_it(worker_stores):
+    first, second = worker_stores
+    first.start("user-1", "a poet")
+    assert second.get("user-1") is not None
+
+    first.end("user-1")
+
+    assert second.get("user-1") is None
+    assert second.stats()["live_sessions"] == 0
+
+def test_unchanged_chat_is_served_from_memory(worker_stores):
+    store, _ = worker_stores
+    chat = store.start("user-1", "a poet")
+
+    assert store.get("user-1") is chat
+    assert store.stats()["rehydrations"] == 0
@@ -0,0 +1,41 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bot
+import constants
+from api_key_limiter import ApiKeyLimiter
+from chat_state import ChatState
+from transcription import TranscriptionPipeline
+
+from test_transcription import StubSegmenter, media_file
+
+def file_message_body(user_id: str, size: int) -> bytes:
+    return json.dumps({
+        "event": "message",
+        "timestamp": 1700000000000,
+        "message_token": 1,
+        "sender": {"id": user_id, "name": "Test"},
+        "message": {"type": "file", "media": "https://example.com/voice.mp3", "size": size, "file_name": "voice.mp3"}
+    }).encode()
+
+def test_file_with_more_segments_than_in_flight_slots_is_transcribed(viber_bot, user_data_db, recording_sender, monkeypatch):
+    user_data_db.load_user_data("user-1")
+    user_data_db.update_user_data("user-1", {"api_key": user_data_db.encrypt_api_key("sk-test"),
+                                             "chat_state": ChatState.PROVIDING_MEDIA_FILE.value})
+    texts = [f"part {index}" for index in range(5)]
+    # one in flight slot and a short queue timeout, segments waiting for a slot each would fail
+    monkeypatch.setattr(viber_bot, "_api_key_limiter", ApiKeyLimiter(max_in_flight=1, queue_timeout=0.05))
+    monkeypatch.setattr(viber_bot, "_transcription_pipeline",
+                        TranscriptionPipeline(ThreadPoolExecutor(4), StubSegmenter(texts), split_threshold_bytes=100))
+    monkeypatch.setattr(bot, "download_media", lambda *args, **kwargs: media_file(4096))
+
+    def transcribe(api_key, media) -> str:
+        time.sleep(0.1)
+        return media.read().decode()
+    monkeypatch.setattr(viber_bot._ai_clients, "transcribe", transcribe)
+
+    viber_bot.handle_request(file_message_body("user-1", 4096))
+
+    sent_texts = [message["text"] for _, messages, _ in recording_sender.sent for message in messages]
+    assert sent_texts == [constants.TRANSCRIPTION_IN_PROGRESS_MESSAGE] + texts
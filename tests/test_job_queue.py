@@ -0,0 +1,44 @@
+import pytest
+
+from DBService.job_queue_service import JobQueueDatabaseService
+
+@pytest.fixture
+def job_queues(tmp_path, monkeypatch):
+    # two worker processes sharing one jobs.db
+    first = JobQueueDatabaseService(str(tmp_path / "jobs.db"))
+    second = JobQueueDatabaseService(str(tmp_path / "jobs.db"))
+    monkeypatch.setattr(second, "_lease_owner", "other-host:1")
+    yield first, second
+    first.close()
+    second.close()
+
+def test_user_leased_by_another_process_is_skipped(job_queues):
+    first, second = job_queues
+    first_job_id = first.enqueue("user-1", b"first")
+    second_job_id = first.enqueue("user-1", b"second")
+    other_user_job_id = first.enqueue("user-2", b"other")
+    no_user_job_id = first.enqueue(None, b"no user")
+
+    assert [job.id for job in first.claim(1)] == [first_job_id]
+    assert [job.id for job in second.claim(10)] == [other_user_job_id, no_user_job_id]
+
+    first.complete(first_job_id)
+    assert [job.id for job in second.claim(10)] == [second_job_id]
+
+def test_user_leased_by_the_same_process_is_claimed(job_queues):
+    first, _ = job_queues
+    first_job_id = first.enqueue("user-1", b"first")
+    second_job_id = first.enqueue("user-1", b"second")
+
+    assert [job.id for job in first.claim(1)] == [first_job_id]
+    assert [job.id for job in first.claim(1)] == [second_job_id]
+
+def test_expired_lease_of_another_process_does_not_block_the_user(job_queues, monkeypatch):
+    first, second = job_queues
+    first_job_id = first.enqueue("user-1", b"first")
+    second_job_id = first.enqueue("user-1", b"second")
+    # the first process claims with a lease that is already expired, as if it had died
+    monkeypatch.setattr(first, "_lease_seconds", -1.0)
+    first.claim(1)
+
+    assert [job.id for job in second.claim(10)] == [first_job_id, second_job_id]
@@ -0,0 +1,85 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+import constants
+from DBService.message_dedup_service import MessageDedupDatabaseService
+from message_deduplicator import MessageDeduplicator
+
+from conftest import delivered_body, sign
+from parity_check import Lifespan, asgi_request
+
+class FailingOnce:
+    # fails the first enqueue like a locked or full job queue database would
+    def __init__(self, submit):
+        self._submit = submit
+        self.calls = 0
+
+    def __call__(self, user_id, request_data):
+        self.calls += 1
+        if self.calls == 1:
+            raise sqlite3.OperationalError("database is locked")
+        return self._submit(user_id, request_data)
+
+class AsyncFailingOnce(FailingOnce):
+    async def __call__(self, user_id, request_data):
+        self.calls += 1
+        if self.calls == 1:
+            raise sqlite3.OperationalError("database is locked")
+        await self._submit(user_id, request_data)
+
+@pytest.fixture(params=[False, True], ids=["memory", "persistent"])
+def dedup_config(request, app_config) -> dict:
+    return dict(app_config, **{constants.DEDUP_PERSISTENT_ENV: str(request.param).lower()})
+
+@pytest.mark.parametrize("persistent", [False, True])
+def test_forgotten_token_is_not_a_duplicate(tmp_path, persistent):
+    dedup_db = MessageDedupDatabaseService(str(tmp_path / "message_dedup.db")) if persistent else None
+    deduplicator = MessageDeduplicator(dedup_db=dedup_db)
+
+    assert not deduplicator.is_duplicate("message", 1)
+    assert deduplicator.is_duplicate("message", 1)
+    deduplicator.forget("message", 1)
+    assert not deduplicator.is_duplicate("message", 1)
+    assert deduplicator.is_duplicate("message", 1)
+
+def test_flask_redelivery_after_failed_enqueue_is_processed(dedup_config):
+    import bot
+    app = bot.create_app(dedup_config)
+    worker = app.extensions["viber_bot"].get()
+    submit = FailingOnce(worker.request_dispatcher.submit)
+    worker.request_dispatcher.submit = submit
+    client = app.test_client()
+    body = delivered_body("user-1", 42)
+    headers = {"X-Viber-Content-Signature": sign(body)}
+    try:
+        assert client.post("/", data=body, headers=headers).status_code == 500
+        assert client.post("/", data=body, headers=headers).status_code == 200
+        assert client.post("/", data=body, headers=headers).status_code == 200
+        assert submit.calls == 2
+    finally:
+        worker.request_dispatcher.shutdown()
+
+def test_asgi_redelivery_after_failed_enqueue_is_processed(dedup_config):
+    import bot_asgi
+
+    async def run():
+        app = bot_asgi.create_asgi_app(dedup_config)
+        lifespan = Lifespan(app)
+        await lifespan.startup()
+        try:
+            worker = await app.get_worker()
+            submit = AsyncFailingOnce(worker.request_dispatcher.submit)
+            worker.request_dispatcher.submit = submit
+            body = delivered_body("user-1", 42)
+            headers = [(b"x-viber-content-signature", sign(body).encode())]
+            with pytest.raises(sqlite3.OperationalError):
+                await asgi_request(app, "POST", "/", body, headers)
+            assert await asgi_request(app, "POST", "/", body, headers) == 200
+            assert await asgi_request(app, "POST", "/", body, headers) == 200
+            assert submit.calls == 2
+        finally:
+            await lifespan.shutdown()
+
+    asyncio.run(run())
@@ -0,0 +1,21 @@
+import sqlite3
+
+from DBService.migrations import MIGRATIONS, get_schema_version, migrate
+
+def index_names(connection: sqlite3.Connection) -> set[str]:
+    return {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL")}
+
+def test_each_index_is_created_with_its_column_or_table():
+    connection = sqlite3.connect(":memory:")
+    expected_indexes = {
+        "_create_chat_sessions_table": {"chat_sessions_updated_at"},
+        "_add_unsubscribed_at_column": {"user_data_unsubscribed_at"}
+    }
+
+    indexes = index_names(connection)
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        migrate(connection, MIGRATIONS[:version])
+        assert get_schema_version(connection) == version
+        new_indexes = index_names(connection) - indexes
+        assert new_indexes == expected_indexes.get(migration.__name__, set()), migration.__name__
+        indexes |= new_indexes
@@ -0,0 +1,41 @@
+import argparse
+import asyncio
+
+import openai
+import pytest
+
+import bot
+import bot_asgi
+from async_http import AsyncViberMessageSender
+from viber_sender import ViberMessageSender
+
+from parity_check import compare, run_asyncio, run_sync, user_requests
+
+@pytest.fixture(autouse=True)
+def restore_stubbed_attributes(monkeypatch):
+    # the parity check installs its stubs on the modules, they are put back after the test
+    for target, name in [
+        (openai.ChatCompletion, "create"),
+        (bot, "download_media"),
+        (bot.ViberBot, "handle_request"),
+        (ViberMessageSender, "_post"),
+        (bot_asgi, "download_media_async"),
+        (bot_asgi.AsyncViberBot, "handle_request_async"),
+        (AsyncViberMessageSender, "_post"),
+    ]:
+        monkeypatch.setattr(target, name, getattr(target, name))
+
+@pytest.mark.parametrize("streaming", [False, True], ids=["buffered", "streaming"])
+def test_flask_and_asgi_modes_send_the_same_replies(streaming):
+    args = argparse.Namespace(concurrency=4, openai_latency=0.0, viber_latency=0.0, streaming=streaming, timeout=30.0)
+    users = [user_requests(user_index) for user_index in range(3)]
+
+    sync_result = run_sync(args, users)
+    asyncio_result = asyncio.run(run_asyncio(args, users))
+
+    assert sync_result["failures"] == 0
+    assert asyncio_result["failures"] == 0
+    # every user gets a reply on each step of the script
+    assert len(sync_result["messages_by_user"]) == len(users)
+    assert all(len(messages) >= len(users[0]) for messages in sync_result["messages_by_user"].values())
+    assert compare(sync_result["messages_by_user"], asyncio_result["messages_by_user"]) == []
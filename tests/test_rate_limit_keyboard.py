@@ -0,0 +1,50 @@
+import pytest
+
+import constants
+import keyboards
+from api_key_limiter import RateLimitExceededError
+
+from conftest import text_message_body
+
+def raise_rate_limit(*args, **kwargs):
+    raise RateLimitExceededError("queue timeout")
+
+def store_user(user_data_db, user_id: str, fields: dict):
+    # loading adds the user row
+    user_data_db.load_user_data(user_id)
+    user_data_db.update_user_data(user_id, fields)
+
+def last_reply(recording_sender) -> tuple[list[str], str | None]:
+    _, messages, keyboard_json = recording_sender.sent[-1]
+    return [message["text"] for message in messages], keyboard_json
+
+@pytest.mark.parametrize("last_keyboard", [None, '{"Type": "keyboard", "Buttons": []}'])
+def test_throttled_user_with_api_key_gets_main_keyboard(viber_bot, user_data_db, recording_sender, monkeypatch, last_keyboard):
+    # no last keyboard: new user or cleared by retention, unknown json: legacy row the migration could not map
+    store_user(user_data_db, "user-1", {"api_key": user_data_db.encrypt_api_key("sk-test"), "last_keyboard": last_keyboard})
+    monkeypatch.setattr(viber_bot.api_key_limiter, "limit", raise_rate_limit)
+
+    viber_bot.handle_request(text_message_body("user-1", "What is the capital of France?"))
+
+    texts, keyboard_json = last_reply(recording_sender)
+    assert texts == [constants.TOO_MANY_REQUESTS_MESSAGE]
+    assert keyboard_json == keyboards.get_registered_keyboard(keyboards.MAIN_KEYBOARD_ID).payload_json
+    assert user_data_db.load_user_data("user-1")["last_keyboard"] == keyboards.MAIN_KEYBOARD_ID
+
+def test_throttled_user_without_api_key_gets_set_api_key_keyboard(viber_bot, user_data_db, recording_sender, monkeypatch):
+    monkeypatch.setattr(viber_bot, "_route_request", raise_rate_limit)
+
+    viber_bot.handle_request(text_message_body("user-2", "Hello"))
+
+    texts, keyboard_json = last_reply(recording_sender)
+    assert texts == [constants.TOO_MANY_REQUESTS_MESSAGE]
+    assert keyboard_json == keyboards.get_registered_keyboard(keyboards.SET_API_KEY_KEYBOARD_ID).payload_json
+
+def test_throttled_user_keeps_last_keyboard(viber_bot, user_data_db, recording_sender, monkeypatch):
+    store_user(user_data_db, "user-3", {"last_keyboard": keyboards.IMAGE_SIZE_KEYBOARD_ID})
+    monkeypatch.setattr(viber_bot, "_route_request", raise_rate_limit)
+
+    viber_bot.handle_request(text_message_body("user-3", "Hello"))
+
+    _, keyboard_json = last_reply(recording_sender)
+    assert keyboard_json == keyboards.get_registered_keyboard(keyboards.IMAGE_SIZE_KEYBOARD_ID).payload_json
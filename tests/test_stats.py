@@ -0,0 +1,112 @@
+import asyncio
+import json
+
+import pytest
+
+import constants
+from parity_check import Lifespan
+
+from conftest import ADMIN_TOKEN
+
+ADMIN_PATHS = ["/stats", "/metrics", "/debug/profiler"]
+
+def admin_headers(token: str | None = ADMIN_TOKEN) -> dict:
+    return {"Authorization": f"Bearer {token}"} if token else {}
+
+async def asgi_get(app, path: str, headers: dict) -> tuple[int, bytes]:
+    response = {"body": []}
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+        elif message["type"] == "http.response.body":
+            response["body"].append(message.get("body", b""))
+
+    scope_headers = [(name.lower().encode(), value.encode()) for name, value in headers.items()]
+    await app({"type": "http", "method": "GET", "path": path, "query_string": b"", "headers": scope_headers}, receive, send)
+    return response["status"], b"".join(response["body"])
+
+def test_flask_stats_report_api_key_cache(app_config):
+    import bot
+    app = bot.create_app(app_config)
+    worker = app.extensions["viber_bot"].get()
+    try:
+        db = worker.bot.user_data_db
+        db.load_user_data("user-1")
+        db.update_user_data("user-1", {"api_key": db.encrypt_api_key("sk-test")})
+        for _ in range(3):
+            db.decrypt_api_key("user-1", db.load_user_data("user-1")["api_key"])
+
+        stats = app.test_client().get("/stats", headers=admin_headers()).get_json()
+        assert stats["api_key_cache"]["misses"] == 1
+        assert stats["api_key_cache"]["hits"] == 2
+    finally:
+        worker.request_dispatcher.shutdown()
+
+def test_asgi_stats_report_api_key_cache(app_config):
+    import bot_asgi
+
+    async def run() -> tuple[int, bytes]:
+        app = bot_asgi.create_asgi_app(app_config)
+        lifespan = Lifespan(app)
+        await lifespan.startup()
+        try:
+            return await asgi_get(app, "/stats", admin_headers())
+        finally:
+            await lifespan.shutdown()
+
+    status, body = asyncio.run(run())
+    assert status == 200
+    assert json.loads(body)["api_key_cache"] == {"size": 0, "hits": 0, "misses": 0, "evictions": 0}
+
+# admin endpoints are hidden without a configured token as well as from requests with a missing or wrong one
+UNAUTHORIZED_CASES = [(ADMIN_TOKEN, None), (ADMIN_TOKEN, "wrong-token"), (None, ADMIN_TOKEN)]
+UNAUTHORIZED_IDS = ["missing_token", "wrong_token", "not_configured"]
+
+def admin_config(app_config: dict, configured_token: str | None) -> dict:
+    config = dict(app_config, **{constants.PROFILER_ENABLED_ENV: "true"})
+    if configured_token is None:
+        del config[constants.ADMIN_TOKEN_ENV]
+    return config
+
+@pytest.mark.parametrize("configured_token, request_token", UNAUTHORIZED_CASES, ids=UNAUTHORIZED_IDS)
+def test_flask_admin_endpoints_require_admin_token(app_config, monkeypatch, configured_token, request_token):
+    import bot
+    monkeypatch.delenv(constants.ADMIN_TOKEN_ENV, raising=False)
+    app = bot.create_app(admin_config(app_config, configured_token))
+    client = app.test_client()
+
+    for path in ADMIN_PATHS:
+        assert client.get(path, headers=admin_headers(request_token)).status_code == 404, path
+    assert client.post("/debug/profiler", headers=admin_headers(request_token)).status_code == 404
+    # nothing was served, so the worker was not even created
+    assert not app.extensions["viber_bot"].initialized
+
+def test_flask_admin_endpoints_accept_admin_token(app_config):
+    import bot
+    app = bot.create_app(admin_config(app_config, ADMIN_TOKEN))
+    client = app.test_client()
+    try:
+        for path in ADMIN_PATHS:
+            assert client.get(path, headers=admin_headers()).status_code == 200, path
+    finally:
+        app.extensions["viber_bot"].get().request_dispatcher.shutdown()
+
+@pytest.mark.parametrize("configured_token, request_token", UNAUTHORIZED_CASES, ids=UNAUTHORIZED_IDS)
+def test_asgi_admin_endpoints_require_admin_token(app_config, monkeypatch, configured_token, request_token):
+    import bot_asgi
+    monkeypatch.delenv(constants.ADMIN_TOKEN_ENV, raising=False)
+
+    async def run() -> list[int]:
+        app = bot_asgi.create_asgi_app(admin_config(app_config, configured_token))
+        lifespan = Lifespan(app)
+        await lifespan.startup()
+        try:
+            return [(await asgi_get(app, path, admin_headers(request_token)))[0] for path in ADMIN_PATHS]
+        finally:
+            await lifespan.shutdown()
+
+    assert asyncio.run(run()) == [404] * len(ADMIN_PATHS)
@@ -0,0 +1,135 @@
+import asyncio
+import os
+import stat
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from transcription import FFmpegSegmenter, TranscriptionPipeline, remove_overlap
+from utils import SpooledMediaFile
+
+@pytest.mark.parametrize("previous_text, text, expected", [
+    ("we went to the old harbour", "the old harbour was empty", "was empty"),
+    ("We went to the old Harbour.", "harbour, was empty", "was empty"),
+    ("we went to the old harbour", "nobody was there", "nobody was there"),
+    ("the end", "the end", ""),
+    ("", "first words", "first words"),
+    # only the end of the previous segment counts as overlap
+    ("the cat sat on the mat", "the cat ran away", "the cat ran away"),
+])
+def test_remove_overlap(previous_text, text, expected):
+    assert remove_overlap(previous_text, text) == expected
+
+def write_script(path, body: str) -> str:
+    with open(path, "w") as script:
+        script.write("#!/bin/sh\n" + body)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return str(path)
+
+def test_segmenter_splits_into_overlapping_segments(tmp_path):
+    # the stub ffmpeg writes its arguments into the segment it is asked for
+    ffprobe = write_script(tmp_path / "ffprobe", "echo 25.0\n")
+    ffmpeg = write_script(tmp_path / "ffmpeg", 'for last; do :; done\necho "$@" > "$last"\n')
+    output_dir = tmp_path / "segments"
+    output_dir.mkdir()
+
+    segment_paths = FFmpegSegmenter(ffmpeg, ffprobe).split("voice.mp3", 10.0, 2.0, str(output_dir))
+
+    assert [os.path.basename(path) for path in segment_paths] == ["segment_0000.mp3", "segment_0001.mp3", "segment_0002.mp3"]
+    arguments = [open(path).read().split() for path in segment_paths]
+    assert [args[args.index("-ss") + 1] for args in arguments] == ["0.0", "10.0", "20.0"]
+    assert all(args[args.index("-t") + 1] == "12.0" for args in arguments)
+    assert all(args[args.index("-i") + 1] == "voice.mp3" for args in arguments)
+
+class StubSegmenter:
+    # every segment file holds the text its transcription returns
+    def __init__(self, texts: list[str], available: bool = True):
+        self._texts = texts
+        self._available = available
+        self.split_calls = 0
+
+    def is_available(self) -> bool:
+        return self._available
+
+    def split(self, media_path: str, segment_seconds: float, overlap_seconds: float, output_dir: str) -> list[str]:
+        self.split_calls += 1
+        segment_paths = []
+        for index, text in enumerate(self._texts):
+            segment_path = os.path.join(output_dir, f"segment_{index:04d}.mp3")
+            with open(segment_path, "w") as segment_file:
+                segment_file.write(text)
+            segment_paths.append(segment_path)
+        return segment_paths
+
+SEGMENT_TEXTS = [
+    "Welcome to the show. Today we talk about",
+    "we talk about boats and the sea. It is",
+    "it is calm today.",
+]
+EXPECTED_PARTS = ["Welcome to the show. Today we talk about", "boats and the sea. It is", "calm today."]
+
+def media_file(size: int) -> SpooledMediaFile:
+    media = SpooledMediaFile("voice.mp3", spool_threshold=1024)
+    media.write(b"\0" * size)
+    media.seek(0)
+    return media
+
+def transcribe_segment(segment_file) -> str:
+    text = segment_file.read().decode()
+    # earlier segments take longer, the parts still have to arrive in order
+    time.sleep(0.05 if text.startswith("Welcome") else 0.0)
+    return text
+
+def test_large_file_is_transcribed_in_ordered_segments():
+    segmenter = StubSegmenter(SEGMENT_TEXTS)
+    pipeline = TranscriptionPipeline(ThreadPoolExecutor(3), segmenter, split_threshold_bytes=100)
+    parts = []
+
+    assert pipeline.transcribe_file(media_file(4096), transcribe_segment, parts.append) == 3
+    assert parts == EXPECTED_PARTS
+
+def test_large_file_is_transcribed_in_ordered_segments_async():
+    segmenter = StubSegmenter(SEGMENT_TEXTS)
+    pipeline = TranscriptionPipeline(ThreadPoolExecutor(3), segmenter, split_threshold_bytes=100)
+    parts = []
+
+    async def transcribe(segment_file) -> str:
+        text = segment_file.read().decode()
+        await asyncio.sleep(0.05 if text.startswith("Welcome") else 0.0)
+        return text
+
+    async def on_part(part: str):
+        parts.append(part)
+
+    assert asyncio.run(pipeline.transcribe_file_async(media_file(4096), transcribe, on_part)) == 3
+    assert parts == EXPECTED_PARTS
+
+@pytest.mark.parametrize("size, available", [(50, True), (4096, False)], ids=["small_file", "no_ffmpeg"])
+def test_file_is_transcribed_in_one_request(size, available):
+    segmenter = StubSegmenter(SEGMENT_TEXTS, available)
+    pipeline = TranscriptionPipeline(ThreadPoolExecutor(1), segmenter, split_threshold_bytes=100)
+    parts = []
+
+    assert pipeline.transcribe_file(media_file(size), lambda media: f"{len(media.read())} bytes", parts.append) == 1
+    assert parts == [f"{size} bytes"]
+    assert segmenter.split_calls == 0
+
+def test_async_segments_are_bounded_by_max_parallel_segments():
+    segmenter = StubSegmenter([f"segment {index}" for index in range(6)])
+    pipeline = TranscriptionPipeline(ThreadPoolExecutor(2), segmenter, split_threshold_bytes=100, max_parallel_segments=2)
+    in_flight = []
+    max_in_flight = []
+
+    async def transcribe(segment_file) -> str:
+        in_flight.append(segment_file)
+        max_in_flight.append(len(in_flight))
+        await asyncio.sleep(0.01)
+        in_flight.remove(segment_file)
+        return segment_file.read().decode()
+
+    async def on_part(part: str):
+        pass
+
+    assert asyncio.run(pipeline.transcribe_file_async(media_file(4096), transcribe, on_part)) == 6
+    assert max(max_in_flight) == 2
@@ -0,0 +1,145 @@
+import asyncio
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+from viberbot.api.bot_configuration import BotConfiguration
+from viberbot.api.messages.text_message import TextMessage
+
+import viber_sender
+from async_http import AsyncViberMessageSender
+from viber_sender import ViberMessageSender
+
+from conftest import AUTH_TOKEN
+
+OK = (200, {}, {"status": 0, "message_token": 7})
+SLOW = "slow"
+DROP = "drop"
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # clients which timed out close the connection before the answer is written
+        pass
+
+class StubViberApi:
+    # answers the send_message calls with the scripted responses, the last one is repeated
+    def __init__(self, responses: list):
+        self.responses = responses
+        self.calls = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers["Content-Length"]))
+                response = stub.responses[min(stub.calls, len(stub.responses) - 1)]
+                stub.calls += 1
+                if response == DROP:
+                    # the request was received, the connection is closed without an answer
+                    self.close_connection = True
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                    return
+                if response == SLOW:
+                    time.sleep(0.5)
+                    response = OK
+                status, headers, body = response
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = QuietHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self._server.server_port}/"
+        self._thread = threading.Thread(target=self._server.serve_forever, args=(0.01,), daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+def unused_url() -> str:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{s.getsockname()[1]}/"
+
+def bot_configuration() -> BotConfiguration:
+    return BotConfiguration(AUTH_TOKEN, "Test", "")
+
+def send(api_url: str, **kwargs) -> list:
+    sender = ViberMessageSender(bot_configuration(), api_url=api_url, backoff_seconds=0.001, timeout=0.2, **kwargs)
+    try:
+        return sender.send_messages("user-1", [TextMessage(text="Hello")])
+    finally:
+        sender.close()
+
+def send_async(api_url: str, **kwargs) -> list:
+    async def run():
+        sender = AsyncViberMessageSender(bot_configuration(), api_url=api_url, backoff_seconds=0.001, timeout=0.2, **kwargs)
+        try:
+            return await sender.send_messages("user-1", [TextMessage(text="Hello")])
+        finally:
+            await sender.close()
+    return asyncio.run(run())
+
+@pytest.fixture(params=[send, send_async], ids=["sync", "asyncio"])
+def send_message(request):
+    return request.param
+
+def test_too_many_requests_is_retried(send_message):
+    with StubViberApi([(429, {}, {}), (429, {}, {}), OK]) as api:
+        assert send_message(api.url) == [7]
+    assert api.calls == 3
+
+def test_too_many_requests_gives_up_after_max_retries(send_message):
+    with StubViberApi([(429, {}, {})]) as api:
+        with pytest.raises(Exception, match="after 3 attempts"):
+            send_message(api.url, max_retries=2)
+    assert api.calls == 3
+
+@pytest.mark.parametrize("status", [500, 502, 503, 504])
+def test_server_errors_are_not_resent(send_message, status):
+    with StubViberApi([(status, {}, {}), OK]) as api:
+        with pytest.raises(Exception):
+            send_message(api.url)
+    assert api.calls == 1
+
+@pytest.mark.parametrize("response", [SLOW, DROP], ids=["read_timeout", "connection_dropped"])
+def test_failures_after_the_request_was_sent_are_not_resent(send_message, response):
+    with StubViberApi([response, OK]) as api:
+        with pytest.raises(Exception):
+            send_message(api.url)
+    assert api.calls == 1
+
+def test_refused_connection_is_retried(send_message, caplog):
+    with pytest.raises(Exception, match="after 3 attempts"):
+        send_message(unused_url(), max_retries=2)
+    assert sum("retrying in" in record.getMessage() for record in caplog.records) == 2
+
+def test_backoff_doubles_and_honours_retry_after(monkeypatch):
+    delays = []
+    monkeypatch.setattr(viber_sender.time, "sleep", delays.append)
+    with StubViberApi([(429, {}, {}), (429, {}, {}), (429, {"Retry-After": "3"}, {}), OK]) as api:
+        sender = ViberMessageSender(bot_configuration(), api_url=api.url, backoff_seconds=0.5, timeout=1.0)
+        assert sender.send_messages("user-1", [TextMessage(text="Hello")]) == [7]
+        sender.close()
+    assert delays == [0.5, 1.0, 3.0]
+
+def test_connect_errors_are_told_apart_from_sent_requests():
+    with pytest.raises(requests.ConnectionError) as refused:
+        requests.post(unused_url(), timeout=1.0)
+    assert viber_sender._is_connect_error(refused.value)
+    assert viber_sender._is_connect_error(requests.ConnectTimeout())
+    assert not viber_sender._is_connect_error(requests.ReadTimeout())
+    assert not viber_sender._is_connect_error(requests.ConnectionError("Connection aborted."))
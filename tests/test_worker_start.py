@@ -0,0 +1,29 @@
+import os
+import runpy
+import time
+from types import SimpleNamespace
+
+import constants
+from DBService.job_queue_service import JobQueueDatabaseService
+
+from conftest import REPO_ROOT, delivered_body
+
+def test_post_worker_init_processes_jobs_of_a_previous_run(app_config):
+    import bot
+    job_queue = JobQueueDatabaseService(app_config[constants.JOB_QUEUE_DB_ENV])
+    job_queue.enqueue("user-1", delivered_body("user-1", 1))
+    app = bot.create_app(app_config)
+    workers = app.extensions["viber_bot"]
+    assert not workers.initialized
+
+    gunicorn_config = runpy.run_path(os.path.join(REPO_ROOT, "gunicorn.conf.py"))
+    gunicorn_config["post_worker_init"](SimpleNamespace(wsgi=app))
+    try:
+        # no webhook arrives, the job is picked up by the worker started in the hook
+        deadline = time.monotonic() + 5.0
+        while job_queue.count_by_status()["done"] == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert job_queue.count_by_status()["done"] == 1
+    finally:
+        workers.get().request_dispatcher.shutdown()
+        job_queue.close()
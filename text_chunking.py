@@ -0,0 +1,111 @@
+import threading
+import time
+from typing import Callable
+
+VIBER_MAX_TEXT_LENGTH = 7000
+PARAGRAPH_BOUNDARIES = ("\n\n",)
+SENTENCE_BOUNDARIES = (". ", "! ", "? ", ".\n", "!\n", "?\n", "\n")
+
+def _find_split_position(text: str, limit: int) -> int:
+    # prefer paragraph ends, then sentence ends, then whitespace, and only cut words as the last resort
+    for boundaries in (PARAGRAPH_BOUNDARIES, SENTENCE_BOUNDARIES, (" ",)):
+        position = max(text.rfind(boundary, 0, limit) for boundary in boundaries)
+        if position > 0:
+            boundary_length = next(len(boundary) for boundary in boundaries if text.startswith(boundary, position))
+            return position + boundary_length
+    return limit
+
+def split_text(text: str, max_length: int = VIBER_MAX_TEXT_LENGTH) -> list[str]:
+    chunks = []
+    while len(text) > max_length:
+        split_position = _find_split_position(text, max_length)
+        chunks.append(text[:split_position].rstrip())
+        text = text[split_position:].lstrip()
+    if text.strip() or not chunks:
+        chunks.append(text)
+    return chunks
+
+class StreamingStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._streams = 0
+        self._first_message_time_total = 0.0
+        self._first_message_time_max = 0.0
+        self._completion_time_total = 0.0
+        self._chunks = 0
+
+    def record(self, first_message_time: float, completion_time: float, chunks_count: int):
+        with self._lock:
+            self._streams += 1
+            self._first_message_time_total += first_message_time
+            self._first_message_time_max = max(self._first_message_time_max, first_message_time)
+            self._completion_time_total += completion_time
+            self._chunks += chunks_count
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "streams": self._streams,
+                "time_to_first_message_avg": self._first_message_time_total / self._streams if self._streams else 0.0,
+                "time_to_first_message_max": self._first_message_time_max,
+                "completion_time_avg": self._completion_time_total / self._streams if self._streams else 0.0,
+                "chunks_per_stream_avg": self._chunks / self._streams if self._streams else 0.0
+            }
+
+class StreamChunker:
+    def __init__(self, on_chunk: Callable[[str], None], min_chunk_size: int = 200, flush_interval: float = 2.0,
+                 max_length: int = VIBER_MAX_TEXT_LENGTH, stats: StreamingStats | None = None):
+        self._on_chunk = on_chunk
+        self._min_chunk_size = min_chunk_size
+        self._flush_interval = flush_interval
+        self._max_length = max_length
+        self._stats = stats
+        self._buffer = ""
+        self._started_at = time.monotonic()
+        self._last_flush_time = None
+        self._first_message_time = None
+        self._chunks_count = 0
+
+    def _emit(self, chunk: str):
+        chunk = chunk.strip()
+        if not chunk:
+            return
+        now = time.monotonic()
+        if self._first_message_time is None:
+            self._first_message_time = now - self._started_at
+        self._last_flush_time = now
+        self._chunks_count += 1
+        self._on_chunk(chunk)
+
+    def feed(self, delta: str):
+        self._buffer += delta
+        while len(self._buffer) > self._max_length:
+            split_position = _find_split_position(self._buffer, self._max_length)
+            self._emit(self._buffer[:split_position])
+            self._buffer = self._buffer[split_position:]
+
+        if len(self._buffer) < self._min_chunk_size:
+            return
+        # the first chunk goes out as soon as it is big enough, later ones are spaced to avoid spamming the chat
+        if self._last_flush_time is not None and time.monotonic() - self._last_flush_time < self._flush_interval:
+            return
+
+        for boundaries in (PARAGRAPH_BOUNDARIES, SENTENCE_BOUNDARIES):
+            split_position = max(
+                self._buffer.rfind(boundary) + len(boundary) if boundary in self._buffer else 0
+                for boundary in boundaries
+            )
+            if split_position >= self._min_chunk_size:
+                self._emit(self._buffer[:split_position])
+                self._buffer = self._buffer[split_position:]
+                return
+
+    def finish(self) -> list[str]:
+        # the remaining text is returned instead of emitted so the caller can attach a keyboard to it
+        remaining_chunks = [chunk for chunk in split_text(self._buffer.strip(), self._max_length) if chunk]
+        self._buffer = ""
+        if self._stats is not None:
+            completion_time = time.monotonic() - self._started_at
+            first_message_time = self._first_message_time if self._first_message_time is not None else completion_time
+            self._stats.record(first_message_time, completion_time, self._chunks_count + len(remaining_chunks))
+        return remaining_chunks
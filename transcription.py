@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import Executor, wait
+from typing import Awaitable, BinaryIO, Callable
+
+from utils import SpooledMediaFile
+
+logger = logging.getLogger(__name__)
+
+# how many words at a segment border are compared when removing text transcribed twice in the overlap
+MAX_OVERLAP_WORDS = 30
+
+class FFmpegSegmenter:
+    def __init__(self, ffmpeg_path: str = "ffmpeg", ffprobe_path: str = "ffprobe"):
+        self._ffmpeg_path = ffmpeg_path
+        self._ffprobe_path = ffprobe_path
+
+    def is_available(self) -> bool:
+        return shutil.which(self._ffmpeg_path) is not None and shutil.which(self._ffprobe_path) is not None
+
+    def get_duration(self, media_path: str) -> float:
+        output = subprocess.run(
+            [self._ffprobe_path, "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", media_path],
+            check=True, capture_output=True, text=True
+        ).stdout
+        return float(output.strip())
+
+    def split(self, media_path: str, segment_seconds: float, overlap_seconds: float, output_dir: str) -> list[str]:
+        duration = self.get_duration(media_path)
+        segment_paths = []
+        start = 0.0
+        while start < duration:
+            segment_path = os.path.join(output_dir, f"segment_{len(segment_paths):04d}.mp3")
+            # only the audio track is kept, which also makes video segments much smaller
+            subprocess.run(
+                [self._ffmpeg_path, "-v", "error", "-y", "-ss", str(start), "-t", str(segment_seconds + overlap_seconds),
+                 "-i", media_path, "-vn", "-ac", "1", "-b:a", "64k", segment_path],
+                check=True, capture_output=True
+            )
+            segment_paths.append(segment_path)
+            start += segment_seconds
+        return segment_paths
+
+def _normalize_word(word: str) -> str:
+    return re.sub(r"\W", "", word.lower())
+
+def remove_overlap(previous_text: str, text: str) -> str:
+    previous_words = [_normalize_word(word) for word in previous_text.split()[-MAX_OVERLAP_WORDS:]]
+    words = text.split()
+    normalized_words = [_normalize_word(word) for word in words[:MAX_OVERLAP_WORDS]]
+    for overlap_length in range(min(len(previous_words), len(normalized_words)), 0, -1):
+        if previous_words[-overlap_length:] == normalized_words[:overlap_length]:
+            return " ".join(words[overlap_length:])
+    return text
+
+class TranscriptionPipeline:
+    def __init__(self, executor: Executor, segmenter: FFmpegSegmenter | None = None, segment_seconds: float = 600.0,
+                 overlap_seconds: float = 2.0, split_threshold_bytes: int = 24 * 1024 * 1024, max_parallel_segments: int = 4):
+        self._executor = executor
+        self._segmenter = segmenter if segmenter is not None else FFmpegSegmenter()
+        self._segment_seconds = segment_seconds
+        self._overlap_seconds = overlap_seconds
+        self._split_threshold_bytes = split_threshold_bytes
+        self._max_parallel_segments = max_parallel_segments
+
+    def transcribe_file(self, media_file: SpooledMediaFile, transcribe: Callable[[BinaryIO], str],
+                        on_part: Callable[[str], None]) -> int:
+        # small files are uploaded straight from the download buffer without touching the disk
+        if media_file.size <= self._split_threshold_bytes:
+            on_part(transcribe(media_file))
+            return 1
+
+        if not self._segmenter.is_available():
+            logger.warning("ffmpeg is not available, large media file is transcribed in a single request")
+            on_part(transcribe(media_file))
+            return 1
+
+        with tempfile.TemporaryDirectory(prefix="transcription_") as segments_dir:
+            segment_paths = self._segmenter.split(
+                media_file.ensure_path(), self._segment_seconds, self._overlap_seconds, segments_dir
+            )
+            futures = [
+                self._executor.submit(self._transcribe_segment, transcribe, segment_path) for segment_path in segment_paths
+            ]
+            try:
+                # parts are delivered in order, each one as soon as it and all parts before it are transcribed
+                previous_text = ""
+                for future in futures:
+                    text = future.result()
+                    part = remove_overlap(previous_text, text) if previous_text else text
+                    previous_text = text
+                    if part.strip():
+                        on_part(part)
+            finally:
+                # segments must not be removed while they are still being uploaded
+                for future in futures:
+                    future.cancel()
+                wait(futures)
+            return len(segment_paths)
+
+    async def transcribe_file_async(self, media_file: SpooledMediaFile, transcribe: Callable[[BinaryIO], Awaitable[str]],
+                                    on_part: Callable[[str], Awaitable[None]]) -> int:
+        if media_file.size <= self._split_threshold_bytes:
+            await on_part(await transcribe(media_file))
+            return 1
+
+        if not self._segmenter.is_available():
+            logger.warning("ffmpeg is not available, large media file is transcribed in a single request")
+            await on_part(await transcribe(media_file))
+            return 1
+
+        loop = asyncio.get_running_loop()
+        with tempfile.TemporaryDirectory(prefix="transcription_") as segments_dir:
+            # spilling the download to disk and running ffmpeg block, so they run in the executor
+            media_path = await loop.run_in_executor(self._executor, media_file.ensure_path)
+            segment_paths = await loop.run_in_executor(
+                self._executor, self._segmenter.split, media_path, self._segment_seconds, self._overlap_seconds, segments_dir
+            )
+            # the same bound on parallel uploads as the executor gives transcribe_file
+            semaphore = asyncio.Semaphore(self._max_parallel_segments)
+            tasks = [
+                asyncio.ensure_future(self._transcribe_segment_async(transcribe, segment_path, semaphore)) for segment_path in segment_paths
+            ]
+            try:
+                previous_text = ""
+                for task in tasks:
+                    text = await task
+                    part = remove_overlap(previous_text, text) if previous_text else text
+                    previous_text = text
+                    if part.strip():
+                        await on_part(part)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+            return len(segment_paths)
+
+    @staticmethod
+    async def _transcribe_segment_async(transcribe: Callable[[BinaryIO], Awaitable[str]], segment_path: str,
+                                        semaphore: asyncio.Semaphore) -> str:
+        async with semaphore:
+            with open(segment_path, "rb") as segment_file:
+                return await transcribe(segment_file)
+
+    @staticmethod
+    def _transcribe_segment(transcribe: Callable[[BinaryIO], str], segment_path: str) -> str:
+        with open(segment_path, "rb") as segment_file:
+            return transcribe(segment_file)
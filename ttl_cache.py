@@ -0,0 +1,78 @@
+import threading
+import time
+from collections import OrderedDict
+
+class LRUTTLCache:
+    _MISSING = object()
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self._max_size = max(1, max_size)
+        self._ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, self._MISSING)
+            if entry is not self._MISSING:
+                value, expires_at = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    return value
+                del self._entries[key]
+            self._misses += 1
+            return default
+
+    def _store(self, key, value):
+        self._entries[key] = (value, time.monotonic() + self._ttl_seconds)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+    def set(self, key, value):
+        with self._lock:
+            self._store(key, value)
+
+    def set_if_absent(self, key, value) -> bool:
+        with self._lock:
+            entry = self._entries.get(key, self._MISSING)
+            if entry is not self._MISSING and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                return False
+
+            self._store(key, value)
+            return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, self._MISSING)
+            return default if entry is self._MISSING else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def hits(self) -> int:
+        return self._hits
+
+    @property
+    def misses(self) -> int:
+        return self._misses
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions
+            }
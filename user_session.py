@@ -0,0 +1,102 @@
+import time
+
+from chat_state import ChatState
+from DBService.db_service import UserDataDatabaseService
+
+# last_active_at is coarse, it costs at most one extra write per user and period
+LAST_ACTIVE_RESOLUTION_SECONDS = 3600.0
+
+class UserSession:
+    def __init__(self, user_data_db: UserDataDatabaseService, user_id: str):
+        self._user_data_db = user_data_db
+        self._user_id = user_id
+        self._data = user_data_db.load_user_data(user_id)
+        self._dirty_fields = set()
+        self._chat_state = self._parse_chat_state(self._data['chat_state'])
+        self._api_key = None
+        self._api_key_decrypted = False
+
+    @staticmethod
+    def _parse_chat_state(chat_state_value: int | None) -> ChatState:
+        try:
+            return ChatState(chat_state_value)
+        except ValueError:
+            return ChatState.MAIN
+
+    def _set_field(self, field: str, value):
+        if self._data[field] != value:
+            self._data[field] = value
+            self._dirty_fields.add(field)
+
+    @property
+    def user_id(self) -> str:
+        return self._user_id
+
+    @property
+    def chat_state(self) -> ChatState:
+        return self._chat_state
+
+    @chat_state.setter
+    def chat_state(self, chat_state: ChatState):
+        self._chat_state = chat_state
+        self._set_field('chat_state', chat_state.value)
+
+    @property
+    def api_key(self) -> str | None:
+        if not self._api_key_decrypted:
+            api_key = self._user_data_db.decrypt_api_key(self._user_id, self._data['api_key'])
+            self._api_key = api_key.strip() if api_key else None
+            self._api_key_decrypted = True
+        return self._api_key
+
+    @api_key.setter
+    def api_key(self, api_key: str):
+        self._set_field('api_key', self._user_data_db.encrypt_api_key(api_key))
+        self._api_key = api_key.strip() if api_key else None
+        self._api_key_decrypted = True
+
+    @property
+    def img_description(self) -> str | None:
+        return self._data['img_description']
+
+    @img_description.setter
+    def img_description(self, img_description: str):
+        self._set_field('img_description', img_description)
+
+    @property
+    def img_count(self) -> int | None:
+        return self._data['img_count']
+
+    @img_count.setter
+    def img_count(self, img_count: int):
+        self._set_field('img_count', img_count)
+
+    @property
+    def last_keyboard(self) -> str | None:
+        return self._data['last_keyboard']
+
+    @last_keyboard.setter
+    def last_keyboard(self, last_keyboard: str):
+        self._set_field('last_keyboard', last_keyboard)
+
+    def record_activity(self):
+        last_active_at = self._data['last_active_at']
+        now = time.time()
+        if last_active_at is None or now - last_active_at >= LAST_ACTIVE_RESOLUTION_SECONDS:
+            self._set_field('last_active_at', now)
+
+    def mark_subscribed(self):
+        # users who write to the bot are subscribed again, the field is only written when it changes
+        self._set_field('unsubscribed_at', None)
+
+    @property
+    def is_dirty(self) -> bool:
+        return bool(self._dirty_fields)
+
+    def flush(self):
+        if not self._dirty_fields:
+            return
+
+        changed_fields = {field: self._data[field] for field in self._dirty_fields}
+        self._user_data_db.update_user_data(self._user_id, changed_fields)
+        self._dirty_fields.clear()
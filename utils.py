@@ -1,5 +1,10 @@
+import hmac
+import io
+import os
+import tempfile
 import requests
 import mimetypes
+from requests.adapters import HTTPAdapter
 
 mimetypes.init()
 
@@ -14,12 +19,148 @@ def is_media_file(fileName):
 
     return False
 
-def download_file(url, save_path):
-    response = requests.get(url, stream=True)
+def get_env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value else default
 
-    if response.status_code == 200:
-        with open(save_path, 'wb') as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                file.write(chunk)
-    else:
-        raise Exception(f"Failed to download file. Status code: {response.status_code}")
\ No newline at end of file
+def get_env_float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    return float(value) if value else default
+
+def get_env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    return value.strip().lower() in ('1', 'true', 'yes', 'on') if value else default
+
+def get_env_str(name: str, default: str) -> str:
+    return os.getenv(name) or default
+
+class Settings:
+    # Values passed to the app factory take precedence over environment variables of the same name.
+    def __init__(self, overrides: dict | None = None):
+        self._overrides = dict(overrides or {})
+
+    def get_int(self, name: str, default: int) -> int:
+        return int(self._overrides[name]) if name in self._overrides else get_env_int(name, default)
+
+    def get_float(self, name: str, default: float) -> float:
+        return float(self._overrides[name]) if name in self._overrides else get_env_float(name, default)
+
+    def get_bool(self, name: str, default: bool) -> bool:
+        if name in self._overrides:
+            value = self._overrides[name]
+            return value.strip().lower() in ('1', 'true', 'yes', 'on') if isinstance(value, str) else bool(value)
+        return get_env_bool(name, default)
+
+    def get_str(self, name: str, default: str | None) -> str | None:
+        return self._overrides[name] if name in self._overrides else get_env_str(name, default)
+
+def is_admin_request(admin_token: str | None, authorization: str | None) -> bool:
+    # admin endpoints are disabled while no token is configured
+    if not admin_token or not authorization:
+        return False
+    scheme, _, token = authorization.partition(" ")
+    return scheme.lower() == "bearer" and hmac.compare_digest(token.strip().encode(), admin_token.encode())
+
+class FileTooLargeError(Exception):
+    pass
+
+class SpooledMediaFile:
+    # Keeps small downloads in memory and spills bigger ones to a unique named temp file,
+    # so they can still be handed to tools that need a path (ffmpeg).
+    def __init__(self, file_name: str, spool_threshold: int = 5 * 1024 * 1024):
+        self._file_name = file_name
+        self._spool_threshold = spool_threshold
+        self._file = io.BytesIO()
+        self._path = None
+        self._size = 0
+
+    @property
+    def name(self) -> str:
+        # the original file name lets the OpenAI client detect the media format
+        return self._file_name
+
+    @property
+    def path(self) -> str | None:
+        return self._path
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def write(self, data: bytes):
+        if self._path is None and self._size + len(data) > self._spool_threshold:
+            self._rollover()
+        self._file.write(data)
+        self._size += len(data)
+
+    def ensure_path(self) -> str:
+        if self._path is None:
+            self._rollover()
+        self._file.flush()
+        return self._path
+
+    def _rollover(self):
+        extension = os.path.splitext(self._file_name)[1]
+        disk_file = tempfile.NamedTemporaryFile(prefix="user_media_", suffix=extension, delete=False)
+        self._path = disk_file.name
+        try:
+            disk_file.write(self._file.getbuffer())
+        except Exception:
+            disk_file.close()
+            os.remove(self._path)
+            raise
+        position = self._file.tell()
+        self._file = disk_file
+        self._file.seek(position)
+
+    def read(self, size: int = -1) -> bytes:
+        return self._file.read(size)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if self._path is not None:
+            self._file.flush()
+        return self._file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+    def close(self):
+        self._file.close()
+        if self._path is not None and os.path.exists(self._path):
+            os.remove(self._path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+_http_session = requests.Session()
+_http_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+_http_session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+def download_media(url: str, file_name: str, max_bytes: int, spool_threshold: int = 5 * 1024 * 1024,
+                   expected_size: int | None = None, timeout: tuple[float, float] = (5.0, 30.0)) -> SpooledMediaFile:
+    if expected_size is not None and expected_size > max_bytes:
+        raise FileTooLargeError(f"File size {expected_size} exceeds the limit of {max_bytes} bytes")
+
+    media_file = SpooledMediaFile(file_name, spool_threshold)
+    try:
+        with _http_session.get(url, stream=True, timeout=timeout) as response:
+            if response.status_code != 200:
+                raise Exception(f"Failed to download file. Status code: {response.status_code}")
+
+            content_length = response.headers.get("Content-Length")
+            if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+                raise FileTooLargeError(f"File size {content_length} exceeds the limit of {max_bytes} bytes")
+
+            # the declared sizes can be missing or wrong, so the limit is also checked while streaming
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                if media_file.size + len(chunk) > max_bytes:
+                    raise FileTooLargeError(f"File exceeds the limit of {max_bytes} bytes")
+                media_file.write(chunk)
+        media_file.seek(0)
+        return media_file
+    except BaseException:
+        media_file.close()
+        raise
@@ -0,0 +1,189 @@
+import json
+import logging
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from viberbot.api.bot_configuration import BotConfiguration
+from viberbot.api.consts import VIBER_BOT_API_URL, VIBER_BOT_USER_AGENT, BOT_API_ENDPOINT
+from viberbot.api.messages.text_message import TextMessage
+
+from keyboards import RegisteredKeyboard
+from metrics import metrics_registry
+from rate_limiter import TokenBucket
+from text_chunking import split_text
+
+logger = logging.getLogger(__name__)
+
+# viber may have delivered a message when the call failed in any other way, sending it again would duplicate it
+RETRYABLE_STATUS_CODES = (429,)
+# the viberbot package has no client for the broadcast API
+BROADCAST_MESSAGE_ENDPOINT = "broadcast_message"
+BROADCAST_MAX_RECIPIENTS = 300
+
+def _add_sender(bot_configuration: BotConfiguration, message_payload: dict):
+    message_payload.update({
+        "auth_token": bot_configuration.auth_token,
+        "sender": {
+            "name": bot_configuration.name,
+            "avatar": bot_configuration.avatar
+        }
+    })
+
+def _validated_payloads(messages: list) -> list[dict]:
+    payloads = []
+    for message in messages:
+        if not message.validate():
+            raise Exception(f"failed validating message: {message}")
+        payloads.append(message.to_dict())
+    return payloads
+
+def _build_message_body(bot_configuration: BotConfiguration, to: str, message_payload: dict, keyboard_json: str | None) -> bytes:
+    _add_sender(bot_configuration, message_payload)
+    message_payload["receiver"] = to
+    body = json.dumps(message_payload, ensure_ascii=False)
+    if keyboard_json is not None:
+        # keyboards are pre-serialized, so their json is spliced into the body instead of being dumped again
+        body = f'{body[:-1]}, "keyboard": {keyboard_json}}}'
+    return body.encode()
+
+def build_message_bodies(bot_configuration: BotConfiguration, to: str, messages: list, keyboard_json: str | None = None) -> list[bytes]:
+    payloads = _validated_payloads(messages)
+
+    # the keyboard is attached to the last message instead of being sent as a separate request
+    if keyboard_json is not None and not payloads:
+        payloads.append({})
+
+    last_index = len(payloads) - 1
+    return [
+        _build_message_body(bot_configuration, to, payload, keyboard_json if index == last_index else None)
+        for index, payload in enumerate(payloads)
+    ]
+
+def build_broadcast_bodies(bot_configuration: BotConfiguration, receivers: list[str], messages: list) -> list[bytes]:
+    if len(receivers) > BROADCAST_MAX_RECIPIENTS:
+        raise ValueError(f"Broadcast to {len(receivers)} receivers exceeds the limit of {BROADCAST_MAX_RECIPIENTS}")
+
+    bodies = []
+    for payload in _validated_payloads(messages):
+        _add_sender(bot_configuration, payload)
+        payload["broadcast_list"] = receivers
+        bodies.append(json.dumps(payload, ensure_ascii=False).encode())
+    return bodies
+
+def _is_connect_error(error: requests.RequestException) -> bool:
+    # the request was not sent when no connection could be established
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(error, requests.ConnectionError) and isinstance(reason, NewConnectionError)
+
+def get_message_token(result: dict):
+    if result["status"] != 0:
+        raise Exception(f"failed with status: {result['status']}, message: {result.get('status_message')}")
+    return result.get("message_token")
+
+class ViberMessageSender:
+    def __init__(self, bot_configuration: BotConfiguration, api_url: str = VIBER_BOT_API_URL,
+                 rate_limiter: TokenBucket | None = None, max_retries: int = 3, backoff_seconds: float = 0.5,
+                 timeout: float = 10.0, pool_size: int = 10):
+        self._bot_configuration = bot_configuration
+        self._send_message_url = f"{api_url.rstrip('/')}/{BOT_API_ENDPOINT.SEND_MESSAGE}"
+        self._broadcast_message_url = f"{api_url.rstrip('/')}/{BROADCAST_MESSAGE_ENDPOINT}"
+        self._rate_limiter = rate_limiter
+        self._max_retries = max_retries
+        self._backoff_seconds = backoff_seconds
+        self._timeout = timeout
+        # a single session keeps keep-alive connections to the Viber API open between replies
+        self._session = requests.Session()
+        self._session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self._session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self._session.headers.update({
+            "User-Agent": VIBER_BOT_USER_AGENT,
+            "X-Viber-Auth-Token": bot_configuration.auth_token
+        })
+
+    def close(self):
+        self._session.close()
+
+    def send_messages(self, to: str, messages: list, keyboard_json: str | None = None) -> list:
+        return [
+            get_message_token(self._post(body))
+            for body in build_message_bodies(self._bot_configuration, to, messages, keyboard_json)
+        ]
+
+    def broadcast_messages(self, receivers: list[str], messages: list) -> list[dict]:
+        # returns the failed_list entries of all calls, a receiver can be listed once per message
+        failed_list = []
+        for body in build_broadcast_bodies(self._bot_configuration, receivers, messages):
+            result = self._post_to(self._broadcast_message_url, body)
+            get_message_token(result)
+            failed_list.extend(result.get("failed_list", []))
+        return failed_list
+
+    def _post(self, payload: bytes) -> dict:
+        return self._post_to(self._send_message_url, payload)
+
+    def _post_to(self, url: str, payload: bytes) -> dict:
+        attempt = 0
+        while True:
+            if self._rate_limiter is not None:
+                self._rate_limiter.acquire()
+
+            retry_after = None
+            try:
+                with metrics_registry.timer("viber_send"):
+                    response = self._session.post(url, data=payload, timeout=self._timeout)
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    if not response.ok:
+                        logger.warning(f"Sending Viber message failed with status code {response.status_code}, it is not sent again.")
+                    response.raise_for_status()
+                    return response.json()
+                retry_after = response.headers.get("Retry-After")
+                error = f"status code {response.status_code}"
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if not _is_connect_error(e):
+                    logger.warning(f"Sending Viber message failed ({e}), it may have been delivered and is not sent again.")
+                    raise
+                error = str(e)
+
+            if attempt >= self._max_retries:
+                raise Exception(f"Failed to send Viber message after {attempt + 1} attempts: {error}")
+
+            delay = self._backoff_seconds * 2 ** attempt
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, float(retry_after))
+            logger.warning(f"Sending Viber message failed ({error}), retrying in {delay} seconds.")
+            time.sleep(delay)
+            attempt += 1
+
+class OutboundMessageBuffer:
+    def __init__(self, sender: ViberMessageSender, user_id: str):
+        self._sender = sender
+        self._user_id = user_id
+        self._messages = []
+        self._keyboard = None
+
+    def add_text(self, text: str):
+        # texts over the Viber limit are split into several messages
+        self._messages.extend(TextMessage(text=chunk) for chunk in split_text(text))
+
+    def add_messages(self, messages: list):
+        self._messages.extend(messages)
+
+    def set_keyboard(self, keyboard: RegisteredKeyboard):
+        self._keyboard = keyboard
+
+    def _take_pending(self) -> tuple[list, str | None] | None:
+        if not self._messages and self._keyboard is None:
+            return None
+
+        messages, keyboard = self._messages, self._keyboard
+        self._messages, self._keyboard = [], None
+        return messages, keyboard.payload_json if keyboard is not None else None
+
+    def flush(self):
+        pending = self._take_pending()
+        if pending is not None:
+            self._sender.send_messages(self._user_id, *pending)